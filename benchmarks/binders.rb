@@ -0,0 +1,76 @@
+#Compares reflecting over a gateway method's parameters on every request with
+#the argument binders am_bridge.rb compiles at configure time
+#
+#Run from the repository root:
+#  ruby benchmarks/binders.rb [NUMBER]
+#
+#Prints the CPU microseconds per call spent binding authorize arguments each
+#way, and for a whole authorize request through handle_request on the bogus
+#gateway.
+require "benchmark"
+require File.expand_path('../../payment_bridge/am_bridge', __FILE__)
+
+#what every request used to do before binders were compiled
+def reflect_arguments(gateway, money, credit_card, options)
+  master_params = {
+    :money=>money,
+    :credit_card=>credit_card,
+    :creditcard=>credit_card,
+    :credit_card_or_reference=>credit_card,
+    :creditcard_or_reference=>credit_card,
+    :creditcard_or_card_id=>credit_card,
+    :creditcard_or_billing_id=>credit_card,
+    :authorization_or_credit_card=>credit_card,
+    :credit_card_or_vault_id=>credit_card,
+    :creditcard_or_stored_id=>credit_card,
+    :source=>credit_card,
+    :payment_object=>credit_card,
+    :payment_source=>credit_card,
+    :payment_method=>credit_card,
+    :card_or_auth=>credit_card,
+    :options=>options
+  }
+  in_params = []
+  for required, symbol in gateway.method(:authorize).parameters
+    in_params.push(master_params[symbol])
+  end
+  return in_params
+end
+
+def cpu_us(number)
+  return Benchmark.measure { number.times { yield } }.total / number * 1e6
+end
+
+number = Integer(ARGV[0] || 20000)
+
+bridge = PaymentBridge.new()
+bridge.configure([{'module' => 'bogus', 'name' => 'test', 'params' => {}}])
+gateway = bridge.get_gateway('test')
+
+data = {
+  'cc_number' => '1',
+  'cc_exp_year' => '2015',
+  'cc_exp_month' => '11',
+  'cc_ccv' => '111',
+  'bill_first_name' => 'John',
+  'bill_last_name' => 'Smith',
+  'bill_address1' => '5555 Main St',
+  'bill_city' => 'San Diego',
+  'bill_state' => 'CA',
+  'bill_country' => 'US',
+  'bill_zip' => '92101'
+}
+payload = {'gateway' => 'test', 'action' => 'authorize', 'data' => data, 'secure_data' => {'money' => '100'}, 'request_id' => 1}
+credit_card = bridge.build_credit_card(data)
+options = {}
+
+reflected = cpu_us(number) { reflect_arguments(gateway, 100, credit_card, options) }
+bound = cpu_us(number) { bridge.bind_arguments(gateway, 'authorize', {:money=>100, :credit_card=>credit_card, :options=>options}) }
+request = cpu_us(number) { bridge.handle_request(payload) }
+
+puts JSON.pretty_generate({
+  'reflect_us' => reflected,
+  'binder_us' => bound,
+  'saved_us' => reflected - bound,
+  'authorize_request_us' => request
+})
@@ -0,0 +1,98 @@
+"""
+Compares payload codecs on the response a direct post hands back
+
+Run from the repository root:
+  python benchmarks/codec.py [--number 5000]
+
+For each codec, prints the bytes of the encrypted payload and the
+microseconds spent in dumps, loads and a full round trip. The payload is a
+bogus authorize response echoing get_all_info(). When Django is installed,
+django.core.signing, which DjangoDirectPostApplication used to import on
+every call, is measured as well.
+"""
+from __future__ import print_function
+import json
+import optparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from payment_bridge.payloads import SERIALIZERS, DjangoSigningCodec, SignedCodec
+from payment_bridge.tests.common import PaymentData
+
+
+def build_response():
+    response = {'gateway':'test',
+                'action':'authorize',
+                'success':True,
+                'test':True,
+                'fraud_review':False,
+                'message':'Bogus Gateway: Forced success',
+                'authorization':'53433',
+                'session_data':None,
+                'cc_display':'XXXX-XXXX-XXXX-1111',
+                'cc_exp_month':11,
+                'cc_exp_year':2015,
+                'cc_type':'visa',
+                'money':100,}
+    for key, value in PaymentData().get_all_info().items():
+        if key.startswith('bill_') or key.startswith('ship_'):
+            response[key] = value
+    return response
+
+def build_codecs():
+    codecs = dict()
+    try:
+        from django.conf import settings
+        from django.core import signing
+    except ImportError:
+        print('Django is not installed, django.core.signing was not measured', file=sys.stderr)
+    else:
+        settings.configure(SECRET_KEY='benchmark')
+        codecs['django_per_call_import'] = PerCallDjangoSigning('payment_bridge.wsgi')
+        codecs['django_signer'] = DjangoSigningCodec(salt='payment_bridge.wsgi')
+    for name in sorted(SERIALIZERS):
+        codecs['signed_%s' % name] = SignedCodec('benchmark', serializer=name, compress=False)
+        codecs['signed_%s_zlib' % name] = SignedCodec('benchmark', serializer=name)
+    return codecs
+
+class PerCallDjangoSigning(object):
+    """
+    What DjangoDirectPostApplication did before it had a codec
+    """
+    def __init__(self, salt):
+        self.salt = salt
+    
+    def dumps(self, params):
+        from django.core.signing import dumps
+        return dumps(params, salt=self.salt)
+    
+    def loads(self, payload):
+        from django.core.signing import loads
+        return loads(payload, salt=self.salt)
+
+def measure(codec, params, number):
+    payload = codec.dumps(params)
+    dumps = timeit.timeit(lambda: codec.dumps(params), number=number)
+    loads = timeit.timeit(lambda: codec.loads(payload), number=number)
+    round_trip = timeit.timeit(lambda: codec.loads(codec.dumps(params)), number=number)
+    return {'bytes':len(payload),
+            'dumps_us':dumps / number * 1e6,
+            'loads_us':loads / number * 1e6,
+            'round_trip_us':round_trip / number * 1e6,}
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--number', type='int', default=5000)
+    options, args = parser.parse_args()
+    
+    params = build_response()
+    results = dict()
+    for name, codec in sorted(build_codecs().items()):
+        results[name] = measure(codec, params, options.number)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Compares the cost of the bridge framings for a typical direct post round trip
+
+Run from the repository root:
+  python benchmarks/framing.py [--number 20000]
+
+For each framing, prints the bytes on the wire and the microseconds spent
+encoding and decoding a request carrying get_all_info() and the response
+echoing it back.
+"""
+from __future__ import print_function
+import json
+import optparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from payment_bridge.framing import FRAMINGS
+from payment_bridge.tests.common import PaymentData
+
+
+def build_messages():
+    data = PaymentData().get_all_info()
+    request = {'request_id':12345678,
+               'gateway':'test',
+               'action':'authorize',
+               'data':data,
+               'secure_data':{'money':'100', 'gateway':'test', 'action':'authorize',
+                              'redirect':'http://localhost:8080/direct-post/'},}
+    response = {'request_id':12345678,
+                'gateway':'test',
+                'action':'authorize',
+                'success':True,
+                'test':True,
+                'fraud_review':False,
+                'message':'Bogus Gateway: Forced success',
+                'authorization':'53433',
+                'session_data':None,
+                'cc_display':'XXXX-XXXX-XXXX-1111',
+                'cc_exp_month':11,
+                'cc_exp_year':2015,
+                'cc_type':'visa',
+                'money':100,}
+    for key, value in data.items():
+        if key.startswith('bill_') or key.startswith('ship_'):
+            response[key] = value
+    return request, response
+
+def measure(framing, message, number):
+    encoded = framing.encode(message)
+    encode = timeit.timeit(lambda: framing.encode(message), number=number)
+    decode = timeit.timeit(lambda: framing.decode(encoded), number=number)
+    return {'bytes':len(encoded),
+            'encode_us':encode / number * 1e6,
+            'decode_us':decode / number * 1e6,}
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--number', type='int', default=20000)
+    options, args = parser.parse_args()
+    
+    request, response = build_messages()
+    results = dict()
+    for name, framing in sorted(FRAMINGS.items()):
+        results[name] = {'request':measure(framing, request, options.number),
+                         'response':measure(framing, response, options.number),}
+    print(json.dumps(results, indent=2, sort_keys=True))
+    if 'msgpack' not in FRAMINGS:
+        print('msgpack is not installed, only JSON was measured', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
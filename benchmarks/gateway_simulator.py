@@ -0,0 +1,460 @@
+"""
+Local stand-in for the Authorize.Net CIM and Orbital XML APIs
+
+Run from the repository root:
+  python benchmarks/gateway_simulator.py [--port 8099] [--latency uniform:0.1,0.4]
+                                         [--error-rate 0.01] [--drop-rate 0.001]
+
+Point the compat gateways at it with the url param, e.g. in gateways.yaml:
+
+  authorize_net_cim_compat:
+    login: simulator
+    password: simulator
+    test: true
+    url: http://localhost:8099/xml/v1/request.api
+  orbital_compat:
+    login: simulator
+    password: simulator
+    merchant_id: '000000'
+    test: true
+    url: http://localhost:8099/authorize
+
+Requests are told apart by their XML, so any path works. Profiles and
+transactions are kept in memory so multi-call flows (store, then authorize
+against the stored profile, then capture) behave like the real thing. Cards
+listed in --decline-cards are declined.
+
+--latency takes a fixed number of seconds or a distribution:
+  uniform:LOW,HIGH  normal:MEAN,STDDEV  lognormal:MEDIAN,SIGMA
+--error-rate answers that fraction of requests with a gateway error and
+--drop-rate closes that fraction of connections without answering.
+GET /stats returns request counts as JSON.
+"""
+from __future__ import print_function
+from threading import Lock
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError: #python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+from itertools import count
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+import json
+import math
+import optparse
+import random
+import sys
+import time
+
+
+CIM_NAMESPACE = 'AnetApi/xml/v1/schema/AnetApiSchema.xsd'
+
+CIM_TRANSACTION_TYPES = {'profileTransAuthOnly':'auth_only',
+                         'profileTransAuthCapture':'auth_capture',
+                         'profileTransCaptureOnly':'capture_only',
+                         'profileTransPriorAuthCapture':'prior_auth_capture',
+                         'profileTransVoid':'void',
+                         'profileTransRefund':'refund',}
+
+def local_name(tag):
+    return tag.split('}', 1)[-1]
+
+def find_text(element, *path):
+    #namespace agnostic lookup of a nested element's text
+    for name in path:
+        if element is None:
+            return None
+        element = next((child for child in element if local_name(child.tag) == name), None)
+    if element is None:
+        return None
+    return element.text
+
+def find_all(element, name):
+    return [child for child in element if local_name(child.tag) == name]
+
+def render_elements(fields):
+    """
+    Renders (tag, value) pairs, where value is text or a list of pairs
+    """
+    parts = []
+    for tag, value in fields:
+        if value is None:
+            continue
+        if isinstance(value, list):
+            value = render_elements(value)
+        else:
+            value = escape(str(value))
+        parts.append('<%s>%s</%s>' % (tag, value, tag))
+    return ''.join(parts)
+
+def parse_latency(value):
+    """
+    Returns a function giving the next delay in seconds
+    """
+    if ':' not in value:
+        delay = float(value)
+        return lambda: delay
+    kind, params = value.split(':', 1)
+    first, second = [float(param) for param in params.split(',')]
+    if kind == 'uniform':
+        return lambda: random.uniform(first, second)
+    if kind == 'normal':
+        return lambda: max(0, random.normalvariate(first, second))
+    if kind == 'lognormal':
+        mu = math.log(first)
+        return lambda: random.lognormvariate(mu, second)
+    raise ValueError('Unknown latency distribution: %s' % kind)
+
+class GatewayState(object):
+    """
+    Profiles and transactions shared by every connection
+    """
+    def __init__(self, decline_cards=()):
+        self.lock = Lock()
+        self.ids = count(1000)
+        self.decline_cards = set(decline_cards)
+        #profile id => {'payment_profiles': {id: card number}, 'addresses': set of ids}
+        self.cim_profiles = dict()
+        #transaction id => card number
+        self.cim_transactions = dict()
+        #customer ref num => card number
+        self.orbital_profiles = dict()
+        self.stats = {'requests':0, 'errors':0, 'drops':0, 'declines':0}
+    
+    def new_id(self):
+        self.lock.acquire()
+        try:
+            return str(next(self.ids))
+        finally:
+            self.lock.release()
+    
+    def count(self, name):
+        self.lock.acquire()
+        try:
+            self.stats[name] += 1
+        finally:
+            self.lock.release()
+    
+    def declined(self, card_number):
+        if card_number in self.decline_cards:
+            self.count('declines')
+            return True
+        return False
+
+class CIMDialect(object):
+    """
+    Answers createCustomerProfileRequest and friends the way the CIM XML API does
+    """
+    def __init__(self, state):
+        self.state = state
+    
+    def respond(self, request, result_code='Ok', code='I00001', text='Successful.', fields=()):
+        name = local_name(request.tag).replace('Request', 'Response')
+        body = render_elements([('messages', [('resultCode', result_code),
+                                              ('message', [('code', code), ('text', text)])])] + list(fields))
+        return '<?xml version="1.0" encoding="utf-8"?><%s xmlns="%s">%s</%s>' % (name, CIM_NAMESPACE, body, name)
+    
+    def error(self, request, code='E00001', text='An error occurred during processing. Please try again.', fields=()):
+        return self.respond(request, 'Error', code, text, fields)
+    
+    def handle(self, request):
+        if not find_text(request, 'merchantAuthentication', 'name') or not find_text(request, 'merchantAuthentication', 'transactionKey'):
+            return self.error(request, 'E00007', 'User authentication failed due to invalid authentication values.')
+        handler = getattr(self, 'handle_%s' % local_name(request.tag), None)
+        if handler is None:
+            return self.error(request, 'E00003', 'Unsupported request: %s' % local_name(request.tag))
+        return handler(request)
+    
+    def read_card(self, payment_profile):
+        return find_text(payment_profile, 'payment', 'creditCard', 'cardNumber')
+    
+    def handle_createCustomerProfileRequest(self, request):
+        profile = next((child for child in request if local_name(child.tag) == 'profile'), None)
+        payment_profiles = profile is not None and find_all(profile, 'paymentProfiles') or []
+        ship_to_list = profile is not None and find_all(profile, 'shipToList') or []
+        for payment_profile in payment_profiles:
+            if self.state.declined(self.read_card(payment_profile)):
+                return self.error(request, 'E00027', 'The credit card number is invalid.')
+        profile_id = self.state.new_id()
+        payment_profile_ids = [self.state.new_id() for payment_profile in payment_profiles]
+        address_ids = [self.state.new_id() for address in ship_to_list]
+        self.state.cim_profiles[profile_id] = {
+            'payment_profiles':dict(zip(payment_profile_ids, [self.read_card(payment_profile) for payment_profile in payment_profiles])),
+            'addresses':set(address_ids),
+        }
+        fields = [('customerProfileId', profile_id)]
+        if payment_profile_ids:
+            fields.append(('customerPaymentProfileIdList', [('numericString', payment_profile_id) for payment_profile_id in payment_profile_ids]))
+        if address_ids:
+            fields.append(('customerShippingAddressIdList', [('numericString', address_id) for address_id in address_ids]))
+        return self.respond(request, fields=fields)
+    
+    def get_profile(self, request):
+        return self.state.cim_profiles.get(find_text(request, 'customerProfileId'))
+    
+    def handle_createCustomerPaymentProfileRequest(self, request):
+        profile = self.get_profile(request)
+        if profile is None:
+            return self.error(request, 'E00040', 'The record cannot be found.')
+        card_number = find_text(request, 'paymentProfile', 'payment', 'creditCard', 'cardNumber')
+        if self.state.declined(card_number):
+            return self.error(request, 'E00027', 'The credit card number is invalid.')
+        payment_profile_id = self.state.new_id()
+        profile['payment_profiles'][payment_profile_id] = card_number
+        return self.respond(request, fields=[('customerPaymentProfileId', payment_profile_id)])
+    
+    def handle_createCustomerShippingAddressRequest(self, request):
+        profile = self.get_profile(request)
+        if profile is None:
+            return self.error(request, 'E00040', 'The record cannot be found.')
+        address_id = self.state.new_id()
+        profile['addresses'].add(address_id)
+        return self.respond(request, fields=[('customerAddressId', address_id)])
+    
+    def handle_createCustomerProfileTransactionRequest(self, request):
+        transaction = next((child for child in request if local_name(child.tag) == 'transaction'), None)
+        details = transaction is not None and list(transaction) or []
+        if not details or local_name(details[0].tag) not in CIM_TRANSACTION_TYPES:
+            return self.error(request, 'E00003', 'Invalid transaction type.')
+        details = details[0]
+        transaction_type = CIM_TRANSACTION_TYPES[local_name(details.tag)]
+        amount = find_text(details, 'amount') or '0.00'
+        profile = self.state.cim_profiles.get(find_text(details, 'customerProfileId'))
+        if profile is None:
+            return self.error(request, 'E00040', 'The record cannot be found.')
+        card_number = profile['payment_profiles'].get(find_text(details, 'customerPaymentProfileId'))
+        trans_id = find_text(details, 'transId')
+        if transaction_type in ('prior_auth_capture', 'void', 'refund'):
+            if trans_id not in self.state.cim_transactions:
+                return self.error(request, 'E00027', 'The transaction cannot be found.',
+                    [('directResponse', self.direct_response(3, 33, 'The transaction cannot be found.', '', amount, transaction_type))])
+            card_number = self.state.cim_transactions[trans_id]
+        elif self.state.declined(card_number):
+            return self.error(request, 'E00027', 'This transaction has been declined.',
+                [('directResponse', self.direct_response(2, 2, 'This transaction has been declined.', '0', amount, transaction_type))])
+        new_trans_id = self.state.new_id()
+        self.state.cim_transactions[new_trans_id] = card_number
+        return self.respond(request, fields=[('directResponse', self.direct_response(1, 1, 'This transaction has been approved.', new_trans_id, amount, transaction_type))])
+    
+    def direct_response(self, response_code, reason_code, message, trans_id, amount, transaction_type):
+        #the comma separated AIM response parse_direct_response splits up
+        fields = [str(response_code), '1', str(reason_code), message, 'SIMAPP', 'Y', trans_id,
+                  '', '', amount, 'CC', transaction_type]
+        return ','.join(fields + [''] * (68 - len(fields)))
+    
+    def handle_deleteCustomerProfileRequest(self, request):
+        if self.state.cim_profiles.pop(find_text(request, 'customerProfileId'), None) is None:
+            return self.error(request, 'E00040', 'The record cannot be found.')
+        return self.respond(request)
+    
+    def handle_deleteCustomerPaymentProfileRequest(self, request):
+        profile = self.get_profile(request)
+        if profile is None or profile['payment_profiles'].pop(find_text(request, 'customerPaymentProfileId'), None) is None:
+            return self.error(request, 'E00040', 'The record cannot be found.')
+        return self.respond(request)
+    
+    def handle_deleteCustomerShippingAddressRequest(self, request):
+        profile = self.get_profile(request)
+        if profile is None or find_text(request, 'customerAddressId') not in profile['addresses']:
+            return self.error(request, 'E00040', 'The record cannot be found.')
+        profile['addresses'].discard(find_text(request, 'customerAddressId'))
+        return self.respond(request)
+    
+    def handle_getCustomerProfileRequest(self, request):
+        profile_id = find_text(request, 'customerProfileId')
+        profile = self.state.cim_profiles.get(profile_id)
+        if profile is None:
+            return self.error(request, 'E00040', 'The record cannot be found.')
+        fields = [('customerProfileId', profile_id)]
+        for payment_profile_id in sorted(profile['payment_profiles']):
+            fields.append(('paymentProfiles', [('customerPaymentProfileId', payment_profile_id)]))
+        for address_id in sorted(profile['addresses']):
+            fields.append(('shipToList', [('customerAddressId', address_id)]))
+        return self.respond(request, fields=[('profile', fields)])
+
+class OrbitalDialect(object):
+    """
+    Answers NewOrder, MarkForCapture, Reversal and Profile requests the way Orbital does
+    """
+    def __init__(self, state):
+        self.state = state
+    
+    def respond(self, name, fields):
+        return '<?xml version="1.0" encoding="UTF-8"?><Response><%s>%s</%s></Response>' % (name, render_elements(fields), name)
+    
+    def handle(self, request):
+        if len(request) != 1:
+            return self.respond('QuickResp', [('ProcStatus', '9714'), ('StatusMsg', 'Invalid Request')])
+        message = request[0]
+        handler = getattr(self, 'handle_%s' % local_name(message.tag), None)
+        if handler is None:
+            return self.respond('QuickResp', [('ProcStatus', '9714'), ('StatusMsg', 'Unsupported request: %s' % local_name(message.tag))])
+        return handler(message)
+    
+    def error(self, message='Error processing request'):
+        return self.respond('QuickResp', [('ProcStatus', '20412'), ('StatusMsg', message)])
+    
+    def handle_NewOrder(self, message):
+        message_type = find_text(message, 'MessageType')
+        card_number = find_text(message, 'AccountNum')
+        customer_ref_num = find_text(message, 'CustomerRefNum')
+        if not card_number and customer_ref_num:
+            card_number = self.state.orbital_profiles.get(customer_ref_num)
+            if card_number is None:
+                return self.error('Profile does not exist')
+        fields = [('IndustryType', find_text(message, 'IndustryType')),
+                  ('MessageType', message_type),
+                  ('MerchantID', find_text(message, 'MerchantID')),
+                  ('OrderID', find_text(message, 'OrderID')),
+                  ('TxRefNum', self.state.new_id()),
+                  ('ProcStatus', '0'),]
+        if message_type != 'R' and self.state.declined(card_number):
+            fields += [('ApprovalStatus', '0'),
+                       ('RespCode', '05'),
+                       ('AVSRespCode', 'B'),
+                       ('StatusMsg', 'Do Not Honor'),]
+        else:
+            fields += [('ApprovalStatus', '1'),
+                       ('RespCode', '00'),
+                       ('AuthCode', 'SIMAPP'),
+                       ('AVSRespCode', 'H'),
+                       ('CVV2RespCode', 'M'),
+                       ('StatusMsg', 'Approved'),]
+        if customer_ref_num:
+            fields.append(('CustomerRefNum', customer_ref_num))
+        return self.respond('NewOrderResp', fields)
+    
+    def handle_MarkForCapture(self, message):
+        return self.respond('MarkForCaptureResp', [('MerchantID', find_text(message, 'MerchantID')),
+                                                   ('OrderID', find_text(message, 'OrderID')),
+                                                   ('TxRefNum', find_text(message, 'TxRefNum')),
+                                                   ('ProcStatus', '0'),
+                                                   ('StatusMsg', 'Approved'),
+                                                   ('Amount', find_text(message, 'Amount')),])
+    
+    def handle_Reversal(self, message):
+        return self.respond('ReversalResp', [('MerchantID', find_text(message, 'MerchantID')),
+                                             ('OrderID', find_text(message, 'OrderID')),
+                                             ('TxRefNum', find_text(message, 'TxRefNum')),
+                                             ('ProcStatus', '0'),
+                                             ('StatusMsg', 'Approved'),])
+    
+    def handle_Profile(self, message):
+        action = find_text(message, 'CustomerProfileAction')
+        customer_ref_num = find_text(message, 'CustomerRefNum')
+        names = {'C':'CREATE', 'R':'RETRIEVE', 'U':'UPDATE', 'D':'DELETE'}
+        if action == 'C':
+            card_number = find_text(message, 'CCAccountNum')
+            if self.state.declined(card_number):
+                return self.respond('ProfileResp', [('CustomerProfileAction', 'CREATE'),
+                                                    ('ProfileProcStatus', '9581'),
+                                                    ('CustomerProfileMessage', 'Invalid card number'),])
+            customer_ref_num = customer_ref_num or self.state.new_id()
+            self.state.orbital_profiles[customer_ref_num] = card_number
+        elif customer_ref_num not in self.state.orbital_profiles:
+            return self.respond('ProfileResp', [('CustomerRefNum', customer_ref_num),
+                                                ('CustomerProfileAction', names.get(action)),
+                                                ('ProfileProcStatus', '9581'),
+                                                ('CustomerProfileMessage', 'Profile does not exist'),])
+        elif action == 'U' and find_text(message, 'CCAccountNum'):
+            self.state.orbital_profiles[customer_ref_num] = find_text(message, 'CCAccountNum')
+        elif action == 'D':
+            del self.state.orbital_profiles[customer_ref_num]
+        return self.respond('ProfileResp', [('CustomerBin', find_text(message, 'CustomerBin')),
+                                            ('CustomerMerchantID', find_text(message, 'CustomerMerchantID')),
+                                            ('CustomerRefNum', customer_ref_num),
+                                            ('CustomerProfileAction', names.get(action)),
+                                            ('ProfileProcStatus', '0'),
+                                            ('CustomerProfileMessage', 'Profile Request Processed'),])
+
+class SimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    #headers and body go out in separate writes, without this every request
+    #on a kept alive connection waits out the client's delayed ACK
+    disable_nagle_algorithm = True
+    
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+    
+    def send_body(self, status, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def do_GET(self):
+        if self.path == '/stats':
+            return self.send_body(200, 'application/json', json.dumps(self.server.state.stats))
+        self.send_body(404, 'text/plain', 'Not found')
+    
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        server.state.count('requests')
+        time.sleep(server.latency())
+        if random.random() < server.drop_rate:
+            #like a load balancer giving up on us
+            server.state.count('drops')
+            self.close_connection = True
+            return
+        try:
+            request = ElementTree.fromstring(body)
+        except ElementTree.ParseError as error:
+            return self.send_body(400, 'text/plain', 'Malformed XML: %s' % error)
+        if local_name(request.tag) == 'Request':
+            dialect = server.orbital
+        else:
+            dialect = server.cim
+        if random.random() < server.error_rate:
+            server.state.count('errors')
+            if dialect is server.cim:
+                response = dialect.error(request)
+            else:
+                response = dialect.error()
+        else:
+            response = dialect.handle(request)
+        self.send_body(200, 'text/xml', response)
+
+class GatewaySimulator(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    
+    def __init__(self, address, latency='0', error_rate=0, drop_rate=0, decline_cards=(), verbose=False):
+        HTTPServer.__init__(self, address, SimulatorHandler)
+        self.latency = parse_latency(latency)
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.verbose = verbose
+        self.state = GatewayState(decline_cards)
+        self.cim = CIMDialect(self.state)
+        self.orbital = OrbitalDialect(self.state)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--host', default='localhost')
+    parser.add_option('--port', type='int', default=8099)
+    parser.add_option('--latency', default='0', help='seconds, or uniform:LOW,HIGH normal:MEAN,STDDEV lognormal:MEDIAN,SIGMA')
+    parser.add_option('--error-rate', type='float', default=0)
+    parser.add_option('--drop-rate', type='float', default=0)
+    parser.add_option('--decline-cards', default='2,4000300011112220')
+    parser.add_option('--seed', type='int')
+    parser.add_option('--verbose', action='store_true', default=False)
+    options, args = parser.parse_args()
+    if options.seed is not None:
+        random.seed(options.seed)
+    
+    server = GatewaySimulator((options.host, options.port), latency=options.latency,
+                              error_rate=options.error_rate, drop_rate=options.drop_rate,
+                              decline_cards=options.decline_cards.split(','), verbose=options.verbose)
+    print('Gateway simulator listening on http://%s:%s/' % (options.host, options.port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
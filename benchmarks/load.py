@@ -0,0 +1,211 @@
+"""
+Load and latency benchmark against the bogus gateway
+
+Run from the repository root:
+  python benchmarks/load.py [--targets bridge,jsonp,post] [--concurrency 1,8,32]
+                            [--workers 1,4] [--payload 0,4096] [--requests 2000]
+
+Every combination of target, concurrency, worker count and payload size is
+run in turn. Targets:
+* bridge - BridgePool.send directly
+* jsonp - BaseDirectPostApplication.__call__ with a GET/JSONP request
+* post - BaseDirectPostApplication.__call__ with a POST/303 request
+payload is the number of extra bytes of caller data sent with each
+authorize. Prints a JSON list with throughput and p50/p99/p999 latency in
+milliseconds for each run.
+"""
+from __future__ import print_function
+from io import BytesIO
+from threading import Lock, Thread
+import base64
+import json
+import math
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from payment_bridge.wsgi import BaseDirectPostApplication, Bridge, BridgePool, urlencode
+from payment_bridge.tests.common import PaymentData
+
+
+BOGUS_CONFIG = [{'module':'bogus', 'name':'test', 'params':{}}]
+
+class BenchmarkApplication(BaseDirectPostApplication):
+    def load_gateways_config(self):
+        return BOGUS_CONFIG
+    
+    def decrypt_data(self, encrypted_data):
+        return json.loads(base64.b64decode(encrypted_data).decode('utf-8'))
+    
+    def encrypt_data(self, params):
+        return base64.b64encode(json.dumps(params).encode('utf-8')).decode('ascii')
+
+def build_caller_data(payload_size):
+    data = PaymentData().get_all_info()
+    data['cc_number'] = '1'
+    if payload_size:
+        data['notes'] = 'x' * payload_size
+    return data
+
+def wait_for_standby(bridge, timeout=60):
+    #standby processes booting in the background would compete for CPU
+    workers = getattr(bridge, 'workers', [bridge])
+    end = time.time() + timeout
+    while time.time() < end:
+        if all(worker.supervisor.stats()['standby_ready'] for worker in workers):
+            return
+        time.sleep(.05)
+
+def percentile(latencies, fraction):
+    #nearest rank on sorted latencies
+    index = int(math.ceil(fraction * len(latencies))) - 1
+    return latencies[max(0, min(index, len(latencies) - 1))]
+
+class Target(object):
+    def __init__(self, workers, payload_size):
+        self.data = build_caller_data(payload_size)
+        self.secure_data = {'gateway':'test', 'action':'authorize', 'money':'100'}
+
+class BridgeTarget(Target):
+    def __init__(self, workers, payload_size):
+        super(BridgeTarget, self).__init__(workers, payload_size)
+        self.bridge = BridgePool(size=workers, bridge_class=Bridge,
+                                 environ={'PAYMENT_CONFIGURATION':json.dumps(BOGUS_CONFIG)})
+    
+    def request(self):
+        response = self.bridge.send(data=self.data, secure_data=self.secure_data, gateway='test', action='authorize')
+        return response['success']
+    
+    def close(self):
+        self.bridge.close()
+
+class ApplicationTarget(Target):
+    def __init__(self, workers, payload_size):
+        super(ApplicationTarget, self).__init__(workers, payload_size)
+        application_class = type('PooledBenchmarkApplication', (BenchmarkApplication,), {'bridge_pool_size':workers})
+        self.application = application_class(redirect_to='http://localhost:8080/direct-post/')
+        self.bridge = self.application.bridge
+        caller_data = dict(self.data)
+        caller_data['payload'] = self.application.encrypt_data(self.secure_data)
+        self.caller_data = caller_data
+    
+    def close(self):
+        self.application.shutdown()
+
+class JSONPTarget(ApplicationTarget):
+    def __init__(self, workers, payload_size):
+        super(JSONPTarget, self).__init__(workers, payload_size)
+        self.query = urlencode(dict(self.caller_data, callback='done'))
+    
+    def request(self):
+        statuses = []
+        self.application({'REQUEST_METHOD':'GET', 'QUERY_STRING':self.query},
+                         lambda status, headers: statuses.append(status))
+        return statuses == ['200 OK']
+
+class PostTarget(ApplicationTarget):
+    def __init__(self, workers, payload_size):
+        super(PostTarget, self).__init__(workers, payload_size)
+        self.body = urlencode(self.caller_data).encode('ascii')
+    
+    def request(self):
+        statuses = []
+        self.application({'REQUEST_METHOD':'POST',
+                          'CONTENT_LENGTH':str(len(self.body)),
+                          'wsgi.input':BytesIO(self.body),},
+                         lambda status, headers: statuses.append(status))
+        return statuses == ['303 SEE OTHER']
+
+TARGETS = {'bridge':BridgeTarget,
+           'jsonp':JSONPTarget,
+           'post':PostTarget,}
+
+def run(target, concurrency, requests):
+    """
+    Sends requests from concurrency threads; returns sorted latencies and the error count
+    """
+    latencies = []
+    errors = [0]
+    lock = Lock()
+    remaining = [requests]
+    def client():
+        while True:
+            lock.acquire()
+            try:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            finally:
+                lock.release()
+            started = time.time()
+            try:
+                ok = target.request()
+            except Exception:
+                ok = False
+            elapsed = time.time() - started
+            lock.acquire()
+            try:
+                latencies.append(elapsed)
+                if not ok:
+                    errors[0] += 1
+            finally:
+                lock.release()
+    clients = [Thread(target=client) for index in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    latencies.sort()
+    return latencies, errors[0]
+
+def benchmark(name, concurrency, workers, payload_size, requests, warmup):
+    target = TARGETS[name](workers, payload_size)
+    try:
+        wait_for_standby(target.bridge)
+        run(target, concurrency, warmup)
+        started = time.time()
+        latencies, errors = run(target, concurrency, requests)
+        seconds = time.time() - started
+    finally:
+        target.close()
+    return {'target':name,
+            'concurrency':concurrency,
+            'workers':workers,
+            'payload_bytes':payload_size,
+            'requests':requests,
+            'errors':errors,
+            'seconds':seconds,
+            'throughput_rps':requests / seconds,
+            'p50_ms':percentile(latencies, .5) * 1000,
+            'p99_ms':percentile(latencies, .99) * 1000,
+            'p999_ms':percentile(latencies, .999) * 1000,}
+
+def parse_list(value, cast=int):
+    return [cast(item) for item in value.split(',') if item]
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--targets', default='bridge,jsonp,post')
+    parser.add_option('--concurrency', default='1,8,32')
+    parser.add_option('--workers', default='1,4')
+    parser.add_option('--payload', default='0,4096')
+    parser.add_option('--requests', type='int', default=2000)
+    parser.add_option('--warmup', type='int', default=100)
+    options, args = parser.parse_args()
+    
+    results = []
+    for name in parse_list(options.targets, str):
+        for workers in parse_list(options.workers):
+            for concurrency in parse_list(options.concurrency):
+                for payload_size in parse_list(options.payload):
+                    result = benchmark(name, concurrency, workers, payload_size, options.requests, options.warmup)
+                    print('%(target)s concurrency=%(concurrency)s workers=%(workers)s payload=%(payload_bytes)s: '
+                          '%(throughput_rps).0f/s p99 %(p99_ms).2fms' % result, file=sys.stderr)
+                    results.append(result)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
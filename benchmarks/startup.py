@@ -0,0 +1,69 @@
+"""
+Bridge process start times, booting ruby against forking from a zygote
+
+Run from the repository root:
+  python benchmarks/startup.py [--samples 20]
+
+Times Bridge.spawn, from starting the process until it has sent its
+capabilities and agreed on framing, which is what a bridge waits for on
+scale up or crash recovery. Prints JSON with p50 and max for a cold ruby
+start and for a fork from a Zygote, in milliseconds, and how long the zygote
+itself took to boot.
+"""
+from __future__ import print_function
+import json
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from payment_bridge.wsgi import Bridge, Zygote
+
+
+BOGUS_CONFIG = [{'module':'bogus', 'name':'test', 'params':{}}]
+
+def time_spawns(bridge, samples):
+    latencies = []
+    for index in range(samples):
+        started = time.time()
+        process = bridge.spawn()[0]
+        latencies.append(time.time() - started)
+        process.kill()
+        process.wait()
+    latencies.sort()
+    return {'p50_ms':latencies[len(latencies) // 2] * 1000,
+            'max_ms':latencies[-1] * 1000,}
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--samples', type='int', default=20)
+    options, args = parser.parse_args()
+    
+    environ = {'PAYMENT_CONFIGURATION':json.dumps(BOGUS_CONFIG)}
+    bridge = Bridge(environ=environ, standby=False)
+    try:
+        cold = time_spawns(bridge, options.samples)
+    finally:
+        bridge.close()
+    
+    started = time.time()
+    zygote = Zygote()
+    zygote_boot = time.time() - started
+    try:
+        bridge = Bridge(environ=environ, standby=False, zygote=zygote)
+        try:
+            forked = time_spawns(bridge, options.samples)
+        finally:
+            bridge.close()
+    finally:
+        zygote.close()
+    
+    print(json.dumps({'samples':options.samples,
+                      'cold_start':cold,
+                      'fork_start':forked,
+                      'zygote_boot_ms':zygote_boot * 1000,}, indent=2, sort_keys=True))
+
+if __name__ == '__main__':
+    main()
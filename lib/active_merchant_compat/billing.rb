@@ -1,2 +1,3 @@
 require 'active_merchant'
+require 'active_merchant_compat/billing/connection_pool'
 require 'active_merchant_compat/billing/gateways'
@@ -0,0 +1,285 @@
+require 'net/http'
+require 'net/https'
+require 'thread'
+require 'uri'
+
+module ActiveMerchant #:nodoc:
+  module Billing #:nodoc:
+    # Keeps HTTP connections to gateway endpoints open between requests so
+    # that a checkout making several calls to the same processor pays for
+    # the TCP and TLS handshakes once.
+    #
+    # Connections are pooled per scheme, host, port and socket settings
+    # (proxy, SSL, client certificate, wiredump) and shared by every gateway
+    # in the process that agrees on them. A connection is used by one
+    # request at a time; ones left idle for longer than idle_timeout seconds
+    # are closed rather than reused, since the processor may already have
+    # dropped them.
+    #
+    # Requests are logged, retried and configured like ActiveMerchant's own
+    # Connection does, from the options KeepAlive#connection_options reads
+    # off the gateway.
+    class ConnectionPool
+      IDLE_TIMEOUT = 15
+      MAX_IDLE = 8
+      #attempts per request, as in ActiveMerchant::Connection
+      MAX_RETRIES = 3
+      #options that change the connection itself rather than a single request
+      SOCKET_OPTIONS = [:proxy_address, :proxy_port, :verify_peer, :ca_file, :ssl_version,
+                        :min_version, :max_version, :ciphers, :pem, :pem_password, :wiredump_device]
+
+      # The connection could not be opened, so nothing was sent and it is
+      # always safe to try again
+      class RefusedError < ConnectionError
+      end
+
+      @shared = nil
+      @shared_lock = Mutex.new
+
+      attr_reader :idle_timeout, :max_idle, :pid
+
+      def self.shared
+        #a forked bridge must not share its parent's sockets
+        @shared_lock.synchronize do
+          if @shared == nil || @shared.pid != Process.pid
+            @shared = new
+          end
+          return @shared
+        end
+      end
+
+      def initialize(idle_timeout=IDLE_TIMEOUT, max_idle=MAX_IDLE)
+        @idle_timeout = idle_timeout
+        @max_idle = max_idle
+        @pid = Process.pid
+        @lock = Mutex.new
+        #endpoint key => [[connection, last used], ...], most recently used last
+        @idle = {}
+      end
+
+      def post(endpoint, data, headers, options={})
+        uri = URI.parse(endpoint)
+        started = Time.now
+        attempts = 0
+        begin
+          attempts += 1
+          log(options, :info, "connection_http_method=POST connection_uri=#{endpoint}")
+          return attempt(uri, data, headers, options)
+        rescue ConnectionError => error
+          #other failures may have reached the processor, only gateways marked retry_safe try them again
+          retriable = error.is_a?(RefusedError) || options[:retry_safe]
+          if retriable && attempts < (options[:max_retries] || MAX_RETRIES)
+            log(options, :info, "connection_request_retry attempt=#{attempts} error=#{error.message}")
+            retry
+          end
+          log(options, :error, "connection_request_failed attempts=#{attempts} error=#{error.message}")
+          raise
+        ensure
+          log(options, :info, "connection_request_total_time=%.4fs" % (Time.now - started))
+        end
+      end
+
+      def warm_up(endpoint, options={})
+        #opens a connection ahead of the first request
+        uri = URI.parse(endpoint)
+        checkin(uri, checkout(uri, options), options)
+      end
+
+      def checkout(uri, options={})
+        connection = nil
+        stale = []
+        @lock.synchronize do
+          idle = @idle[key(uri, options)] || []
+          #the most recently used is last, once it is stale so are the rest
+          if !idle.empty? && Time.now - idle.last[1] <= @idle_timeout
+            connection = idle.pop[0]
+          else
+            stale = idle.map { |entry| entry[0] }
+            idle.clear
+          end
+        end
+        stale.each { |old| discard(old) }
+        if connection
+          #gateways sharing a connection may not share a read timeout
+          connection.read_timeout = options[:read_timeout] || 60
+          return connection
+        end
+        return connect(uri, options)
+      end
+
+      def checkin(uri, connection, options={})
+        closing = []
+        @lock.synchronize do
+          idle = (@idle[key(uri, options)] ||= [])
+          idle << [connection, Time.now]
+          while idle.size > @max_idle || Time.now - idle.first[1] > @idle_timeout
+            closing << idle.shift[0]
+          end
+        end
+        closing.each { |old| discard(old) }
+      end
+
+      def size(endpoint, options={})
+        @lock.synchronize { (@idle[key(URI.parse(endpoint), options)] || []).size }
+      end
+
+      def clear
+        connections = @lock.synchronize do
+          closing = @idle.values.flatten(1).map { |entry| entry[0] }
+          @idle = {}
+          closing
+        end
+        connections.each { |connection| discard(connection) }
+      end
+
+      private
+
+      def key(uri, options)
+        [uri.scheme, uri.host, uri.port] + options.values_at(*SOCKET_OPTIONS)
+      end
+
+      def attempt(uri, data, headers, options)
+        connection = checkout(uri, options)
+        started = Time.now
+        begin
+          request = Net::HTTP::Post.new(uri.request_uri, headers)
+          request.body = data
+          log(options, :debug, data)
+          response = connection.request(request)
+        rescue Timeout::Error, Errno::ETIMEDOUT
+          discard(connection)
+          raise ConnectionError, "The connection to the remote server timed out"
+        rescue Errno::ECONNREFUSED
+          discard(connection)
+          raise ConnectionError, "The remote server refused the connection"
+        rescue EOFError, Errno::ECONNRESET, Errno::EPIPE, IOError
+          #the processor may have acted on the request
+          discard(connection)
+          raise ConnectionError, "The remote server reset the connection"
+        rescue OpenSSL::SSL::SSLError
+          discard(connection)
+          raise ConnectionError, "The SSL connection to the remote server could not be established"
+        rescue Exception
+          discard(connection)
+          raise
+        end
+        log(options, :info, "--> %d %s (%d %.4fs)" % [response.code.to_i, response.message, response.body ? response.body.length : 0, Time.now - started])
+        log(options, :debug, response.body)
+        if response['Connection'].to_s.downcase == 'close'
+          discard(connection)
+        else
+          checkin(uri, connection, options)
+        end
+        return response
+      end
+
+      def connect(uri, options)
+        connection = Net::HTTP.new(uri.host, uri.port, options[:proxy_address], options[:proxy_port])
+        connection.set_debug_output(options[:wiredump_device]) if options[:wiredump_device]
+        connection.open_timeout = options[:open_timeout] || 60
+        connection.read_timeout = options[:read_timeout] || 60
+        #net/http reconnects by itself once a connection sat idle this long
+        connection.keep_alive_timeout = @idle_timeout if connection.respond_to?(:keep_alive_timeout=)
+        configure_ssl(connection, options) if uri.scheme == 'https'
+        begin
+          connection.start
+        rescue Timeout::Error, Errno::ETIMEDOUT
+          raise ConnectionError, "The connection to the remote server timed out"
+        rescue Errno::ECONNREFUSED
+          raise RefusedError, "The remote server refused the connection"
+        rescue EOFError, Errno::ECONNRESET, Errno::EPIPE, IOError
+          raise ConnectionError, "The remote server reset the connection"
+        rescue OpenSSL::SSL::SSLError
+          raise ConnectionError, "The SSL connection to the remote server could not be established"
+        end
+        return connection
+      end
+
+      def configure_ssl(connection, options)
+        connection.use_ssl = true
+        connection.ssl_version = options[:ssl_version] if options[:ssl_version]
+        [:min_version, :max_version, :ciphers].each do |name|
+          if options[name] && connection.respond_to?("#{name}=")
+            connection.send("#{name}=", options[name])
+          end
+        end
+        if options.fetch(:verify_peer, true)
+          connection.verify_mode = OpenSSL::SSL::VERIFY_PEER
+          connection.ca_file = options[:ca_file] if options[:ca_file]
+        else
+          connection.verify_mode = OpenSSL::SSL::VERIFY_NONE
+        end
+        if options[:pem]
+          #client certificate, for processors that authenticate with one
+          connection.cert = OpenSSL::X509::Certificate.new(options[:pem])
+          if options[:pem_password]
+            connection.key = OpenSSL::PKey::RSA.new(options[:pem], options[:pem_password])
+          else
+            connection.key = OpenSSL::PKey::RSA.new(options[:pem])
+          end
+        end
+      end
+
+      def log(options, level, message)
+        logger = options[:logger]
+        return unless logger
+        message = "[#{options[:tag]}] #{message}" if options[:tag]
+        logger.send(level, message)
+      end
+
+      def discard(connection)
+        begin
+          connection.finish if connection.started?
+        rescue IOError, SystemCallError, OpenSSL::SSL::SSLError
+          #already gone
+        end
+      end
+    end
+
+    # Sends a gateway's ssl_post calls through ConnectionPool.shared.
+    # Gateways list the urls they post to in keep_alive_endpoints so the
+    # bridge can open connections to them as soon as they are configured.
+    module KeepAlive
+      #gateway settings PostsData hands to every ActiveMerchant::Connection
+      CONNECTION_SETTINGS = [:open_timeout, :read_timeout, :retry_safe, :max_retries, :ssl_version,
+                             :min_version, :max_version, :ciphers, :logger, :wiredump_device,
+                             :proxy_address, :proxy_port]
+
+      def ssl_post(endpoint, data, headers = {})
+        options = connection_options
+        if options[:logger] && !options[:verify_peer]
+          options[:logger].warn "#{self.class} using ssl_strict=false, which is insecure"
+        end
+        response = ConnectionPool.shared.post(endpoint, data, headers, options)
+        return response.body if options[:ignore_http_status]
+        handle_response(response)
+      end
+
+      def warm_up
+        keep_alive_endpoints.each do |endpoint|
+          ConnectionPool.shared.warm_up(endpoint, connection_options)
+        end
+      end
+
+      def keep_alive_endpoints
+        []
+      end
+
+      def connection_options
+        klass = self.class
+        options = {:tag => klass.name, :verify_peer => true}
+        CONNECTION_SETTINGS.each do |name|
+          options[name] = klass.send(name) if klass.respond_to?(name)
+        end
+        options[:verify_peer] = klass.ssl_strict if klass.respond_to?(:ssl_strict)
+        options[:ca_file] = ActiveMerchant::Connection::CA_FILE if defined?(ActiveMerchant::Connection::CA_FILE)
+        if @options
+          options[:pem] = @options[:pem]
+          options[:pem_password] = @options[:pem_password]
+          options[:ignore_http_status] = @options[:ignore_http_status]
+        end
+        return options
+      end
+    end
+  end
+end
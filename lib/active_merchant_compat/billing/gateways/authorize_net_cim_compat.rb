@@ -27,6 +27,8 @@ module ActiveMerchant #:nodoc:
     # 4. Type in the answer to the secret question configured on setup
     # 5. Click Submit
     class AuthorizeNetCimCompatGateway < AuthorizeNetCimGateway
+      include KeepAlive
+      
       def merge_authorization_strings(old_auth, new_auth)
         trans_id, profile_id, payment_profile_id, shipping_address_id = split_authorization(old_auth)
         new_trans_id, new_profile_id, new_payment_profile_id, new_shipping_address_id = split_authorization(new_auth)
@@ -50,8 +52,52 @@ module ActiveMerchant #:nodoc:
       end
       
       def store(creditcard, options = {})
+        if options[:customer_profile_id] or @options[:single_call_store] == false
+          return store_in_steps(creditcard, options)
+        end
+        #a new profile is created together with its payment and shipping
+        #profiles in one request, instead of one request for each
+        requires!(options, :address)
+        options[:profile] = {
+          :email => options[:address][:email],
+          :payment_profiles => {
+            :payment => {
+              :credit_card => creditcard
+            }
+          }
+        }
+        if options[:ship_address]
+          options[:profile][:ship_to_list] = options[:ship_address]
+        end
+        response = create_customer_profile(options)
+        if not response.success?()
+          return response
+        end
+        _, profile_id, _, _ = split_authorization(response.authorization)
+        payment_profile_id = first_profile_id(response.params['customer_payment_profile_id_list'])
+        if payment_profile_id == nil
+          #the profile was created without the card, add it the old way
+          options[:customer_profile_id] = profile_id
+          return store_in_steps(creditcard, options)
+        end
+        ship_address_id = first_profile_id(response.params['customer_shipping_address_id_list'])
+        authorization = authorization_string("", profile_id, payment_profile_id, ship_address_id)
+        response.instance_variable_set(:@authorization, authorization)
+        return response
+      end
+      
+      def first_profile_id(id_list)
+        #a list of one id parses to a string, longer ones to an array
+        return nil if id_list == nil
+        return Array(id_list['numeric_string']).first
+      end
+      
+      def store_in_steps(creditcard, options = {})
+        #adds the card, and shipping address, to an existing profile; also used
+        #for new profiles when the single_call_store param is false
         #TODO check that the responses are successful, if not delete other profiles
-        if not options[:customer_profile_id]
+        profile_id = options[:customer_profile_id]
+        if not profile_id
           requires!(options, :address)
           options[:profile] = {
             :email => options[:address][:email]
@@ -168,9 +214,17 @@ module ActiveMerchant #:nodoc:
         authorization.split(';')
       end
 
+      def endpoint_url
+        #the url option points the gateway somewhere else, such as benchmarks/gateway_simulator.py
+        @options[:url] || (test? ? test_url : live_url)
+      end
+      
+      def keep_alive_endpoints
+        [endpoint_url]
+      end
+
       def commit(action, request)
-        url = test? ? test_url : live_url
-        xml = ssl_post(url, request, "Content-Type" => "text/xml")
+        xml = ssl_post(endpoint_url, request, "Content-Type" => "text/xml")
 
         response_params = parse(action, xml)
 
@@ -1,14 +1,203 @@
 require "rubygems"
 require "active_merchant"
 require 'active_merchant_compat/billing'
+require "digest"
 require "json"
 require "stringio"
+require "thread"
+require "optparse"
+require "socket"
+begin
+  require "msgpack"
+rescue LoadError
+  #length prefixed msgpack framing is optional, JSON lines always work
+end
+
+#stands in for $stdout so whatever gateways print can't get into the protocol
+#stream; keeps only the last limit bytes and copies every write to forward
+class RingBufferIO < StringIO
+    def initialize(limit, forward=nil)
+      super()
+      @limit = limit
+      @forward = forward
+      @lock = Mutex.new
+    end
+    
+    def write(*strings)
+      data = strings.join
+      @lock.synchronize do
+        if @forward
+          begin
+            @forward.write(data)
+            @forward.flush
+          rescue IOError, SystemCallError
+            #nobody is reading diagnostics anymore
+            @forward = nil
+          end
+        end
+        super(data)
+        if string.bytesize > @limit
+          self.string = string.byteslice(-@limit, @limit)
+          seek(0, IO::SEEK_END)
+        end
+      end
+      return data.bytesize
+    end
+end
+
+#one end of a conversation with a python bridge client
+class BridgeChannel
+    def initialize(input, output)
+      @input = input
+      @output = output
+      @input.binmode
+      @output.binmode
+      @framing = 'json'
+      @send_lock = Mutex.new
+    end
+    
+    def self.framings()
+      defined?(MessagePack) ? ['msgpack', 'json'] : ['json']
+    end
+    
+    def receive_data()
+      while payload = read_frame()
+        if payload['type'] == 'framing'
+          negotiate_framing(payload)
+        else
+          return payload
+        end
+      end
+      return nil
+    end
+    
+    def negotiate_framing(payload)
+      framing = (payload['framings'] & BridgeChannel.framings).first || 'json'
+      #the answer still goes out in the old framing
+      send_data({'type' => 'framing', 'framing' => framing, 'request_id' => payload['request_id']})
+      @framing = framing
+    end
+    
+    def read_frame()
+      if @framing == 'msgpack'
+        header = @input.read(4)
+        if header == nil or header.bytesize < 4
+          return nil
+        end
+        body = @input.read(header.unpack('N').first)
+        if body == nil
+          return nil
+        end
+        return MessagePack.unpack(body)
+      end
+      input = @input.gets()
+      if input == nil
+        return nil
+      end
+      return JSON.parse(input)
+    end
+    
+    def send_data(data)
+      @send_lock.synchronize do
+        if @framing == 'msgpack'
+          begin
+            body = MessagePack.pack(data)
+          rescue NoMethodError
+            #not a plain value, pack what JSON would have sent
+            body = MessagePack.pack(JSON.parse(JSON.dump(data)))
+          end
+          @output.write([body.bytesize].pack('N'))
+          @output.write(body)
+        else
+          @output.puts(JSON.dump(data))
+        end
+        @output.flush
+      end
+    end
+end
+
+#the response fields a caller asked for in secure_data['fields']; a name
+#ending in * matches every field with that prefix, like bill_*
+class ResponseFields
+    #returned whatever the caller asks for; test tells a gateway response
+    #apart from an exception, see BridgeMetrics.request_finished
+    ALWAYS = ['success', 'message', 'test']
+    
+    def initialize(fields)
+      @all = fields == nil
+      @names = {}
+      @prefixes = []
+      (fields || []).each do |field|
+        if field.end_with?('*')
+          @prefixes << field.chomp('*')
+        else
+          @names[field] = true
+        end
+      end
+      ALWAYS.each { |field| @names[field] = true }
+    end
+    
+    def include?(field)
+      return (@all or @names.has_key?(field) or @prefixes.any? { |prefix| field.start_with?(prefix) })
+    end
+    
+    #whether any field starting with prefix was asked for, so a whole group
+    #can be skipped without building it
+    def include_prefix?(prefix)
+      return (@all or @names.keys.any? { |field| field.start_with?(prefix) } or
+              @prefixes.any? { |field| field.start_with?(prefix) or prefix.start_with?(field) })
+    end
+end
 
 class PaymentBridge
     #include ActiveMerchant::Billing::Gateway::RequiresParameters
     
-    def initialize()
-      #do nothing
+    #bytes of captured gateway output kept in memory
+    CAPTURE_LIMIT = 64 * 1024
+    #gateways built from per-request credentials kept at once, see get_merchant_gateway
+    GATEWAY_CACHE_SIZE = 1000
+    
+    #the names gateways give their parameters, mapped to the value we pass for them
+    CARD_ARGUMENTS = {
+      :money=>:money,
+      :credit_card=>:credit_card,
+      :creditcard=>:credit_card,
+      :credit_card_or_reference=>:credit_card,
+      :creditcard_or_reference=>:credit_card,
+      :creditcard_or_card_id=>:credit_card,
+      :creditcard_or_billing_id=>:credit_card,
+      :authorization_or_credit_card=>:credit_card,
+      :credit_card_or_vault_id=>:credit_card,
+      :creditcard_or_stored_id=>:credit_card,
+      :source=>:credit_card,
+      :payment_object=>:credit_card,
+      :payment_source=>:credit_card,
+      :payment_method=>:credit_card,
+      :card_or_auth=>:credit_card,
+      :options=>:options
+    }
+    
+    REFERENCE_ARGUMENTS = {
+      :money=>:money,
+      :authorization=>:authorization,
+      :identification=>:authorization,
+      :reference=>:authorization,
+      :options=>:options
+    }
+    
+    BOUND_ACTIONS = {
+      'authorize' => CARD_ARGUMENTS,
+      'capture' => REFERENCE_ARGUMENTS,
+      'purchase' => CARD_ARGUMENTS,
+      'void' => REFERENCE_ARGUMENTS,
+      'refund' => REFERENCE_ARGUMENTS.merge(:txn_id=>:authorization)
+    }
+    
+    def initialize(gateway_cache_size=GATEWAY_CACHE_SIZE)
+      #gateways built from credentials sent with requests, least recently used first
+      @gateway_cache = {}
+      @gateway_cache_size = gateway_cache_size
+      @gateway_cache_lock = Mutex.new
     end
     
     def configure_from_environ()
@@ -22,20 +211,114 @@ class PaymentBridge
     end
     
     def configure(config)
+      @gateway_lock = Mutex.new
+      #gateway name => config, and the gateways built from them so far
+      @gateway_configs = {}
       @gateways = {}
-      for gateway_config in config
+      @supported_actions = {}
+      @binders = {}
+      update_gateways(config, [])
+    end
+    
+    def update_gateways(add, remove)
+      #gateways are only built on first use, see get_gateway; replaced ones
+      #are rebuilt while requests already running keep the old instance
+      @gateway_lock.synchronize do
+        for name in remove
+          @gateway_configs.delete(name)
+          @gateways.delete(name)
+        end
+        for gateway_config in add
+          @gateway_configs[gateway_config['name']] = gateway_config
+          @gateways.delete(gateway_config['name'])
+        end
+      end
+      warm_up_gateways(add)
+    end
+    
+    def warm_up_gateways(gateway_configs)
+      #gateways that keep connections alive open them in the background, so
+      #the first checkout skips the handshakes without delaying the bridge
+      gateway_configs = gateway_configs.select do |gateway_config|
         klass = get_gateway_class(gateway_config['module'])
-        if klass == nil
-          @gateways[gateway_config['name']] = klass
-        else
-          #convert string params into symbol params
-          params = gateway_config['params']
-          params = params.inject({}){|memo,(k,v)| memo[k.to_sym] = v; memo}
-          @gateways[gateway_config['name']] = klass.new(params)
+        klass != nil && klass.method_defined?(:warm_up)
+      end
+      return nil if gateway_configs.empty?
+      Thread.new do
+        for gateway_config in gateway_configs
+          begin
+            gateway = get_gateway(gateway_config['name'])
+            gateway.warm_up if gateway != nil
+          rescue StandardError => error
+            STDERR.puts("Could not warm up #{gateway_config['name']}: #{error}")
+          end
+        end
+      end
+    end
+    
+    def get_gateway(name)
+      @gateway_lock.synchronize do
+        if !@gateways.has_key?(name)
+          gateway_config = @gateway_configs[name]
+          return nil if gateway_config == nil
+          @gateways[name] = build_gateway(gateway_config)
         end
+        return @gateways[name]
       end
     end
     
+    def get_merchant_gateway(gateway_config)
+      #looks up a gateway for credentials sent with the request by their
+      #fingerprint, building it on a miss; returns the gateway and how the
+      #cache was used
+      params = (gateway_config['params'] || {}).sort
+      fingerprint = Digest::SHA256.hexdigest(JSON.generate([gateway_config['module'], params]))
+      @gateway_cache_lock.synchronize do
+        gateway = @gateway_cache.delete(fingerprint)
+        if gateway != nil
+          @gateway_cache[fingerprint] = gateway
+          return gateway, {'hit' => true, 'evicted' => 0}
+        end
+      end
+      
+      gateway = build_gateway(gateway_config)
+      if gateway == nil
+        return nil, nil
+      end
+      evicted = 0
+      @gateway_cache_lock.synchronize do
+        @gateway_cache[fingerprint] = gateway
+        while @gateway_cache.size > @gateway_cache_size
+          @gateway_cache.shift
+          evicted += 1
+        end
+      end
+      return gateway, {'hit' => false, 'evicted' => evicted}
+    end
+    
+    def build_gateway(gateway_config)
+      klass = get_gateway_class(gateway_config['module'])
+      return nil if klass == nil
+      #convert string params into symbol params
+      params = gateway_config['params'] || {}
+      params = params.inject({}){|memo,(k,v)| memo[k.to_sym] = v; memo}
+      return klass.new(params)
+    end
+    
+    def capabilities()
+      #gateway name => supported actions, sent to every client on connect;
+      #worked out from the gateway classes so nothing has to be built
+      capabilities = {}
+      gateway_configs = @gateway_lock.synchronize { @gateway_configs.values }
+      for gateway_config in gateway_configs
+        klass = get_gateway_class(gateway_config['module'])
+        if klass != nil
+          capabilities[gateway_config['name']] = get_supported_actions(klass)
+        end
+      end
+      return capabilities
+    end
+    
     def get_gateway_class(name)
       begin
         return ActiveMerchant::Billing::Base.gateway(name)
@@ -44,81 +327,290 @@ class PaymentBridge
       end
     end
     
-    def run()
+    def run(threads=1)
       setup_data_channel()
-      while payload = receive_data
-        data = payload['data']
-        secure_data = payload['secure_data'] || {}
-        action = payload['action']
-        gateway = @gateways[payload['gateway']]
-        
-        if gateway == nil
-          callback_params = {
-              'message' => "Unrecognized gateway",
-              'success' => false
-          }
-        elsif action == nil
-          callback_params = {
-              'message' => "No action",
-              'success' => false,
-              'supported_actions' => get_supported_actions(gateway)
-          }
-        elsif data == nil
-          callback_params = {
-              'message' => "No Data",
-              'success' => false
-          }
-        elsif secure_data == nil
-          callback_params = {
-              'message' => "No Secure Data",
-              'success' => false
-          }
-        else
-          expanded_response = process_direct_post(gateway, action, data, secure_data)
-          callback_params = construct_callback_params(expanded_response)
+      serve(BridgeChannel.new(STDIN, @data_out), threads)
+    end
+    
+    def self.preload_gateways()
+      #gateways are autoloaded, load them all before forking so every
+      #worker shares them instead of loading its own copy
+      for name in ActiveMerchant::Billing.constants
+        if name.to_s.end_with?('Gateway') && ActiveMerchant::Billing.autoload?(name)
+          begin
+            ActiveMerchant::Billing.const_get(name)
+          rescue StandardError, LoadError, NotImplementedError => error
+            STDERR.puts("Could not preload #{name}: #{error}")
+          end
         end
-        callback_params['gateway'] = payload['gateway']
-        callback_params['action'] = action
-        callback_params['request_id'] = payload['request_id']
-        
-        send_data(callback_params)
       end
     end
     
-    def setup_data_channel()
-      sio = StringIO.new
-      @data_out, $stdout = $stdout, sio
+    def self.zygote(path)
+      #forks a ready bridge for every client connecting to the unix socket at
+      #path; the client first sends a line with the bridge's command line
+      #options and environment, then talks to the bridge as if over its pipes
+      preload_gateways()
+      if File.socket?(path)
+        File.unlink(path)
+      end
+      server = UNIXServer.new(path)
+      at_exit { File.unlink(path) if File.socket?(path) }
+      STDOUT.write(JSON.generate({'type' => 'ready'}) + "\n")
+      STDOUT.flush
+      loop do
+        client = server.accept
+        line = client.gets
+        if line == nil
+          client.close
+          next
+        end
+        request = JSON.parse(line)
+        pid = fork do
+          begin
+            server.close
+            options = parse_options(request['argv'] || [])
+            if request['environ'] != nil
+              ENV.replace(request['environ'])
+            end
+            client.write(JSON.generate({'type' => 'forked', 'pid' => Process.pid}) + "\n")
+            client.flush
+            bridge = PaymentBridge.new(options[:gateway_cache])
+            bridge.configure_from_environ()
+            bridge.setup_data_channel()
+            bridge.serve(BridgeChannel.new(client, client), options[:threads])
+          rescue IOError, SystemCallError
+            #client went away
+          ensure
+            #skip at_exit, the socket belongs to the zygote
+            exit!(0)
+          end
+        end
+        client.close
+        Process.detach(pid)
+      end
     end
     
-    def receive_data()
-      input = STDIN.gets()
-      if input == nil
-        return nil
+    def listen(path, threads=1)
+      #daemon mode: serve every client connecting to the unix socket at path,
+      #each connection gets its own channel and set of threads
+      setup_data_channel()
+      if File.socket?(path)
+        File.unlink(path)
+      end
+      server = UNIXServer.new(path)
+      at_exit { File.unlink(path) if File.socket?(path) }
+      loop do
+        connection = server.accept
+        Thread.new(connection) do |client|
+          begin
+            serve(BridgeChannel.new(client, client), threads)
+          rescue IOError, SystemCallError
+            #client went away
+          ensure
+            client.close unless client.closed?
+          end
+        end
       end
-      return JSON.parse(input)
     end
     
-    def send_data(data)
-      @data_out.puts(JSON.dump(data))
-      @data_out.flush
+    def serve(channel, threads=1)
+      channel.send_data({'type' => 'capabilities', 'capabilities' => capabilities(), 'request_id' => nil})
+      if threads > 1
+        serve_threaded(channel, threads)
+      else
+        while payload = channel.receive_data
+          #a malformed request must not take the bridge down with it
+          channel.send_data(handle_request_safely(payload))
+        end
+      end
     end
     
-    def construct_callback_params(expanded_response)
-        response_params = expanded_response.fetch(:passthrough, {})
+    def serve_threaded(channel, threads)
+      #requests are worked on concurrently and answered as they finish,
+      #the caller matches responses up by request_id
+      queue = SizedQueue.new(threads)
+      workers = (1..threads).map do
+        Thread.new do
+          while payload = queue.pop
+            channel.send_data(handle_request_safely(payload))
+          end
+        end
+      end
+      while payload = channel.receive_data
+        queue.push(payload)
+      end
+      threads.times { queue.push(nil) }
+      workers.each { |worker| worker.join }
+    end
+    
+    def handle_request_safely(payload)
+      begin
+        return handle_request(payload)
+      rescue StandardError => error
+        return {
+          'message' => error.to_s,
+          'success' => false,
+          'gateway' => payload['gateway'],
+          'action' => payload['action'],
+          'request_id' => payload['request_id']
+        }
+      end
+    end
+    
+    def handle_configure(payload)
+      #adds, replaces or removes gateways without restarting the bridge
+      update_gateways(payload['add'] || [], payload['remove'] || [])
+      return {
+        'type' => 'configure',
+        'capabilities' => capabilities(),
+        'request_id' => payload['request_id']
+      }
+    end
+    
+    def handle_batch(payload)
+      #runs every item, at most concurrency at a time, and answers them all
+      #at once in the order they were given
+      items = payload['items'] || []
+      concurrency = [[Integer(payload['concurrency'] || 1), 1].max, items.size].min
+      results = Array.new(items.size)
+      lock = Mutex.new
+      position = -1
+      workers = (1..concurrency).map do
+        Thread.new do
+          loop do
+            index = lock.synchronize { position += 1 }
+            break if index >= items.size
+            results[index] = handle_request_safely(items[index])
+          end
+        end
+      end
+      workers.each { |worker| worker.join }
+      return {
+        'type' => 'batch',
+        'results' => results,
+        'request_id' => payload['request_id']
+      }
+    end
+    
+    def trace_request(payload)
+      #times the phases of one request, see timed
+      timing = Thread.current[:bridge_timing] = {}
+      started = Time.now
+      begin
+        callback_params = handle_request(payload.merge('trace' => false))
+      ensure
+        Thread.current[:bridge_timing] = nil
+      end
+      timing['total'] = Time.now - started
+      callback_params['timing'] = timing
+      return callback_params
+    end
+    
+    def timed(phase)
+      #adds the seconds spent in the block to the current trace, if any
+      timing = Thread.current[:bridge_timing]
+      if timing == nil
+        return yield
+      end
+      started = Time.now
+      begin
+        return yield
+      ensure
+        timing[phase] = (timing[phase] || 0) + (Time.now - started)
+      end
+    end
+    
+    def handle_request(payload)
+      if payload['type'] == 'batch'
+        return handle_batch(payload)
+      end
+      if payload['type'] == 'configure'
+        return handle_configure(payload)
+      end
+      if payload['trace']
+        return trace_request(payload)
+      end
+      data = payload['data']
+      secure_data = payload['secure_data'] || {}
+      action = payload['action']
+      gateway_error = nil
+      gateway_cache = nil
+      begin
+        if payload['gateway_config'] != nil
+          gateway, gateway_cache = get_merchant_gateway(payload['gateway_config'])
+        else
+          gateway = get_gateway(payload['gateway'])
+        end
+      rescue ArgumentError => error
+        #missing or bad params only show up once the gateway is built
+        gateway, gateway_error = nil, error
+      end
+      
+      if gateway_error != nil
+        callback_params = {
+            'message' => "Invalid gateway configuration: #{gateway_error}",
+            'success' => false
+        }
+      elsif gateway == nil
+        callback_params = {
+            'message' => "Unrecognized gateway",
+            'success' => false
+        }
+      elsif action == nil
+        callback_params = {
+            'message' => "No action",
+            'success' => false,
+            'supported_actions' => get_supported_actions(gateway.class)
+        }
+      elsif data == nil
+        callback_params = {
+            'message' => "No Data",
+            'success' => false
+        }
+      elsif secure_data == nil
+        callback_params = {
+            'message' => "No Secure Data",
+            'success' => false
+        }
+      else
+        expanded_response = process_direct_post(gateway, action, data, secure_data)
+        fields = ResponseFields.new(secure_data['fields'])
+        callback_params = timed('callback') { construct_callback_params(expanded_response, fields) }
+      end
+      callback_params['gateway'] = payload['gateway']
+      callback_params['action'] = action
+      callback_params['request_id'] = payload['request_id']
+      if gateway_cache != nil
+        callback_params['gateway_cache'] = gateway_cache
+      end
+      return callback_params
+    end
+    
+    def setup_data_channel()
+      #the protocol keeps the real stdout, gateway output goes to the
+      #diagnostics stream on stderr
+      @data_out, $stdout = $stdout, RingBufferIO.new(CAPTURE_LIMIT, STDERR)
+    end
+
+    
+    def construct_callback_params(expanded_response, fields=ResponseFields.new(nil))
+        #passthrough fields were asked for already, every other field is
+        #only computed if the caller asked for it
+        response_params = expanded_response.fetch(:passthrough, {}).dup
         
-        response_params['session_data'] = expanded_response[:session_data]
+        add_field(response_params, fields, 'session_data') { expanded_response[:session_data] }
         
         response = expanded_response[:response]
         if response != nil
-          response_params = response_params.merge({
-            'success' => response.success?(),
-            'test' => response.test?(),
-            'fraud_review' => response.fraud_review?(),
-            'message' => response.message,
-            'authorization' => response.authorization #this may also be your card store id
-            #'avs' => response.avs_result,
-            #'cvv' => response.cvv_result,
-          })
+          response_params['success'] = response.success?()
+          response_params['test'] = response.test?()
+          response_params['message'] = response.message
+          add_field(response_params, fields, 'fraud_review') { response.fraud_review?() }
+          #this may also be your card store id
+          add_field(response_params, fields, 'authorization') { response.authorization }
+          #'avs' => response.avs_result,
+          #'cvv' => response.cvv_result,
         else
           response_params['success'] = false
         end
@@ -126,43 +618,52 @@ class PaymentBridge
         if expanded_response[:message] != nil
           response_params['message'] = expanded_response[:message]
         elsif expanded_response[:exception] != nil
-          response_params['message'] = expanded_response[:exception]
+          response_params['message'] = expanded_response[:exception].to_s
         end
         
-        if expanded_response[:bill_address] != nil
-          add_address_with_prefix(response_params, expanded_response[:bill_address], 'bill')
+        if expanded_response[:bill_address] != nil and fields.include_prefix?('bill_')
+          add_address_with_prefix(response_params, expanded_response[:bill_address], 'bill', fields)
         end
         
-        if expanded_response[:ship_address] != nil
-          add_address_with_prefix(response_params, expanded_response[:ship_address], 'ship')
+        if expanded_response[:ship_address] != nil and fields.include_prefix?('ship_')
+          add_address_with_prefix(response_params, expanded_response[:ship_address], 'ship', fields)
         end
         
         if expanded_response[:credit_card] != nil
             credit_card = expanded_response[:credit_card]
             if credit_card.is_a?(String)
-              response_params['referenced_authorization'] = credit_card
-            else
-              response_params['cc_display'] = credit_card.display_number
-              response_params['cc_exp_month'] = credit_card.month
-              response_params['cc_exp_year'] = credit_card.year
-              response_params['cc_type'] = credit_card.brand
+              add_field(response_params, fields, 'referenced_authorization') { credit_card }
+            elsif fields.include_prefix?('cc_')
+              add_field(response_params, fields, 'cc_display') { credit_card.display_number }
+              add_field(response_params, fields, 'cc_exp_month') { credit_card.month }
+              add_field(response_params, fields, 'cc_exp_year') { credit_card.year }
+              add_field(response_params, fields, 'cc_type') { credit_card.brand }
             end
         end
         
         if expanded_response[:money] != nil
-            response_params['money'] = expanded_response[:money]
+            add_field(response_params, fields, 'money') { expanded_response[:money] }
         end
         
         if expanded_response[:currency_code] != nil
-            response_params['currency_code'] = expanded_response[:currency_code]
+            add_field(response_params, fields, 'currency_code') { expanded_response[:currency_code] }
         end
         
         return response_params
     end
     
-    def add_address_with_prefix(response, address, prefix)
+    def add_field(response_params, fields, name)
+      if fields.include?(name)
+        response_params[name] = yield
+      end
+    end
+    
+    def add_address_with_prefix(response, address, prefix, fields=ResponseFields.new(nil))
       address.each do |key, value|
-        response[prefix+"_"+key.to_s] = value
+        name = prefix+"_"+key.to_s
+        if fields.include?(name)
+          response[name] = value
+        end
       end
     end
     
@@ -186,7 +687,7 @@ class PaymentBridge
     
     def process_direct_post(gateway, action, data, secure_data)
         #should return dict containing: response, credit_card, passthrough, money, currency_code
-        if get_supported_actions(gateway).index(action) == nil
+        if get_supported_actions(gateway.class).index(action) == nil
           return invalid_action(gateway, action, data, secure_data)
         end
         
@@ -251,6 +752,10 @@ class PaymentBridge
     end
     
     def build_options(data, secure_data)
+      return timed('prepare') { prepare_options(data, secure_data) }
+    end
+    
+    def prepare_options(data, secure_data)
       options = secure_data.fetch('options', {})
       options = secure_data.inject({}){|memo,(k,v)| memo[k.to_sym] = v; memo}
       #currency_code = secure_data['currency_code']
@@ -268,6 +773,10 @@ class PaymentBridge
     end
     
     def build_credit_card(data)
+      return timed('prepare') { prepare_credit_card(data) }
+    end
+    
+    def prepare_credit_card(data)
       requires!(data, 'cc_number', 'cc_exp_month', 'cc_exp_year', 'bill_first_name', 'bill_last_name', 'cc_ccv')
       return ActiveMerchant::Billing::CreditCard.new(
         :number => data['cc_number'].gsub(/\s+/, ""), #remove all white spaces
@@ -279,10 +788,14 @@ class PaymentBridge
       )
     end
     
-    def get_supported_actions(gateway)
+    def get_supported_actions(klass)
+      return @supported_actions[klass] ||= find_supported_actions(klass)
+    end
+    
+    def find_supported_actions(klass)
       actions_seen = []
       for action in ["authorize", "capture", "purchase", "void", "refund", "store", "retrieve", "update", "unstore"]
-        if gateway.respond_to?(action)
+        if klass.public_method_defined?(action)
           actions_seen.push(action)
         end
       end
@@ -291,18 +804,26 @@ class PaymentBridge
     
     def invalid_action(gateway, action, data, secure_data)
       response = build_expanded_response(data, secure_data)
-      response['message'] = "Unrecognized Action"
+      response[:message] = "Unrecognized Action"
       return response
     end
     
-    def get_method_params(method, params)
-      in_params = []
-      
-      for required, symbol in method.parameters
-        in_params.push(params[symbol])
+    def compile_binders(klass)
+      #reflect on each action's signature once per gateway class, the binders
+      #reuse it for every request
+      binders = {}
+      BOUND_ACTIONS.each do |action, arguments|
+        if klass.public_method_defined?(action)
+          roles = klass.instance_method(action).parameters.map { |kind, name| arguments[name] }
+          binders[action] = lambda { |values| roles.map { |role| values[role] } }
+        end
       end
-      
-      return in_params
+      return binders
+    end
+    
+    def bind_arguments(gateway, action, values)
+      binders = @binders[gateway.class] ||= compile_binders(gateway.class)
+      return binders[action].call(values)
     end
     
     def authorize(gateway, data, secure_data)
@@ -316,28 +837,10 @@ class PaymentBridge
       end
       options = build_options(data, secure_data)
       
-      master_params = {
-        :money=>money,
-        :credit_card=>credit_card,
-        :creditcard=>credit_card,
-        :credit_card_or_reference=>credit_card,
-        :creditcard_or_reference=>credit_card,
-        :creditcard_or_card_id=>credit_card,
-        :creditcard_or_billing_id=>credit_card,
-        :authorization_or_credit_card=>credit_card,
-        :credit_card_or_vault_id=>credit_card,
-        :creditcard_or_stored_id=>credit_card,
-        :source=>credit_card,
-        :payment_object=>credit_card,
-        :payment_source=>credit_card,
-        :payment_method=>credit_card,
-        :card_or_auth=>credit_card,
-        :options=>options
-      }
-      in_params = get_method_params(gateway.method(:authorize), master_params)
+      in_params = bind_arguments(gateway, 'authorize', {:money=>money, :credit_card=>credit_card, :options=>options})
       
       begin
-        response = gateway.authorize(*in_params)
+        response = timed('gateway') { gateway.authorize(*in_params) }
       rescue ActiveMerchant::Billing::Error => error
         return build_expanded_response(data, secure_data, :options=>options, :credit_card=>credit_card, :money=>money, :exception=>error)
       rescue ActiveMerchant::ResponseError => error
@@ -352,17 +855,10 @@ class PaymentBridge
       authorization = secure_data['authorization']
       options = build_options(data, secure_data)
       
-      master_params = {
-        :money=>money,
-        :authorization=>authorization,
-        :identification=>authorization,
-        :reference=>authorization,
-        :options=>options
-      }
-      in_params = get_method_params(gateway.method(:capture), master_params)
+      in_params = bind_arguments(gateway, 'capture', {:money=>money, :authorization=>authorization, :options=>options})
       
       begin
-        response = gateway.capture(*in_params)
+        response = timed('gateway') { gateway.capture(*in_params) }
       rescue ActiveMerchant::Billing::Error => error
         return build_expanded_response(data, secure_data, :options=>options, :money=>money, :exception=>error)
       rescue ActiveMerchant::ResponseError => error
@@ -382,28 +878,10 @@ class PaymentBridge
       end
       options = build_options(data, secure_data)
       
-      master_params = {
-        :money=>money,
-        :credit_card=>credit_card,
-        :creditcard=>credit_card,
-        :credit_card_or_reference=>credit_card,
-        :creditcard_or_reference=>credit_card,
-        :creditcard_or_card_id=>credit_card,
-        :creditcard_or_billing_id=>credit_card,
-        :authorization_or_credit_card=>credit_card,
-        :credit_card_or_vault_id=>credit_card,
-        :creditcard_or_stored_id=>credit_card,
-        :source=>credit_card,
-        :payment_object=>credit_card,
-        :payment_source=>credit_card,
-        :payment_method=>credit_card,
-        :card_or_auth=>credit_card,
-        :options=>options
-      }
-      in_params = get_method_params(gateway.method(:purchase), master_params)
+      in_params = bind_arguments(gateway, 'purchase', {:money=>money, :credit_card=>credit_card, :options=>options})
       
       begin
-        response = gateway.purchase(*in_params)
+        response = timed('gateway') { gateway.purchase(*in_params) }
       rescue ActiveMerchant::Billing::Error => error
         return build_expanded_response(data, secure_data, :options=>options, :credit_card=>credit_card, :money=>money, :exception=>error)
       rescue ActiveMerchant::ResponseError => error
@@ -419,17 +897,10 @@ class PaymentBridge
       money = secure_data['money'] ? Integer(secure_data['money']) : nil
       options = build_options(data, secure_data)
       
-      master_params = {
-        :money=>money,
-        :authorization=>authorization,
-        :identification=>authorization,
-        :reference=>authorization,
-        :options=>options
-      }
-      in_params = get_method_params(gateway.method(:void), master_params)
+      in_params = bind_arguments(gateway, 'void', {:money=>money, :authorization=>authorization, :options=>options})
       
       begin
-        response = gateway.void(*in_params)
+        response = timed('gateway') { gateway.void(*in_params) }
       rescue ActiveMerchant::Billing::Error => error
         return build_expanded_response(data, secure_data, :options=>options, :money=>money, :exception=>error)
       rescue ActiveMerchant::ResponseError => error
@@ -444,18 +915,10 @@ class PaymentBridge
       authorization = secure_data['authorization']
       options = build_options(data, secure_data)
       
-      master_params = {
-        :money=>money,
-        :authorization=>authorization,
-        :identification=>authorization,
-        :reference=>authorization,
-        :txn_id=>authorization,
-        :options=>options
-      }
-      in_params = get_method_params(gateway.method(:refund), master_params)
+      in_params = bind_arguments(gateway, 'refund', {:money=>money, :authorization=>authorization, :options=>options})
       
       begin
-        response = gateway.refund(*in_params)
+        response = timed('gateway') { gateway.refund(*in_params) }
       rescue ActiveMerchant::Billing::Error => error
         return build_expanded_response(data, secure_data, :options=>options, :money=>money, :exception=>error)
       rescue ActiveMerchant::ResponseError => error
@@ -469,7 +932,7 @@ class PaymentBridge
       options = build_options(data, secure_data)
       
       begin
-        response = gateway.store(credit_card, options)
+        response = timed('gateway') { gateway.store(credit_card, options) }
       rescue ActiveMerchant::Billing::Error => error
         return build_expanded_response(data, secure_data, :options=>options, :credit_card=>credit_card, :exception=>error)
       rescue ActiveMerchant::ResponseError => error
@@ -484,7 +947,7 @@ class PaymentBridge
       options = build_options(data, secure_data)
       
       begin
-        response = gateway.retrieve(authorization, options)
+        response = timed('gateway') { gateway.retrieve(authorization, options) }
       rescue ActiveMerchant::Billing::Error => error
         return build_expanded_response(data, secure_data, :options=>options, :exception=>error)
       rescue ActiveMerchant::ResponseError => error
@@ -500,7 +963,7 @@ class PaymentBridge
       options = build_options(data, secure_data)
       
       begin
-        response = gateway.update(authorization, credit_card, options)
+        response = timed('gateway') { gateway.update(authorization, credit_card, options) }
       rescue ActiveMerchant::Billing::Error => error
         return build_expanded_response(data, secure_data, :options=>options, :credit_card=>credit_card, :exception=>error)
       rescue ActiveMerchant::ResponseError => error
@@ -515,7 +978,7 @@ class PaymentBridge
       options = build_options(data, secure_data)
       
       begin
-        response = gateway.unstore(authorization, options)
+        response = timed('gateway') { gateway.unstore(authorization, options) }
       rescue ActiveMerchant::Billing::Error => error
         return build_expanded_response(data, secure_data, :options=>options, :exception=>error)
       rescue ActiveMerchant::ResponseError => error
@@ -538,7 +1001,36 @@ class PaymentBridge
     end
 end
 
-bridge = PaymentBridge.new()
-bridge.configure_from_environ()
-bridge.run()
+def parse_options(argv)
+  options = {:threads => 1, :socket => nil, :zygote => nil, :gateway_cache => PaymentBridge::GATEWAY_CACHE_SIZE}
+  OptionParser.new do |opts|
+    opts.on("--threads N", Integer, "Handle up to N requests at once, answering out of order") do |threads|
+      options[:threads] = threads
+    end
+    opts.on("--socket PATH", "Run as a daemon serving clients on a unix socket") do |path|
+      options[:socket] = path
+    end
+    opts.on("--zygote PATH", "Load everything once and fork a bridge for each client of a unix socket") do |path|
+      options[:zygote] = path
+    end
+    opts.on("--gateway-cache N", Integer, "Keep up to N gateways built from per-request credentials") do |size|
+      options[:gateway_cache] = size
+    end
+  end.parse!(argv)
+  return options
+end
 
+if __FILE__ == $0
+  options = parse_options(ARGV)
+  if options[:zygote]
+    PaymentBridge.zygote(options[:zygote])
+  end
+  
+  bridge = PaymentBridge.new(options[:gateway_cache])
+  bridge.configure_from_environ()
+  if options[:socket]
+    bridge.listen(options[:socket], options[:threads])
+  else
+    bridge.run(options[:threads])
+  end
+end
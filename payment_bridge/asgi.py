@@ -0,0 +1,354 @@
+"""
+asyncio counterparts of the bridge and the direct post application
+Requires Python 3.5 or later
+"""
+import asyncio
+import json
+import time
+from itertools import count
+
+from payment_bridge.idempotency import DuplicateRequestPending
+from payment_bridge.wsgi import (BaseDirectPostApplication, BridgeError,
+    BridgeSendTimeout, BridgeResponseTimeout, GatewayConfiguration, flatten_dictionary, logger,
+    parse_qs, remaining_time, RUBY_PATH, SCRIPT_PATH)
+
+
+class AsyncBridge(object):
+    """
+    Talks to am_bridge.rb over asyncio subprocess streams.
+    Requests are multiplexed by request_id, so every pending payment costs
+    a coroutine instead of a thread; the ruby side works through them on
+    a pool of threads.
+    """
+    #longest line we expect back from the bridge
+    read_limit = 2 ** 20
+    
+    def __init__(self, exec_path=RUBY_PATH, script_path=SCRIPT_PATH, environ=None, threads=16, gateways=None, gateway_cache_size=None):
+        self.exec_path = exec_path
+        self.script_path = script_path
+        self.environ = environ
+        self.gateway_cache_size = gateway_cache_size
+        self.configuration = GatewayConfiguration(gateways or ())
+        self.threads = threads
+        self.max_in_flight = threads
+        self.slave = None
+        #gateway name => supported actions, known once the bridge has started
+        self.capabilities = None
+        self.pending = dict()
+        #requests whose callers timed out while ruby is still working on them
+        self.abandoned = set()
+        self.request_ids = count()
+        self.lock = None
+    
+    def get_command(self):
+        command = [self.exec_path, self.script_path, '--threads', str(self.threads)]
+        if self.gateway_cache_size is not None:
+            command += ['--gateway-cache', str(self.gateway_cache_size)]
+        return command
+    
+    async def open(self):
+        self.slave = await asyncio.create_subprocess_exec(*self.get_command(),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE, env=self.environ, limit=self.read_limit)
+        self.diagnostics = asyncio.ensure_future(self.log_diagnostics(self.slave))
+        await self.read_capabilities(self.slave)
+        await self.replay_configuration(self.slave)
+        self.reader = asyncio.ensure_future(self.read_responses(self.slave))
+    
+    async def read_capabilities(self, slave):
+        params = await self.read_control_message(slave, 'capabilities')
+        self.capabilities = params['capabilities']
+    
+    async def replay_configuration(self, slave):
+        #the process was started after some configure calls
+        version, messages = self.configuration.replay_messages()
+        for message in messages:
+            slave.stdin.write(json.dumps(message).encode('utf-8') + b'\n')
+            await slave.stdin.drain()
+            params = await self.read_control_message(slave, 'configure')
+            self.capabilities = params['capabilities']
+    
+    async def read_control_message(self, slave, message_type):
+        while True:
+            out_payload = await slave.stdout.readline()
+            if not out_payload:
+                raise BridgeError('Bridge exited while starting')
+            try:
+                params = json.loads(out_payload.decode('utf-8'))
+            except ValueError:
+                logger.warning('Unparsable bridge output: %r', out_payload)
+                continue
+            if params.get('type') == message_type:
+                return params
+    
+    async def log_diagnostics(self, slave):
+        while True:
+            line = await slave.stderr.readline()
+            if not line:
+                break
+            logger.warning('bridge: %s', line.rstrip().decode('utf-8', 'replace'))
+    
+    async def ensure_open(self):
+        #the process is started lazily as it needs a running event loop
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if self.slave is None:
+                await self.open()
+    
+    async def send(self, deadline=None, **kwargs):
+        if self.slave is None:
+            try:
+                await asyncio.wait_for(self.ensure_open(), remaining_time(deadline))
+            except asyncio.TimeoutError:
+                raise BridgeSendTimeout('Timed out waiting for the bridge')
+        request_id = kwargs['request_id'] = next(self.request_ids)
+        pending = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = pending
+        try:
+            self.slave.stdin.write(json.dumps(kwargs).encode('utf-8') + b'\n')
+            await self.slave.stdin.drain()
+        except (ConnectionError, BrokenPipeError) as error:
+            self.pending.pop(request_id, None)
+            raise BridgeError('Could not write to bridge: %s' % error)
+        try:
+            return await asyncio.wait_for(pending, remaining_time(deadline))
+        except asyncio.TimeoutError:
+            self.abandon(request_id)
+            raise BridgeResponseTimeout('Timed out waiting for the bridge to respond')
+    
+    def abandon(self, request_id):
+        """
+        Stops waiting on a request. A single slow gateway call is left to
+        finish, but once every ruby thread is stuck on abandoned requests
+        the process is killed and the next send starts a new one.
+        """
+        if self.pending.pop(request_id, None) is None:
+            return
+        self.abandoned.add(request_id)
+        if len(self.abandoned) >= self.threads:
+            logger.warning('All bridge threads are stuck, restarting the bridge')
+            self.abort(self.slave)
+    
+    def abort(self, slave):
+        #read_responses notices the process is gone
+        try:
+            slave.kill()
+        except ProcessLookupError:
+            #already gone
+            pass
+    
+    async def send_many(self, items, concurrency=4, deadline=None):
+        response = await self.send(type='batch', items=list(items), concurrency=concurrency, deadline=deadline)
+        return response['results']
+    
+    async def configure(self, add=(), remove=(), deadline=None):
+        add = list(add)
+        remove = list(remove)
+        self.configuration.update(add, remove)
+        response = await self.send(type='configure', add=add, remove=remove, deadline=deadline)
+        self.capabilities = response['capabilities']
+        return self.capabilities
+    
+    async def read_responses(self, slave):
+        try:
+            while True:
+                try:
+                    out_payload = await slave.stdout.readline()
+                except (ValueError, asyncio.LimitOverrunError) as error:
+                    #a line over read_limit, the rest of the stream can't be trusted
+                    logger.error('Could not read bridge output: %s', error)
+                    self.abort(slave)
+                    break
+                if not out_payload:
+                    break
+                try:
+                    params = json.loads(out_payload.decode('utf-8'))
+                except ValueError:
+                    logger.warning('Unparsable bridge output: %r', out_payload)
+                    continue
+                pending = self.pending.pop(params.get('request_id'), None)
+                if pending is None:
+                    #a late answer to an abandoned request
+                    self.abandoned.discard(params.get('request_id'))
+                elif not pending.done():
+                    pending.set_result(params)
+        finally:
+            #the process is gone, nobody still waiting on it will get an answer
+            pending, self.pending = list(self.pending.values()), dict()
+            self.abandoned = set()
+            for waiting in pending:
+                if not waiting.done():
+                    waiting.set_exception(BridgeError('Bridge exited before responding'))
+            if self.slave is slave:
+                #start a fresh process on the next send
+                self.slave = None
+    
+    async def close(self):
+        slave, self.slave = self.slave, None
+        if slave is None:
+            return
+        slave.stdin.close()
+        await slave.wait()
+        await self.reader
+        await self.diagnostics
+
+class BaseASGIDirectPostApplication(BaseDirectPostApplication):
+    """
+    ASGI version of BaseDirectPostApplication with the same GET/JSONP and
+    POST/303 behaviour; subclasses supply the same hooks.
+    """
+    bridge_threads = 16
+    
+    def construct_zygote(self):
+        #AsyncBridge always starts its own process
+        return None
+    
+    def construct_bridge(self):
+        config = self.load_gateways_config()
+        return AsyncBridge(threads=self.bridge_threads, environ={}, gateways=config,
+                           gateway_cache_size=self.bridge_gateway_cache_size)
+    
+    async def shutdown(self):
+        await self.bridge.close()
+    
+    async def call_bridge(self, data, secure_data, gateway, action, deadline=None, trace=False, gateway_config=None):
+        kwargs = {'data':data,
+                  'secure_data':secure_data,
+                  'gateway':gateway,
+                  'action':action,
+                  'deadline':deadline,
+                  'trace':trace,}
+        if gateway_config is not None:
+            kwargs['gateway_config'] = gateway_config
+        if self.metrics is None:
+            response = await self.bridge.send(**kwargs)
+            response.pop('gateway_cache', None)
+            return response
+        self.metrics.request_started()
+        started = time.time()
+        response = None
+        try:
+            response = await self.bridge.send(**kwargs)
+        finally:
+            self.metrics.request_finished(gateway, action, time.time() - started, response)
+        gateway_cache = response.pop('gateway_cache', None)
+        if gateway_cache is not None:
+            self.metrics.observe_gateway_cache(gateway_cache['hit'], gateway_cache['evicted'])
+        return response
+    
+    async def process_direct_post(self, caller_data, trace=None):
+        bridge_kwargs, key = self.start_direct_post(caller_data, trace)
+        if key is None:
+            return await self.execute_direct_post(bridge_kwargs, trace)
+        
+        #waiting on a duplicate blocks, so keep it off the event loop
+        started = time.time()
+        loop = asyncio.get_event_loop()
+        result = await loop.run_in_executor(None, self.idempotency.begin, key, bridge_kwargs['deadline'])
+        if result is not None:
+            return self.replay_direct_post(result, started, trace)
+        try:
+            result = await self.execute_direct_post(bridge_kwargs, trace)
+        except Exception as error:
+            if getattr(error, 'sent', True) is not False:
+                #it may have reached the gateway, so duplicates must not charge again
+                result = self.build_outcome_unknown_result(bridge_kwargs)
+            raise
+        finally:
+            #the cache backend may be remote
+            await loop.run_in_executor(None, self.release_idempotency_key, key, result)
+        return result
+    
+    async def execute_direct_post(self, bridge_kwargs, trace=None):
+        response_params = self.check_direct_post(bridge_kwargs)
+        if response_params is not None:
+            return self.finish_direct_post(bridge_kwargs, response_params, trace)
+        started = time.time()
+        response_params = await self.call_bridge(**bridge_kwargs)
+        return self.finish_direct_post(bridge_kwargs, response_params, trace, started)
+    
+    async def send_response(self, send, status, content_type, response_body, extra_headers=()):
+        response_body = response_body.encode('utf-8')
+        headers = [(b'content-type', content_type.encode('latin-1')),
+                   (b'content-length', str(len(response_body)).encode('latin-1'))]
+        for name, value in extra_headers:
+            headers.append((name.lower().encode('latin-1'), value.encode('latin-1')))
+        await send({'type':'http.response.start',
+                    'status':status,
+                    'headers':headers,})
+        await send({'type':'http.response.body',
+                    'body':response_body,})
+    
+    async def render_bad_request(self, send, response_body):
+        await self.send_response(send, 405, 'text/html', response_body)
+    
+    async def render_duplicate_pending(self, send):
+        await self.send_response(send, 409, 'text/html', 'The original request is still in progress; retry shortly.',
+                                 [('Retry-After', str(self.idempotency_retry_after))])
+    
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.bridge.ensure_open()
+                await send({'type':'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type':'lifespan.shutdown.complete'})
+                return
+    
+    async def read_body(self, receive):
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+        return body
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.handle_lifespan(receive, send)
+        
+        trace = self.start_trace()
+        method = scope['method'].upper()
+        if method == 'GET':
+            #read our caller data from GET params
+            request_body = scope.get('query_string', b'').decode('latin-1')
+            caller_data = flatten_dictionary(parse_qs(request_body))
+            
+            callback = caller_data.get('callback')
+            if not callback:
+                return await self.render_bad_request(send, "Invalid JSONP request; Please provide 'callback'.")
+            
+            try:
+                params = (await self.process_direct_post(caller_data, trace))['url_params']
+            except DuplicateRequestPending:
+                return await self.render_duplicate_pending(send)
+            
+            response_body = self.render_jsonp(callback, params)
+            
+            status = 200
+            content_type = 'text/javascript'
+        elif method == 'POST':
+            # read our caller data from POST params
+            request_body = (await self.read_body(receive)).decode('utf-8')
+            caller_data = flatten_dictionary(parse_qs(request_body))
+            
+            try:
+                params = await self.process_direct_post(caller_data, trace)
+            except DuplicateRequestPending:
+                return await self.render_duplicate_pending(send)
+            
+            response_body = self.render_redirect(params)
+            
+            status = 303
+            content_type = 'text/html'
+        else:
+            return await self.render_bad_request(send, "Request method must be a POST or JSONP")
+        
+        extra_headers = []
+        if trace is not None:
+            self.finish_trace(trace, extra_headers)
+        await self.send_response(send, status, content_type, response_body, extra_headers)
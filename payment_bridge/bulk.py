@@ -0,0 +1,296 @@
+"""
+Streams a file of capture, refund and void operations through the bridge
+
+  python -m payment_bridge.bulk --config gateways.json settlements.jsonl results.jsonl
+
+Each JSONL line is an operation:
+  {"id": "order-1", "gateway": "test", "action": "capture",
+   "data": {}, "secure_data": {"money": "100", "authorization": "1234"}}
+
+CSV files need id, gateway and action columns; money and authorization
+columns go into secure_data and every other column into data.
+
+Results are appended to the output file as they complete, one JSON line per
+operation carrying its id. Before an operation is sent its id is appended to
+the checkpoint file. A rerun skips operations that already have a result and
+never resends one that was started but did not finish, since it may have
+reached the gateway; those are reported with outcome_unknown set instead.
+Operations that failed before reaching the bridge, such as on a send timeout,
+are written with retry set and sent again by the next run.
+"""
+from __future__ import print_function
+from threading import Lock, Thread
+try:
+    from Queue import Queue
+except ImportError: #python 3
+    from queue import Queue
+import csv
+import json
+import optparse
+import os
+import sys
+import time
+
+from payment_bridge.wsgi import BridgePool, MultiplexedBridge, SocketBridge
+
+
+BULK_ACTIONS = ('capture', 'refund', 'void')
+SECURE_COLUMNS = ('money', 'authorization')
+
+def read_jsonl(path):
+    infile = open(path)
+    try:
+        for line_number, line in enumerate(infile, 1):
+            if not line.strip():
+                continue
+            operation = json.loads(line)
+            operation.setdefault('id', line_number)
+            yield operation
+    finally:
+        infile.close()
+
+def read_csv(path):
+    infile = open(path)
+    try:
+        for row_number, row in enumerate(csv.DictReader(infile), 1):
+            operation = {'id':row.pop('id', None) or row_number,
+                         'gateway':row.pop('gateway', None),
+                         'action':row.pop('action', None),
+                         'secure_data':{},}
+            for column in SECURE_COLUMNS:
+                if row.get(column):
+                    operation['secure_data'][column] = row.pop(column)
+            operation['data'] = row
+            yield operation
+    finally:
+        infile.close()
+
+def read_operations(path, format=None):
+    """
+    Yields operations one at a time so the whole file is never in memory
+    """
+    if format is None:
+        format = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    if format == 'csv':
+        operations = read_csv(path)
+    else:
+        operations = read_jsonl(path)
+    for operation in operations:
+        operation['id'] = str(operation['id'])
+        yield operation
+
+def read_completed(output_path):
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    infile = open(output_path)
+    try:
+        for line in infile:
+            try:
+                result = json.loads(line)
+                if not result.get('retry'):
+                    completed.add(result['id'])
+            except (ValueError, KeyError):
+                #cut short by a crash, the operation is not complete
+                pass
+    finally:
+        infile.close()
+    return completed
+
+def read_started(checkpoint_path):
+    started = set()
+    if not os.path.exists(checkpoint_path):
+        return started
+    infile = open(checkpoint_path)
+    try:
+        for line in infile:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict):
+                #it never reached the bridge after all
+                started.discard(entry.get('unsent'))
+            else:
+                started.add(entry)
+    finally:
+        infile.close()
+    return started
+
+def end_partial_line(path):
+    #a crash can leave half a line behind, new lines must not be appended to it
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return
+    infile = open(path, 'rb')
+    try:
+        infile.seek(-1, os.SEEK_END)
+        last = infile.read(1)
+    finally:
+        infile.close()
+    if last != b'\n':
+        outfile = open(path, 'a')
+        outfile.write('\n')
+        outfile.close()
+
+class BulkRunner(object):
+    """
+    Keeps up to concurrency operations in flight on the bridge and writes
+    each result as soon as it arrives
+    """
+    def __init__(self, bridge, output_path, checkpoint_path=None, concurrency=16, timeout=None):
+        self.bridge = bridge
+        self.output_path = output_path
+        self.checkpoint_path = checkpoint_path or output_path + '.checkpoint'
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.lock = Lock()
+        self.stats = {'succeeded':0,
+                      'failed':0,
+                      'skipped':0,
+                      'interrupted':0,}
+    
+    def run(self, operations):
+        completed = read_completed(self.output_path)
+        started = read_started(self.checkpoint_path)
+        end_partial_line(self.output_path)
+        end_partial_line(self.checkpoint_path)
+        self.output = open(self.output_path, 'a')
+        self.checkpoint = open(self.checkpoint_path, 'a')
+        #a small queue keeps reading just ahead of the workers
+        queue = Queue(self.concurrency * 2)
+        workers = [Thread(target=self.work, args=(queue,)) for index in range(self.concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            for operation in operations:
+                if operation['id'] in completed:
+                    self.count('skipped')
+                elif operation['id'] in started:
+                    #it may have reached the gateway, never send it twice
+                    self.write_result(operation, {'success':False,
+                                                  'outcome_unknown':True,
+                                                  'message':'Interrupted in a previous run, check the gateway before retrying',})
+                    self.count('interrupted')
+                else:
+                    queue.put(operation)
+        finally:
+            for worker in workers:
+                queue.put(None)
+            for worker in workers:
+                worker.join()
+            self.output.close()
+            self.checkpoint.close()
+        return self.stats
+    
+    def work(self, queue):
+        while True:
+            operation = queue.get()
+            if operation is None:
+                return
+            response = self.execute(operation)
+            self.write_result(operation, response)
+            self.count('succeeded' if response.get('success') else 'failed')
+    
+    def execute(self, operation):
+        if operation.get('action') not in BULK_ACTIONS:
+            return {'success':False,
+                    'message':'Unsupported bulk action: %s' % operation.get('action'),}
+        self.record_started(operation)
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        try:
+            return self.bridge.send(data=operation.get('data') or {},
+                                    secure_data=operation.get('secure_data') or {},
+                                    gateway=operation.get('gateway'),
+                                    action=operation['action'],
+                                    deadline=deadline)
+        except Exception as error:
+            #anything else would end the worker and leave run waiting on the queue
+            if getattr(error, 'sent', True) is False:
+                #safe to send again, so a rerun should not treat it as started
+                self.record_unsent(operation)
+                return {'success':False,
+                        'message':str(error),
+                        'outcome_unknown':False,
+                        'retry':True,}
+            return {'success':False,
+                    'message':str(error),
+                    'outcome_unknown':True,}
+    
+    def record_started(self, operation):
+        self.write_checkpoint(operation['id'])
+    
+    def record_unsent(self, operation):
+        self.write_checkpoint({'unsent':operation['id']})
+    
+    def write_checkpoint(self, entry):
+        self.lock.acquire()
+        try:
+            self.checkpoint.write(json.dumps(entry) + '\n')
+            self.checkpoint.flush()
+            os.fsync(self.checkpoint.fileno())
+        finally:
+            self.lock.release()
+    
+    def write_result(self, operation, response):
+        result = dict(response)
+        result.pop('request_id', None)
+        result['id'] = operation['id']
+        result.setdefault('gateway', operation.get('gateway'))
+        result.setdefault('action', operation.get('action'))
+        self.lock.acquire()
+        try:
+            self.output.write(json.dumps(result) + '\n')
+            self.output.flush()
+        finally:
+            self.lock.release()
+    
+    def count(self, outcome):
+        self.lock.acquire()
+        try:
+            self.stats[outcome] += 1
+        finally:
+            self.lock.release()
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options] INPUT OUTPUT')
+    parser.add_option('--config', help='JSON file listing the gateways to set up, as returned by load_gateways_config')
+    parser.add_option('--socket', help='use the bridge daemon listening on this unix socket instead')
+    parser.add_option('--workers', type='int', default=2, help='bridge processes to start [%default]')
+    parser.add_option('--threads', type='int', default=16, help='operations in flight per bridge [%default]')
+    parser.add_option('--checkpoint', help='checkpoint file [OUTPUT.checkpoint]')
+    parser.add_option('--format', choices=['jsonl', 'csv'], help='input format, guessed from the extension by default')
+    parser.add_option('--timeout', type='float', help='seconds to wait on each operation')
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('INPUT and OUTPUT are required')
+    input_path, output_path = args
+    
+    if options.socket:
+        bridge = SocketBridge(options.socket, max_in_flight=options.threads)
+        concurrency = options.threads
+    else:
+        if not options.config:
+            parser.error('--config or --socket is required')
+        configfile = open(options.config)
+        try:
+            config = json.load(configfile)
+        finally:
+            configfile.close()
+        bridge = BridgePool(size=options.workers, bridge_class=MultiplexedBridge, threads=options.threads,
+                            gateways=config)
+        concurrency = options.workers * options.threads
+    
+    runner = BulkRunner(bridge, output_path, checkpoint_path=options.checkpoint,
+                        concurrency=concurrency, timeout=options.timeout)
+    try:
+        stats = runner.run(read_operations(input_path, options.format))
+    finally:
+        bridge.close()
+    print(json.dumps(stats, sort_keys=True), file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""
+Message framing for the bridge protocol
+
+Newline delimited JSON is always understood by both sides. When msgpack is
+installed on both sides, a client can ask for length prefixed MessagePack
+frames (a 4 byte big endian length followed by the packed message) right
+after connecting.
+
+The bridge opens every connection with a JSON line carrying its
+capabilities, the actions each configured gateway supports.
+"""
+import json
+import logging
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger('payment_bridge')
+
+class FramingError(ValueError):
+    def __init__(self, message, data=b''):
+        super(FramingError, self).__init__(message)
+        self.data = data
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+class JSONFraming(object):
+    name = 'json'
+    
+    def encode(self, message):
+        return json.dumps(message).encode('utf-8') + b'\n'
+    
+    def decode(self, data):
+        return json.loads(data.decode('utf-8'))
+    
+    def read(self, stream):
+        """
+        Returns the next message or None once the stream is closed
+        """
+        line = stream.readline()
+        if not line:
+            return None
+        try:
+            return self.decode(line)
+        except ValueError as error:
+            raise FramingError(str(error), line)
+
+class MessagePackFraming(object):
+    name = 'msgpack'
+    header = struct.Struct('>I')
+    
+    def encode(self, message):
+        #strings go out as msgpack str so ruby sees them as UTF-8
+        body = msgpack.packb(message, use_bin_type=False)
+        return self.header.pack(len(body)) + body
+    
+    def decode(self, data):
+        return msgpack.unpackb(data[self.header.size:], raw=False)
+    
+    def read(self, stream):
+        header = read_exactly(stream, self.header.size)
+        if header is None:
+            return None
+        size = self.header.unpack(header)[0]
+        body = read_exactly(stream, size)
+        if body is None:
+            raise FramingError('Bridge closed in the middle of a message', header)
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except Exception as error:
+            raise FramingError(str(error), header + body)
+
+JSON_FRAMING = JSONFraming()
+
+FRAMINGS = {'json': JSON_FRAMING}
+if msgpack is not None:
+    FRAMINGS['msgpack'] = MessagePackFraming()
+
+def read_control_message(stdout, message_type):
+    """
+    Reads JSON lines until a control message of the given type arrives
+    """
+    while True:
+        try:
+            message = JSON_FRAMING.read(stdout)
+        except FramingError as error:
+            #stray output while the bridge boots
+            logger.warning('Unparsable bridge output: %r', error.data)
+            continue
+        if message is None:
+            raise FramingError('Bridge exited while waiting for %s' % message_type)
+        if message.get('type') == message_type:
+            return message
+
+def read_capabilities(stdout):
+    """
+    Returns the gateway name => supported actions map the bridge sends on connect
+    """
+    return read_control_message(stdout, 'capabilities')['capabilities']
+
+def negotiate_framing(stdin, stdout, preferred):
+    """
+    Asks the bridge to switch to the preferred framing and returns the
+    framing both sides agreed on, falling back to JSON
+    """
+    if preferred not in FRAMINGS or preferred == JSON_FRAMING.name:
+        return JSON_FRAMING
+    stdin.write(JSON_FRAMING.encode({'type':'framing', 'framings':[preferred], 'request_id':None}))
+    stdin.flush()
+    reply = read_control_message(stdout, 'framing')
+    return FRAMINGS.get(reply.get('framing'), JSON_FRAMING)
@@ -0,0 +1,131 @@
+"""
+Replays the result of a direct post to duplicates of it
+
+Browsers double submit and load balancers retry POSTs. A direct post with an
+idempotency key claims the key before going to the bridge; duplicates that
+arrive while it is in flight wait for it, and later ones get its result
+straight from the cache.
+
+Results are kept in a bounded LRU for ttl seconds. Processes can share
+results through a backend with the django cache interface (add, get, set and
+delete), such as django.core.cache.cache; a process that dies mid request
+holds its keys there for pending_ttl seconds.
+"""
+from collections import OrderedDict
+from threading import Condition
+import time
+
+
+#marks a key whose request is still in flight
+PENDING = object()
+
+class DuplicateRequestPending(Exception):
+    """
+    Raised when a duplicate's deadline passes while the original is in flight
+    """
+
+class IdempotencyCache(object):
+    poll_interval = .05
+    
+    def __init__(self, max_entries=1024, ttl=600, backend=None, pending_ttl=120):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.pending_ttl = pending_ttl
+        self.condition = Condition()
+        #key => (expires, result or PENDING), oldest first
+        self.entries = OrderedDict()
+    
+    def lookup(self, key):
+        #call with the condition held
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires is not None and expires <= time.time():
+            return None
+        self.entries[key] = entry
+        return value
+    
+    def store(self, key, value):
+        #call with the condition held
+        self.entries.pop(key, None)
+        if value is PENDING:
+            self.entries[key] = (None, value)
+        else:
+            self.entries[key] = (time.time() + self.ttl, value)
+        if len(self.entries) > self.max_entries:
+            #in flight entries stay until they finish
+            for old_key, (expires, old_value) in list(self.entries.items()):
+                if old_value is not PENDING:
+                    del self.entries[old_key]
+                    if len(self.entries) <= self.max_entries:
+                        break
+    
+    def begin(self, key, deadline=None):
+        """
+        Returns the result to replay for key, or None once the caller holds
+        the key and must call finish or abandon
+        """
+        self.condition.acquire()
+        try:
+            while True:
+                value = self.lookup(key)
+                if value is None:
+                    break
+                if value is not PENDING:
+                    return value
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        raise DuplicateRequestPending('Timed out waiting for the original request')
+                self.condition.wait(timeout)
+            self.store(key, PENDING)
+        finally:
+            self.condition.release()
+        if self.backend is None:
+            return None
+        return self.begin_shared(key, deadline)
+    
+    def begin_shared(self, key, deadline):
+        while True:
+            if self.backend.add(key, {'pending':True}, self.pending_ttl):
+                return None
+            value = self.backend.get(key)
+            if value is not None and 'result' in value:
+                self.finish(key, value['result'], share=False)
+                return value['result']
+            if value is None:
+                #expired between add and get
+                continue
+            if deadline is not None and deadline <= time.time():
+                self.abandon(key, share=False)
+                raise DuplicateRequestPending('Timed out waiting for the original request')
+            time.sleep(self.poll_interval)
+    
+    def finish(self, key, result, share=True):
+        """
+        Stores the result of the request holding key and wakes its duplicates
+        """
+        self.condition.acquire()
+        try:
+            self.store(key, result)
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        if share and self.backend is not None:
+            self.backend.set(key, {'result':result}, self.ttl)
+    
+    def abandon(self, key, share=True):
+        """
+        Releases key after its request failed so a retry can go through
+        """
+        self.condition.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        if share and self.backend is not None:
+            self.backend.delete(key)
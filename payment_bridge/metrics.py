@@ -0,0 +1,234 @@
+"""
+Counters and histograms for the bridge, rendered in the Prometheus text format
+
+Everything is allocated up front or on the first request for a gateway and
+action, so recording a request only bumps existing counters.
+
+Mount the endpoint next to the direct post application:
+  metrics_application = MetricsApplication(direct_post_application.metrics)
+  application = DirectPostMiddleware(application, metrics_application, '/metrics')
+"""
+from bisect import bisect_left
+from threading import Lock
+
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+WAIT_BUCKETS = (.0001, .0005, .001, .005, .01, .05, .1, .5, 1, 5)
+
+#what became of a request: the gateway approved it, declined it, or there
+#was no gateway response at all
+OUTCOMES = ('success', 'failure', 'exception')
+SUCCESS, FAILURE, EXCEPTION = range(len(OUTCOMES))
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value)) for name, value in labels)
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        #one slot per bucket plus +Inf, not cumulative until rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = Lock()
+    
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        self.lock.acquire()
+        try:
+            self.counts[index] += 1
+            self.sum += value
+        finally:
+            self.lock.release()
+    
+    def render(self, name, labels=()):
+        self.lock.acquire()
+        try:
+            counts = list(self.counts)
+            total = self.sum
+        finally:
+            self.lock.release()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (name, format_labels(tuple(labels) + (('le', bound),)), cumulative))
+        lines.append('%s_sum%s %r' % (name, format_labels(labels), total))
+        lines.append('%s_count%s %d' % (name, format_labels(labels), cumulative))
+        return lines
+
+class RequestStats(object):
+    """
+    Latency and outcome counts for one gateway and action
+    """
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.outcomes = [0] * len(OUTCOMES)
+
+class BridgeMetrics(object):
+    def __init__(self):
+        self.lock = Lock()
+        #gateway => action => RequestStats
+        self.requests = dict()
+        #waiting on a single bridge's lock, and in a pool's queue for a free bridge
+        self.lock_wait = Histogram(WAIT_BUCKETS)
+        self.queue_wait = Histogram(WAIT_BUCKETS)
+        self.in_flight = 0
+        #direct posts answered from the idempotency cache
+        self.replays = 0
+        #ruby's LRU of gateways built from merchant credentials
+        self.gateway_cache = {'hit':0, 'miss':0, 'eviction':0}
+        self.bridges = []
+    
+    def add_bridge(self, bridge):
+        #restart and reconnect counts are read from the bridges when rendering
+        self.lock.acquire()
+        try:
+            self.bridges.append(bridge)
+        finally:
+            self.lock.release()
+    
+    def get_stats(self, gateway, action):
+        try:
+            return self.requests[gateway][action]
+        except KeyError:
+            pass
+        self.lock.acquire()
+        try:
+            actions = self.requests.setdefault(gateway, dict())
+            if action not in actions:
+                actions[action] = RequestStats()
+            return actions[action]
+        finally:
+            self.lock.release()
+    
+    def request_started(self):
+        self.lock.acquire()
+        try:
+            self.in_flight += 1
+        finally:
+            self.lock.release()
+    
+    def request_finished(self, gateway, action, seconds, response=None):
+        """
+        Records a finished bridge call; response is None if it raised
+        """
+        stats = self.get_stats(gateway, action)
+        stats.latency.observe(seconds)
+        if response is None or 'test' not in response:
+            #the gateway was never reached or raised
+            outcome = EXCEPTION
+        elif response.get('success'):
+            outcome = SUCCESS
+        else:
+            outcome = FAILURE
+        self.lock.acquire()
+        try:
+            self.in_flight -= 1
+            stats.outcomes[outcome] += 1
+        finally:
+            self.lock.release()
+    
+    def observe_replay(self):
+        self.lock.acquire()
+        try:
+            self.replays += 1
+        finally:
+            self.lock.release()
+    
+    def observe_gateway_cache(self, hit, evicted):
+        self.lock.acquire()
+        try:
+            if hit:
+                self.gateway_cache['hit'] += 1
+            else:
+                self.gateway_cache['miss'] += 1
+            self.gateway_cache['eviction'] += evicted
+        finally:
+            self.lock.release()
+    
+    def observe_lock_wait(self, seconds):
+        self.lock_wait.observe(seconds)
+    
+    def observe_queue_wait(self, seconds):
+        self.queue_wait.observe(seconds)
+    
+    def render(self):
+        lines = ['# HELP payment_bridge_request_seconds Time spent on bridge calls',
+                 '# TYPE payment_bridge_request_seconds histogram']
+        self.lock.acquire()
+        try:
+            requests = [(gateway, action, stats) for gateway, actions in sorted(self.requests.items())
+                        for action, stats in sorted(actions.items())]
+            outcomes = [(gateway, action, list(stats.outcomes)) for gateway, action, stats in requests]
+            in_flight = self.in_flight
+            replays = self.replays
+            gateway_cache = dict(self.gateway_cache)
+            bridges = list(self.bridges)
+        finally:
+            self.lock.release()
+        for gateway, action, stats in requests:
+            lines.extend(stats.latency.render('payment_bridge_request_seconds', (('gateway', gateway), ('action', action))))
+        
+        lines.append('# HELP payment_bridge_requests_total Bridge calls by outcome')
+        lines.append('# TYPE payment_bridge_requests_total counter')
+        for gateway, action, counts in outcomes:
+            for outcome, count in zip(OUTCOMES, counts):
+                labels = (('gateway', gateway), ('action', action), ('outcome', outcome))
+                lines.append('payment_bridge_requests_total%s %d' % (format_labels(labels), count))
+        
+        lines.append('# HELP payment_bridge_wait_seconds Time spent waiting for a bridge to take a request')
+        lines.append('# TYPE payment_bridge_wait_seconds histogram')
+        lines.extend(self.lock_wait.render('payment_bridge_wait_seconds', (('wait', 'lock'),)))
+        lines.extend(self.queue_wait.render('payment_bridge_wait_seconds', (('wait', 'queue'),)))
+        
+        lines.append('# HELP payment_bridge_in_flight Bridge calls in progress')
+        lines.append('# TYPE payment_bridge_in_flight gauge')
+        lines.append('payment_bridge_in_flight %d' % in_flight)
+        
+        lines.append('# HELP payment_bridge_replays_total Direct posts answered from the idempotency cache')
+        lines.append('# TYPE payment_bridge_replays_total counter')
+        lines.append('payment_bridge_replays_total %d' % replays)
+        
+        lines.append('# HELP payment_bridge_gateway_cache_total Lookups of gateways built from merchant credentials, and evictions')
+        lines.append('# TYPE payment_bridge_gateway_cache_total counter')
+        for result in ('hit', 'miss', 'eviction'):
+            lines.append('payment_bridge_gateway_cache_total%s %d' % (format_labels((('result', result),)), gateway_cache[result]))
+        
+        restarts = 0
+        failures = 0
+        reconnects = 0
+        for bridge in bridges:
+            stats = bridge.supervisor.stats()
+            restarts += stats['restarts']
+            failures += stats['failures']
+            #a SocketBridge has no process of its own to restart, only a connection
+            reconnects += getattr(bridge, 'reconnects', 0)
+        lines.append('# HELP payment_bridge_restarts_total Bridge processes replaced')
+        lines.append('# TYPE payment_bridge_restarts_total counter')
+        lines.append('payment_bridge_restarts_total %d' % restarts)
+        lines.append('# HELP payment_bridge_reconnects_total Multiplexed and socket bridge connections reopened after the bridge went away')
+        lines.append('# TYPE payment_bridge_reconnects_total counter')
+        lines.append('payment_bridge_reconnects_total %d' % reconnects)
+        lines.append('# HELP payment_bridge_failing_starts Bridge processes that died young in a row')
+        lines.append('# TYPE payment_bridge_failing_starts gauge')
+        lines.append('payment_bridge_failing_starts %d' % failures)
+        return '\n'.join(lines) + '\n'
+
+class MetricsApplication(object):
+    """
+    WSGI application serving BridgeMetrics to Prometheus
+    """
+    def __init__(self, metrics):
+        self.metrics = metrics
+    
+    def __call__(self, environ, start_response):
+        response_body = self.metrics.render().encode('utf-8')
+        response_headers = [('Content-Type', 'text/plain; version=0.0.4'),
+                      ('Content-Length', str(len(response_body)))]
+        start_response('200 OK', response_headers)
+        return [response_body]
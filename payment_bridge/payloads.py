@@ -0,0 +1,166 @@
+"""
+Signed payload codecs for encrypt_data and decrypt_data
+
+A codec turns the dictionaries a direct post application hands out into URL
+safe strings and back, refusing strings that were tampered with. Payloads end
+up in redirect query strings and JSONP bodies and echo every bill_* and
+ship_* field, so SignedCodec keeps them small: MessagePack when it is
+installed, otherwise JSON without whitespace, zlib compressed whenever that
+is shorter, and signed with an HMAC whose key is derived once.
+
+Every payload starts with a flag naming its serialization and compression,
+so loads reads payloads made with other settings of the same key and salt.
+
+DjangoSigningCodec produces django.core.signing payloads from a signer built
+once, for applications that must keep their existing payloads readable.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class BadPayload(ValueError):
+    """
+    Raised for payloads whose signature does not match or that cannot be read
+    """
+
+def b64_encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+def b64_decode(data):
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+if hasattr(hmac, 'compare_digest'):
+    constant_time_compare = hmac.compare_digest
+else: #python < 2.7.7
+    def constant_time_compare(first, second):
+        if len(first) != len(second):
+            return False
+        result = 0
+        for x, y in zip(bytearray(first), bytearray(second)):
+            result |= x ^ y
+        return result == 0
+
+class JSONSerializer(object):
+    name = 'json'
+    flag = b'j'
+    
+    def dumps(self, params):
+        return json.dumps(params, separators=(',', ':')).encode('utf-8')
+    
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'))
+
+class MessagePackSerializer(object):
+    name = 'msgpack'
+    flag = b'm'
+    
+    def dumps(self, params):
+        return msgpack.packb(params, use_bin_type=True)
+    
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+SERIALIZERS = {'json': JSONSerializer()}
+if msgpack is not None:
+    SERIALIZERS['msgpack'] = MessagePackSerializer()
+
+class SignedCodec(object):
+    #marks a zlib compressed body, after the serializer's flag
+    compressed_flag = b'z'
+    separator = b'.'
+    
+    def __init__(self, key, salt='payment_bridge', serializer=None, compress=True):
+        """
+        key is the secret shared by every process that reads the payloads;
+        serializer defaults to msgpack when it is installed
+        """
+        if isinstance(key, type(u'')):
+            key = key.encode('utf-8')
+        if isinstance(salt, type(u'')):
+            salt = salt.encode('utf-8')
+        if serializer is None:
+            serializer = 'msgpack' if 'msgpack' in SERIALIZERS else 'json'
+        self.serializer = SERIALIZERS[serializer]
+        self.compress = compress
+        #copied for each payload instead of deriving the key every time
+        self.mac = hmac.new(hashlib.sha256(salt + b'signer' + key).digest(), digestmod=hashlib.sha256)
+        self.serializers = dict((item.flag, item) for item in SERIALIZERS.values())
+    
+    def signature(self, value):
+        mac = self.mac.copy()
+        mac.update(value)
+        return b64_encode(mac.digest())
+    
+    def dumps(self, params):
+        """
+        Takes a dictionary and returns a signed string
+        """
+        data = self.serializer.dumps(params)
+        flag = self.serializer.flag
+        if self.compress:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                data = compressed
+                flag += self.compressed_flag
+        value = flag + b64_encode(data)
+        return (value + self.separator + self.signature(value)).decode('ascii')
+    
+    def loads(self, payload):
+        """
+        Takes a signed string and returns the dictionary, raising BadPayload
+        if it was not signed with this codec's key and salt
+        """
+        if isinstance(payload, type(u'')):
+            payload = payload.encode('ascii', 'replace')
+        value, separator, signature = payload.rpartition(self.separator)
+        if not separator or not constant_time_compare(signature, self.signature(value)):
+            raise BadPayload('Payload signature does not match')
+        serializer = self.serializers.get(value[:1])
+        if serializer is None:
+            raise BadPayload('Unknown payload serialization %r' % value[:1])
+        data = value[1:]
+        compressed = data[:1] == self.compressed_flag
+        if compressed:
+            data = data[1:]
+        try:
+            data = b64_decode(data)
+            if compressed:
+                data = zlib.decompress(data)
+            return serializer.loads(data)
+        except Exception as error:
+            raise BadPayload('Unreadable payload: %s' % error)
+
+class DjangoSigningCodec(object):
+    """
+    Reads and writes django.core.signing payloads
+    Requires Django 1.4 or later
+    """
+    def __init__(self, salt, compress=False):
+        from django.core import signing
+        self.signing = signing
+        self.salt = salt
+        self.compress = compress
+        self.sign_object = hasattr(signing.TimestampSigner, 'sign_object') #django 3.1+
+    
+    def get_signer(self):
+        #built per call so the current SECRET_KEY is used, as with override_settings or a rotated key
+        return self.signing.TimestampSigner(salt=self.salt)
+    
+    def dumps(self, params):
+        if self.sign_object:
+            return self.get_signer().sign_object(params, compress=self.compress)
+        return self.signing.dumps(params, salt=self.salt, compress=self.compress)
+    
+    def loads(self, payload):
+        #raises django's BadSignature like signing.loads always has
+        if self.sign_object:
+            return self.get_signer().unsign_object(payload)
+        return self.signing.loads(payload, salt=self.salt)
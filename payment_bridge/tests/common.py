@@ -1,8 +1,12 @@
+from __future__ import print_function
+from threading import Lock, Thread
+import atexit
 import base64
 import json
 import unittest
 import yaml
 import os
+import sys
 
 from payment_bridge.wsgi import BaseDirectPostApplication
 
@@ -12,11 +16,16 @@ if os.path.exists(inpath):
     infile = open(inpath)
     global_config = yaml.load(infile) or {}
 else:
-    print "Please create the following file with gateway credentials:", inpath
+    print("Please create the following file with gateway credentials:", inpath, file=sys.stderr)
 
 class BaseTestDirectPostApplication(BaseDirectPostApplication):
+    #the gateway to set up, unless one is passed as gateway=
+    gateway = {'module':'bogus', 'name':'test', 'params':{}}
+    #tests check what was recorded
+    collect_metrics = True
+    
     def __init__(self, **kwargs):
-        self.gateway = kwargs.pop('gateway')
+        self.gateway = kwargs.pop('gateway', self.gateway)
         super(BaseTestDirectPostApplication, self).__init__(**kwargs)
     
     def load_gateways_config(self):
@@ -26,13 +35,59 @@ class BaseTestDirectPostApplication(BaseDirectPostApplication):
         """
         Takes an encoded string and returns a dictionary
         """
-        return json.loads(base64.b64decode(encrypted_data))
+        return json.loads(base64.b64decode(encrypted_data).decode('utf-8'))
     
     def encrypt_data(self, params):
         """
         Takes a dictionary and returns a string
         """
-        return base64.b64encode(json.dumps(params))
+        return base64.b64encode(json.dumps(params).encode('utf-8')).decode('ascii')
+
+#one application, and so one bridge process, per gateway for the whole test run
+applications = {}
+applications_lock = Lock()
+
+def get_application(gateway):
+    """
+    Returns the shared application for gateway, starting it on first use
+    """
+    key = json.dumps(gateway, sort_keys=True)
+    applications_lock.acquire()
+    try:
+        if key not in applications:
+            applications[key] = BaseTestDirectPostApplication(redirect_to='http://localhost:8080/direct-post/', gateway=gateway)
+        return applications[key]
+    finally:
+        applications_lock.release()
+
+def shutdown_applications():
+    applications_lock.acquire()
+    try:
+        while applications:
+            applications.popitem()[1].shutdown()
+    finally:
+        applications_lock.release()
+
+atexit.register(shutdown_applications)
+
+def start_gateway_simulator(**kwargs):
+    """
+    Serves benchmarks/gateway_simulator.py on a free local port, returns None
+    when the benchmarks are not around, as in an installed package
+    """
+    benchmarks = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'benchmarks')
+    if benchmarks not in sys.path:
+        sys.path.insert(0, benchmarks)
+    try:
+        from gateway_simulator import GatewaySimulator
+    except ImportError:
+        return None
+    simulator = GatewaySimulator(('localhost', 0), **kwargs)
+    thread = Thread(target=simulator.serve_forever)
+    thread.daemon = True
+    thread.start()
+    atexit.register(simulator.shutdown)
+    return simulator
 
 class PaymentData(object):
     cc_info = {
@@ -94,23 +149,18 @@ class BaseGatewayTestCase(unittest.TestCase):
         self.checkGatewayConfigured()
         gateway = dict(self.gateway)
         gateway['params'] = self.read_gateway_params()
-        self.application = BaseTestDirectPostApplication(redirect_to='http://localhost:8080/direct-post/', gateway=gateway)
+        self.application = get_application(gateway)
         self.data_source = PaymentData()
     
-    def tearDown(self):
-        self.application.shutdown()
-    
     def read_gateway_params(self):
         return global_config.get(self.gateway['module'], None)
     
     def get_supported_actions(self):
-        if not hasattr(self, '_supported_actions'):
-            #calling a gateway with action = None is a request for the supported actions
-            response = self.application.call_bridge(data=None, secure_data=None, gateway='test', action=None)
-            if response['message'] == 'Unrecognized gateway':
-                self.skipTest(response['message'])
-            self._supported_actions = response['supported_actions']
-        return self._supported_actions
+        #the bridge reports what every gateway supports when it starts
+        capabilities = self.application.bridge.capabilities
+        if 'test' not in capabilities:
+            self.skipTest('Unrecognized gateway')
+        return capabilities['test']
     
     def checkGatewayConfigured(self):
         if self.read_gateway_params() == None:
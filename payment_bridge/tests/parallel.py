@@ -0,0 +1,94 @@
+"""
+Runs test modules in parallel worker processes
+
+  python -m payment_bridge.tests.parallel [--workers 4] [module ...]
+
+Without modules every payment_bridge/tests/test_*.py is run. Each module gets
+its own python process, and so its own bridge per gateway, so the bogus,
+orbital and CIM suites do not wait on each other. Output is printed a module
+at a time as they finish; the exit status is non zero if any module failed.
+"""
+from __future__ import print_function
+from threading import Lock, Thread
+try:
+    from Queue import Queue
+except ImportError: #python 3
+    from queue import Queue
+import glob
+import multiprocessing
+import optparse
+import os
+import subprocess
+import sys
+import time
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def discover_modules():
+    paths = sorted(glob.glob(os.path.join(TESTS_DIR, 'test_*.py')))
+    return ['payment_bridge.tests.' + os.path.basename(path)[:-3] for path in paths]
+
+def run_module(module):
+    """
+    Returns (returncode, output, seconds) for one module's tests
+    """
+    started = time.time()
+    process = subprocess.Popen([sys.executable, '-m', 'unittest', module],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT,
+                               cwd=os.getcwd())
+    output = process.communicate()[0]
+    return process.returncode, output.decode('utf-8', 'replace'), time.time() - started
+
+def run_modules(modules, workers):
+    """
+    Returns a dictionary of module => (returncode, output, seconds)
+    """
+    queue = Queue()
+    for module in modules:
+        queue.put(module)
+    results = dict()
+    print_lock = Lock()
+    
+    def worker():
+        while True:
+            try:
+                module = queue.get_nowait()
+            except Exception:
+                return
+            result = run_module(module)
+            print_lock.acquire()
+            try:
+                results[module] = result
+                print('%s (%.2fs)' % (module, result[2]))
+                print(result[1])
+                sys.stdout.flush()
+            finally:
+                print_lock.release()
+    
+    threads = [Thread(target=worker) for index in range(min(workers, len(modules)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [module ...]')
+    parser.add_option('--workers', type='int', default=multiprocessing.cpu_count(),
+                      help='Number of modules to run at once')
+    options, args = parser.parse_args()
+    
+    modules = args or discover_modules()
+    started = time.time()
+    results = run_modules(modules, options.workers)
+    failed = [module for module in modules if results[module][0] != 0]
+    print('Ran %s modules in %.2fs' % (len(modules), time.time() - started))
+    if failed:
+        print('FAILED: %s' % ', '.join(failed))
+        sys.exit(1)
+    print('OK')
+
+if __name__ == '__main__':
+    main()
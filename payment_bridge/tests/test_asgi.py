@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import json
+import sys
+import time
+import unittest
+
+try:
+    import asyncio
+    from payment_bridge.asgi import AsyncBridge, BaseASGIDirectPostApplication
+except (ImportError, SyntaxError): #python 2
+    BaseASGIDirectPostApplication = None
+
+from payment_bridge.wsgi import BridgeError, BridgeResponseTimeout
+
+from payment_bridge.tests.common import BaseTestDirectPostApplication, PaymentData
+
+try:
+    from urlparse import parse_qs
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import parse_qs, urlencode
+
+
+#answers void, floods the reader for anything else and never answers hang
+SCRIPTED_BRIDGE = '''import json, sys
+sys.stdout.write('{"type": "capabilities", "capabilities": {}, "request_id": null}\\n')
+sys.stdout.flush()
+for line in iter(sys.stdin.readline, ""):
+    request = json.loads(line)
+    if request["action"] == "hang":
+        continue
+    if request["action"] == "void":
+        sys.stdout.write(json.dumps({"request_id": request["request_id"], "success": True}) + "\\n")
+    else:
+        sys.stdout.write("x" * 4096 + "\\n")
+    sys.stdout.flush()'''
+
+if BaseASGIDirectPostApplication is not None:
+    class ScriptedAsyncBridge(AsyncBridge):
+        read_limit = 1024
+        
+        def get_command(self):
+            return [sys.executable, '-c', SCRIPTED_BRIDGE]
+    
+    class BogusASGIDirectPostApplication(BaseASGIDirectPostApplication, BaseTestDirectPostApplication):
+        pass
+
+@unittest.skipIf(BaseASGIDirectPostApplication is None, 'asyncio requires python 3')
+class TestASGIApplication(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.application = BogusASGIDirectPostApplication(redirect_to='http://localhost:8080/direct-post/')
+        self.data_source = PaymentData()
+    
+    def tearDown(self):
+        self.loop.run_until_complete(self.application.shutdown())
+        self.loop.close()
+    
+    def done(self, result=None):
+        future = self.loop.create_future()
+        future.set_result(result)
+        return future
+    
+    def request(self, method, query_string=b'', body=b''):
+        sent = []
+        def receive():
+            return self.done({'type':'http.request', 'body':body, 'more_body':False})
+        def send(message):
+            sent.append(message)
+            return self.done()
+        scope = {'type':'http', 'method':method, 'query_string':query_string}
+        self.loop.run_until_complete(self.application(scope, receive, send))
+        return sent[0]['status'], sent[1]['body'].decode('utf-8')
+    
+    def get_payload(self, action='authorize'):
+        secure_data = {'money':'100', 'gateway':'test', 'action':action}
+        return self.application.encrypt_data(secure_data)
+    
+    def test_post_redirects_with_response(self):
+        bill_info = self.data_source.get_all_info()
+        bill_info['cc_number'] = '1'
+        bill_info['payload'] = self.get_payload()
+        status, body = self.request('POST', body=urlencode(bill_info).encode('utf-8'))
+        self.assertEqual(status, 303)
+        redirect, query = body.split('?', 1)
+        self.assertEqual(redirect, 'http://localhost:8080/direct-post/')
+        response = self.application.decrypt_data(parse_qs(query)['payload'][0])
+        self.assertTrue(response['success'], response['message'])
+    
+    def test_jsonp_requires_callback(self):
+        status, body = self.request('GET', query_string=urlencode({'payload':self.get_payload()}).encode('utf-8'))
+        self.assertEqual(status, 405)
+    
+    def test_jsonp_response(self):
+        bill_info = self.data_source.get_all_info()
+        bill_info['cc_number'] = '2'
+        bill_info['payload'] = self.get_payload()
+        bill_info['callback'] = 'paid'
+        status, body = self.request('GET', query_string=urlencode(bill_info).encode('utf-8'))
+        self.assertEqual(status, 200)
+        self.assertTrue(body.startswith('paid('))
+        params = json.loads(body[len('paid('):-len(');')])
+        response = self.application.decrypt_data(params['payload'])
+        self.assertFalse(response['success'], response['message'])
+    
+    def test_concurrent_sends(self):
+        bridge = self.application.bridge
+        def capture(authorization):
+            return bridge.send(data={}, secure_data={'money':'100', 'authorization':authorization}, gateway='test', action='capture')
+        responses = self.loop.run_until_complete(asyncio.gather(*[capture(str(index)) for index in range(3, 23)]))
+        for response in responses:
+            self.assertTrue(response['success'], response['message'])
+        self.assertEqual(bridge.pending, {})
+    
+    def test_configure_survives_restart(self):
+        bridge = self.application.bridge
+        capabilities = self.loop.run_until_complete(bridge.configure(add=[{'module':'bogus', 'name':'other', 'params':{}}]))
+        self.assertEqual(sorted(capabilities.keys()), ['other', 'test'])
+        
+        #the next process is started on demand and configured before use
+        self.loop.run_until_complete(bridge.close())
+        response = self.loop.run_until_complete(bridge.send(data={}, secure_data={'money':'100', 'authorization':'3'}, gateway='other', action='capture'))
+        self.assertTrue(response['success'], response['message'])
+
+@unittest.skipIf(BaseASGIDirectPostApplication is None, 'asyncio requires python 3')
+class TestAsyncBridge(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.bridge = ScriptedAsyncBridge(threads=1)
+    
+    def tearDown(self):
+        self.loop.run_until_complete(self.bridge.close())
+        self.loop.close()
+    
+    def send(self, action, deadline=None):
+        return self.loop.run_until_complete(self.bridge.send(action=action, deadline=deadline))
+    
+    def wait_for_restart(self, slave):
+        #this module is imported by python 2, so no coroutines here
+        end = time.time() + 5
+        while self.bridge.slave is slave:
+            self.assertTrue(time.time() < end, 'bridge not restarted in time')
+            self.loop.run_until_complete(asyncio.sleep(.01))
+        self.loop.run_until_complete(asyncio.wait_for(slave.wait(), 5))
+    
+    def test_reader_failure_fails_pending_and_reopens(self):
+        self.assertTrue(self.send('void')['success'])
+        slave = self.bridge.slave
+        self.assertRaises(BridgeError, self.send, 'flood', time.time() + 5)
+        self.wait_for_restart(slave)
+        self.assertEqual(self.bridge.pending, {})
+        self.assertTrue(self.send('void')['success'])
+        self.assertNotEqual(self.bridge.slave, slave)
+    
+    def test_timeout_replaces_stuck_process(self):
+        self.assertTrue(self.send('void')['success'])
+        slave = self.bridge.slave
+        self.assertRaises(BridgeResponseTimeout, self.send, 'hang', time.time() + .1)
+        self.wait_for_restart(slave)
+        self.assertTrue(self.send('void')['success'])
+
+if __name__ == '__main__':
+    unittest.main()
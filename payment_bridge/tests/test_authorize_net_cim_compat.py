@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import unittest
 
-from payment_bridge.tests.common import BaseGatewayTestCase
+from payment_bridge.tests.common import BaseGatewayTestCase, start_gateway_simulator
 
 
 class TestAuthorizeNetCIMGateway(BaseGatewayTestCase):
@@ -242,6 +242,86 @@ class TestAuthorizeNetCIMGateway(BaseGatewayTestCase):
         response = self.application.call_bridge(data={}, secure_data=secure_data, gateway='test', action='unstore')
         self.assertFalse(response['success'], response['message'])
 
+class TestAuthorizeNetCIMSingleCallStore(BaseGatewayTestCase):
+    """
+    Stores against benchmarks/gateway_simulator.py, answering
+    createCustomerProfileRequest with as many ids as each test asks for
+    """
+    gateway = {
+        'module':'authorize_net_cim_compat',
+        'name':'test',
+    }
+    simulator = None
+    
+    def setUp(self):
+        if TestAuthorizeNetCIMSingleCallStore.simulator is None:
+            TestAuthorizeNetCIMSingleCallStore.simulator = start_gateway_simulator()
+        super(TestAuthorizeNetCIMSingleCallStore, self).setUp()
+        self.payment_profile_count = 1
+        self.address_count = 1
+        self.created = None
+        self.simulator.cim.handle_createCustomerProfileRequest = self.create_profile
+    
+    def tearDown(self):
+        del self.simulator.cim.handle_createCustomerProfileRequest
+    
+    def read_gateway_params(self):
+        if self.simulator is None:
+            return None
+        return {
+            'login':'simulator',
+            'password':'simulator',
+            'test':True,
+            'url':'http://localhost:%s/xml/v1/request.api' % self.simulator.server_address[1],
+        }
+    
+    def create_profile(self, request):
+        state = self.simulator.state
+        profile_id = state.new_id()
+        payment_profile_ids = [state.new_id() for index in range(self.payment_profile_count)]
+        address_ids = [state.new_id() for index in range(self.address_count)]
+        state.cim_profiles[profile_id] = {
+            'payment_profiles':dict.fromkeys(payment_profile_ids, '4111111111111111'),
+            'addresses':set(address_ids),
+        }
+        self.created = (profile_id, payment_profile_ids, address_ids)
+        #one numericString parses to a string, several to an array
+        fields = [('customerProfileId', profile_id)]
+        if payment_profile_ids:
+            fields.append(('customerPaymentProfileIdList', [('numericString', value) for value in payment_profile_ids]))
+        if address_ids:
+            fields.append(('customerShippingAddressIdList', [('numericString', value) for value in address_ids]))
+        return self.simulator.cim.respond(request, fields=fields)
+    
+    def store(self):
+        self.checkGatewaySupport('store')
+        bill_info = self.data_source.get_all_info()
+        response = self.application.call_bridge(data=bill_info, secure_data={}, gateway='test', action='store')
+        self.assertTrue(response['success'], response['message'])
+        return response['authorization'].split(';')
+    
+    def test_store_single_ids(self):
+        authorization = self.store()
+        profile_id, payment_profile_ids, address_ids = self.created
+        self.assertEqual(authorization, ['', profile_id, payment_profile_ids[0], address_ids[0]])
+    
+    def test_store_multiple_ids(self):
+        self.payment_profile_count = 2
+        self.address_count = 2
+        authorization = self.store()
+        profile_id, payment_profile_ids, address_ids = self.created
+        self.assertEqual(authorization, ['', profile_id, payment_profile_ids[0], address_ids[0]])
+    
+    def test_store_without_payment_profile(self):
+        #the card is added to the new profile with a second request
+        self.payment_profile_count = 0
+        authorization = self.store()
+        profile_id, payment_profile_ids, address_ids = self.created
+        profile = self.simulator.state.cim_profiles[profile_id]
+        self.assertEqual(authorization[1], profile_id)
+        self.assertEqual(list(profile['payment_profiles']), [authorization[2]])
+        self.assertTrue(authorization[3] in profile['addresses'])
+
 if __name__ == '__main__':
     unittest.main()
 
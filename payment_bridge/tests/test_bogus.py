@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import unittest
 
+from payment_bridge.metrics import SUCCESS
 from payment_bridge.tests.common import BaseGatewayTestCase
 
 
@@ -65,6 +66,35 @@ class TestBogusGateway(BaseGatewayTestCase):
         self.assertTrue(response['success'], response['message'])
         self.assertEqual(response['bill_first_name'], bill_info['bill_first_name'])
     
+    def test_authorize_selected_fields(self):
+        self.checkGatewaySupport('authorize')
+        secure_data = {'money':'100', 'fields':['authorization', 'ship_*']}
+        bill_info = self.data_source.get_all_info()
+        bill_info['cc_number'] = '1'
+        stats = self.application.metrics.get_stats('test', 'authorize')
+        successes = stats.outcomes[SUCCESS]
+        response = self.application.call_bridge(data=bill_info, secure_data=secure_data, gateway='test', action='authorize')
+        self.assertTrue(response['success'], response['message'])
+        self.assertTrue(response['authorization'])
+        self.assertTrue(response['test'])
+        self.assertEqual(response['ship_zip'], bill_info['ship_zip'])
+        for field in ('bill_first_name', 'cc_display', 'money', 'session_data', 'fraud_review'):
+            self.assertFalse(field in response, field)
+        #still counted as a gateway response rather than an exception
+        self.assertEqual(stats.outcomes[SUCCESS], successes + 1)
+    
+    def test_authorize_malformed_fields(self):
+        self.checkGatewaySupport('authorize')
+        secure_data = {'money':'100', 'fields':'authorization'} #not a list
+        bill_info = self.data_source.get_all_info()
+        bill_info['cc_number'] = '1'
+        response = self.application.call_bridge(data=bill_info, secure_data=secure_data, gateway='test', action='authorize')
+        self.assertFalse(response['success'], response['message'])
+        #the bridge is still there for the next request
+        secure_data['fields'] = ['authorization']
+        response = self.application.call_bridge(data=bill_info, secure_data=secure_data, gateway='test', action='authorize')
+        self.assertTrue(response['success'], response['message'])
+    
     ## Capture ##
     
     def test_capture_success(self):
@@ -0,0 +1,602 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+from io import BytesIO
+from subprocess import Popen
+from threading import Event, Thread
+
+from payment_bridge.framing import FRAMINGS, FramingError
+from payment_bridge.metrics import BridgeMetrics
+from payment_bridge.wsgi import (Bridge, BridgeError, BridgePool, BridgePoolFull, BridgeSupervisor, MultiplexedBridge, SocketBridge,
+    BridgeSendTimeout, BridgeResponseTimeout, GatewayConfiguration, Zygote, RUBY_PATH, SCRIPT_PATH)
+from payment_bridge.tests.common import BaseTestDirectPostApplication, PaymentData
+
+
+BOGUS_ENVIRON = {'PAYMENT_CONFIGURATION':json.dumps([
+    {'module':'bogus',
+     'name':'test',
+     'params': {}}
+])}
+
+#reads requests and never answers, like a bridge stuck on a gateway call
+HUNG_SCRIPT = '''import sys, time
+sys.stdout.write('{"type": "capabilities", "capabilities": {}, "request_id": null}\\n')
+sys.stdout.flush()
+for line in iter(sys.stdin.readline, ""): time.sleep(60)'''
+
+#answers every request but warns on stderr first, like ruby printing a deprecation
+NOISY_SCRIPT = '''import json, sys
+sys.stdout.write('{"type": "capabilities", "capabilities": {}, "request_id": null}\\n')
+sys.stdout.flush()
+for line in iter(sys.stdin.readline, ""):
+    sys.stderr.write("warning: something is deprecated\\n")
+    sys.stderr.flush()
+    sys.stdout.write(json.dumps({"request_id": json.loads(line)["request_id"], "success": True}) + "\\n")
+    sys.stdout.flush()'''
+
+class HungBridge(Bridge):
+    def get_command(self):
+        return [sys.executable, '-c', HUNG_SCRIPT]
+
+class SlowRestartBridge(HungBridge):
+    #replacements take a while to boot, like ruby loading ActiveMerchant
+    spawned = 0
+    
+    def spawn(self):
+        self.spawned += 1
+        if self.spawned > 1:
+            time.sleep(1)
+        return super(SlowRestartBridge, self).spawn()
+
+class HungMultiplexedBridge(MultiplexedBridge):
+    def get_command(self):
+        return [sys.executable, '-c', HUNG_SCRIPT]
+
+class NoisyBridge(Bridge):
+    def get_command(self):
+        return [sys.executable, '-c', NOISY_SCRIPT]
+
+class FlakyMultiplexedBridge(MultiplexedBridge):
+    #the first restart fails, like a daemon that is not back up yet
+    spawned = 0
+    
+    def get_command(self):
+        return [sys.executable, '-c', NOISY_SCRIPT]
+    
+    def spawn(self):
+        self.spawned += 1
+        if self.spawned == 2:
+            raise OSError('Connection refused')
+        return super(FlakyMultiplexedBridge, self).spawn()
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+    
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class FakeBridge(object):
+    max_in_flight = 1
+    
+    def __init__(self, **kwargs):
+        self.proceed = Event()
+        self.calls = 0
+    
+    def send(self, deadline=None, **kwargs):
+        self.calls += 1
+        self.proceed.wait()
+        return kwargs
+    
+    def close(self):
+        self.proceed.set()
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError('condition not met in time')
+        time.sleep(.01)
+
+def send_in_background(bridge, **kwargs):
+    thread = Thread(target=bridge.send, kwargs=kwargs)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+class TestBridgePool(unittest.TestCase):
+    def test_authorize_through_pool(self):
+        pool = BridgePool(size=2, environ=BOGUS_ENVIRON)
+        try:
+            bill_info = PaymentData().get_all_info()
+            bill_info['cc_number'] = '1'
+            response = pool.send(data=bill_info, secure_data={'money':'100'}, gateway='test', action='authorize')
+            self.assertTrue(response['success'], response['message'])
+        finally:
+            pool.close()
+    
+    def test_requests_go_to_idle_workers(self):
+        pool = BridgePool(size=2, bridge_class=FakeBridge)
+        first = send_in_background(pool, action='void')
+        wait_for(lambda: sum(pool.load) == 1)
+        second = send_in_background(pool, action='void')
+        wait_for(lambda: sum(pool.load) == 2)
+        self.assertEqual([worker.calls for worker in pool.workers], [1, 1])
+        pool.close()
+        first.join()
+        second.join()
+    
+    def test_waiting_queue_is_bounded(self):
+        pool = BridgePool(size=1, max_waiting=1, bridge_class=FakeBridge)
+        send_in_background(pool, action='void')
+        wait_for(lambda: pool.load[0] == 1)
+        waiter = send_in_background(pool, action='void')
+        wait_for(lambda: pool.waiting == 1)
+        self.assertRaises(BridgePoolFull, pool.send, action='void')
+        pool.close()
+        waiter.join()
+        self.assertEqual(pool.workers[0].calls, 2)
+
+class TestMultiplexedBridge(unittest.TestCase):
+    def setUp(self):
+        self.bridge = MultiplexedBridge(threads=4, environ=BOGUS_ENVIRON)
+    
+    def tearDown(self):
+        self.bridge.close()
+    
+    def test_concurrent_requests_get_their_own_response(self):
+        responses = dict()
+        def capture(authorization):
+            secure_data = {'money':'100',
+                           'authorization':authorization,}
+            responses[authorization] = self.bridge.send(data={}, secure_data=secure_data, gateway='test', action='capture')
+        threads = [Thread(target=capture, args=(authorization,)) for authorization in ['1', '2', '3', '4', '5', '6']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEqual(len(responses), 6)
+        self.assertFalse(responses['1']['success'], responses['1']['message'])
+        self.assertFalse(responses['2']['success'], responses['2']['message'])
+        for authorization in ['3', '4', '5', '6']:
+            self.assertTrue(responses[authorization]['success'], responses[authorization]['message'])
+        self.assertEqual(self.bridge.pending, {})
+
+class TestDeadlines(unittest.TestCase):
+    def test_response_timeout_replaces_process(self):
+        bridge = HungBridge()
+        stuck = bridge.slave
+        try:
+            self.assertRaises(BridgeResponseTimeout, bridge.send, action='void', deadline=time.time() + .2)
+            self.assertNotEqual(stuck.wait(), None)
+            wait_for(lambda: bridge.slave is not stuck)
+            self.assertEqual(bridge.slave.poll(), None)
+        finally:
+            bridge.close()
+    
+    def test_timeout_raised_before_replacement_boots(self):
+        bridge = SlowRestartBridge(standby=False)
+        stuck = bridge.slave
+        try:
+            started = time.time()
+            self.assertRaises(BridgeResponseTimeout, bridge.send, action='void', deadline=started + .2)
+            self.assertTrue(time.time() - started < .8)
+            #the replacement is still booting
+            self.assertRaises(BridgeSendTimeout, bridge.send, action='void', deadline=time.time() + .2)
+            wait_for(lambda: bridge.slave is not stuck)
+            self.assertEqual(bridge.slave.poll(), None)
+        finally:
+            bridge.close()
+    
+    def test_send_timeout_when_bridge_busy(self):
+        bridge = HungBridge()
+        try:
+            bridge.lock.acquire()
+            try:
+                bridge.send(action='void', deadline=time.time() + .1)
+            except BridgeSendTimeout as error:
+                self.assertFalse(error.sent)
+            else:
+                self.fail('BridgeSendTimeout not raised')
+            bridge.lock.release()
+        finally:
+            bridge.close()
+    
+    def test_deadline_met(self):
+        bridge = Bridge(environ=BOGUS_ENVIRON)
+        try:
+            secure_data = {'money':'100',
+                           'authorization':'3',}
+            response = bridge.send(data={}, secure_data=secure_data, gateway='test', action='capture', deadline=time.time() + 30)
+            self.assertTrue(response['success'], response['message'])
+        finally:
+            bridge.close()
+    
+    def test_multiplexed_restarts_once_all_threads_stuck(self):
+        bridge = HungMultiplexedBridge(threads=2)
+        stuck = bridge.slave
+        try:
+            self.assertRaises(BridgeResponseTimeout, bridge.send, action='void', deadline=time.time() + .1)
+            self.assertEqual(stuck.poll(), None)
+            self.assertRaises(BridgeResponseTimeout, bridge.send, action='void', deadline=time.time() + .1)
+            wait_for(lambda: bridge.slave is not stuck)
+            self.assertNotEqual(stuck.wait(), None)
+            self.assertEqual(bridge.pending, {})
+        finally:
+            bridge.close()
+    
+    def test_multiplexed_reconnects_after_failed_reopen(self):
+        metrics = BridgeMetrics()
+        bridge = FlakyMultiplexedBridge(threads=2, standby=False, metrics=metrics)
+        crashed = bridge.slave
+        try:
+            crashed.kill()
+            wait_for(lambda: bridge.spawned == 2)
+            self.assertRaises(BridgeError, bridge.send, action='void', deadline=time.time() + 1)
+            wait_for(lambda: bridge.slave is not crashed and bridge.connected)
+            self.assertTrue(bridge.send(action='void', deadline=time.time() + 5)['success'])
+            self.assertTrue('payment_bridge_reconnects_total 1' in metrics.render())
+        finally:
+            bridge.close()
+    
+    def test_pool_wait_times_out(self):
+        pool = BridgePool(size=1, bridge_class=FakeBridge)
+        send_in_background(pool, action='void')
+        wait_for(lambda: pool.load[0] == 1)
+        self.assertRaises(BridgeSendTimeout, pool.send, action='void', deadline=time.time() + .1)
+        pool.close()
+
+class TestDiagnostics(unittest.TestCase):
+    def setUp(self):
+        self.handler = RecordingHandler()
+        logging.getLogger('payment_bridge').addHandler(self.handler)
+    
+    def tearDown(self):
+        logging.getLogger('payment_bridge').removeHandler(self.handler)
+    
+    def test_stderr_is_logged_not_parsed(self):
+        bridge = NoisyBridge(standby=False)
+        slave = bridge.slave
+        try:
+            for index in range(3):
+                response = bridge.send(action='void')
+                self.assertTrue(response['success'])
+            self.assertEqual(bridge.slave, slave)
+            wait_for(lambda: len(self.handler.messages) == 3)
+            self.assertEqual(self.handler.messages[0], 'bridge: warning: something is deprecated')
+        finally:
+            bridge.close()
+
+class FakeProcess(object):
+    returncode = None
+    
+    def poll(self):
+        return self.returncode
+
+class TestSupervisor(unittest.TestCase):
+    def test_crashed_bridge_swaps_in_standby(self):
+        bridge = Bridge(environ=BOGUS_ENVIRON)
+        try:
+            wait_for(lambda: bridge.supervisor.standby is not None, timeout=30)
+            standby = bridge.supervisor.standby[0]
+            bridge.slave.kill()
+            bridge.slave.wait()
+            
+            secure_data = {'money':'100',
+                           'authorization':'3',}
+            response = bridge.send(data={}, secure_data=secure_data, gateway='test', action='capture')
+            self.assertTrue(response['success'], response['message'])
+            self.assertEqual(bridge.slave, standby)
+            self.assertEqual(bridge.supervisor.restarts, 1)
+        finally:
+            bridge.close()
+    
+    def test_backoff_doubles_for_processes_dying_young(self):
+        supervisor = BridgeSupervisor(lambda: (FakeProcess(), None, {}, 0), standby=False, backoff=.05)
+        supervisor.take()
+        self.assertEqual(supervisor.next_delay(), 0)
+        supervisor.take()
+        supervisor.take()
+        started = time.time()
+        supervisor.take()
+        #the replacement waited out the backoff
+        self.assertTrue(time.time() - started >= .1)
+        self.assertEqual(supervisor.restarts, 3)
+        self.assertEqual(supervisor.next_delay(), .2)
+        
+        supervisor.current_since -= supervisor.min_uptime
+        supervisor.take()
+        self.assertEqual(supervisor.next_delay(), 0)
+    
+    def test_dead_standby_is_not_used(self):
+        supervisor = BridgeSupervisor(lambda: (FakeProcess(), None, {}, 0), standby=False)
+        dead = FakeProcess()
+        dead.returncode = 1
+        supervisor.standby = (dead, None, {}, 0)
+        process, framing, capabilities, version = supervisor.take()
+        self.assertNotEqual(process, dead)
+    
+    def test_take_gives_up_at_deadline(self):
+        slow = Event()
+        def spawn():
+            slow.wait()
+            return FakeProcess(), None, {}, 0
+        supervisor = BridgeSupervisor(spawn, standby=False)
+        slow.set()
+        supervisor.take()
+        slow.clear()
+        started = time.time()
+        self.assertRaises(BridgeSendTimeout, supervisor.take, deadline=started + .1)
+        self.assertTrue(time.time() - started < .5)
+        slow.set()
+        process, framing, capabilities, version = supervisor.take(deadline=time.time() + 5)
+        self.assertEqual(process.poll(), None)
+        supervisor.close()
+    
+    def test_waiting_caller_sees_spawn_failure(self):
+        spawned = []
+        def spawn():
+            spawned.append(None)
+            if len(spawned) > 1:
+                raise OSError('ruby not found')
+            return FakeProcess(), None, {}, 0
+        supervisor = BridgeSupervisor(spawn, standby=False)
+        supervisor.take()
+        self.assertRaises(BridgeError, supervisor.take)
+        supervisor.close()
+
+class TestBatch(unittest.TestCase):
+    def capture(self, authorization):
+        return {'gateway':'test',
+                'action':'capture',
+                'data':{},
+                'secure_data':{'money':'100', 'authorization':authorization},}
+    
+    def check_results(self, results):
+        self.assertEqual(len(results), 5)
+        self.assertTrue(results[0]['success'], results[0]['message'])
+        self.assertFalse(results[1]['success'], results[1]['message'])
+        self.assertTrue(results[2]['success'], results[2]['message'])
+        #partial failures come back in place
+        self.assertEqual(results[3]['message'], 'Unrecognized gateway')
+        self.assertEqual(results[4]['message'], 'Missing required parameter: money')
+    
+    def items(self):
+        missing_money = self.capture('3')
+        del missing_money['secure_data']['money']
+        return [self.capture('3'), self.capture('2'), self.capture('4'),
+                dict(self.capture('3'), gateway='missing'), missing_money]
+    
+    def test_send_many(self):
+        bridge = Bridge(environ=BOGUS_ENVIRON, standby=False)
+        try:
+            self.check_results(bridge.send_many(self.items(), concurrency=3))
+            self.assertEqual(bridge.send_many([]), [])
+        finally:
+            bridge.close()
+    
+    def test_send_many_multiplexed(self):
+        bridge = MultiplexedBridge(threads=2, environ=BOGUS_ENVIRON, standby=False)
+        try:
+            self.check_results(bridge.send_many(self.items(), concurrency=1))
+        finally:
+            bridge.close()
+
+class TestCapabilities(unittest.TestCase):
+    def test_bridge_reports_capabilities(self):
+        bridge = Bridge(environ=BOGUS_ENVIRON, standby=False)
+        try:
+            self.assertEqual(list(bridge.capabilities.keys()), ['test'])
+            self.assertTrue('authorize' in bridge.capabilities['test'])
+            self.assertFalse('retrieve' in bridge.capabilities['test'])
+        finally:
+            bridge.close()
+    
+    def test_unsupported_requests_rejected_locally(self):
+        application = BaseTestDirectPostApplication(redirect_to='http://localhost:8080/direct-post/',
+            gateway={'module':'bogus', 'name':'test', 'params':{}})
+        try:
+            self.assertEqual(application.check_supported('test', 'authorize'), None)
+            response = application.check_supported('test', 'retrieve')
+            self.assertFalse(response['success'])
+            self.assertEqual(response['message'], 'Unrecognized Action')
+            response = application.check_supported('missing', 'authorize')
+            self.assertEqual(response['message'], 'Unrecognized gateway')
+        finally:
+            application.shutdown()
+
+class TestConfigure(unittest.TestCase):
+    def authorize(self, bridge, gateway):
+        return bridge.send(gateway=gateway, action='capture', data={},
+                           secure_data={'money':'100', 'authorization':'3'})
+    
+    def test_gateways_change_while_running(self):
+        bridge = Bridge(environ=BOGUS_ENVIRON, standby=False)
+        try:
+            capabilities = bridge.configure(add=[{'module':'bogus', 'name':'other', 'params':{}}], remove=['test'])
+            self.assertEqual(list(capabilities.keys()), ['other'])
+            self.assertEqual(bridge.capabilities, capabilities)
+            self.assertTrue(self.authorize(bridge, 'other')['success'])
+            self.assertEqual(self.authorize(bridge, 'test')['message'], 'Unrecognized gateway')
+            
+            #a replacement process gets the same gateways
+            bridge.abort(bridge.slave)
+            bridge.slave.wait()
+            response = self.authorize(bridge, 'other')
+            self.assertTrue(response['success'], response['message'])
+            self.assertEqual(list(bridge.capabilities.keys()), ['other'])
+            self.assertEqual(self.authorize(bridge, 'test')['message'], 'Unrecognized gateway')
+        finally:
+            bridge.close()
+    
+    def test_gateways_sent_over_channel(self):
+        gateways = [{'module':'bogus', 'name':'merchant-%s' % index, 'params':{}} for index in range(5)]
+        bridge = MultiplexedBridge(threads=2, environ={}, gateways=gateways, standby=False)
+        try:
+            self.assertEqual(sorted(bridge.capabilities.keys()), sorted(gateway['name'] for gateway in gateways))
+            self.assertTrue(self.authorize(bridge, 'merchant-4')['success'])
+        finally:
+            bridge.close()
+    
+    def test_replay_messages(self):
+        configuration = GatewayConfiguration([{'name':'a'}, {'name':'b'}, {'name':'c'}])
+        configuration.chunk_size = 2
+        configuration.update(add=[{'name':'d'}], remove=['a', 'old'])
+        version, messages = configuration.replay_messages()
+        self.assertEqual(version, 1)
+        self.assertEqual([[config['name'] for config in message['add']] for message in messages], [['b', 'c'], ['d'], []])
+        self.assertEqual(messages[-1]['remove'], ['a', 'old'])
+
+class MerchantDirectPostApplication(BaseTestDirectPostApplication):
+    bridge_gateway_cache_size = 2
+    
+    def decrypt_data(self, encrypted_data):
+        return encrypted_data
+    
+    def encrypt_data(self, params):
+        return params
+    
+    def load_merchant_gateway(self, merchant):
+        return {'module':'bogus', 'params':{'login':merchant}}
+
+class TestMerchantGateways(unittest.TestCase):
+    def setUp(self):
+        self.application = MerchantDirectPostApplication(redirect_to='http://localhost:8080/direct-post/',
+            gateway={'module':'bogus', 'name':'test', 'params':{}})
+    
+    def tearDown(self):
+        self.application.shutdown()
+    
+    def capture(self, merchant):
+        secure_data = {'merchant':merchant, 'action':'capture', 'money':'100', 'authorization':'3'}
+        return self.application.process_direct_post({'payload':secure_data})['url_params']['payload']
+    
+    def test_gateways_built_per_credentials(self):
+        for merchant in ['m1', 'm2', 'm1', 'm3', 'm1', 'm2']:
+            response = self.capture(merchant)
+            self.assertTrue(response['success'], response['message'])
+            self.assertEqual(response['gateway'], 'bogus')
+            self.assertFalse('gateway_cache' in response)
+        
+        #m2 was pushed out by m3, m1 stayed in use
+        text = self.application.metrics.render()
+        self.assertTrue('payment_bridge_gateway_cache_total{result="hit"} 2' in text, text)
+        self.assertTrue('payment_bridge_gateway_cache_total{result="miss"} 4' in text, text)
+        self.assertTrue('payment_bridge_gateway_cache_total{result="eviction"} 2' in text, text)
+        self.assertTrue('payment_bridge_requests_total{gateway="bogus",action="capture",outcome="success"} 6' in text, text)
+
+class TestZygote(unittest.TestCase):
+    def setUp(self):
+        self.zygote = Zygote()
+    
+    def tearDown(self):
+        self.zygote.close()
+    
+    def capture(self, bridge):
+        return bridge.send(gateway='test', action='capture', data={}, secure_data={'money':'100', 'authorization':'3'})
+    
+    def test_forked_bridge_recovers_from_crash(self):
+        bridge = Bridge(environ=BOGUS_ENVIRON, zygote=self.zygote)
+        try:
+            self.assertEqual(list(bridge.capabilities.keys()), ['test'])
+            self.assertTrue(self.capture(bridge)['success'])
+            first = bridge.slave
+            bridge.abort(first)
+            first.wait()
+            self.assertTrue(self.capture(bridge)['success'])
+            self.assertNotEqual(bridge.slave.pid, first.pid)
+        finally:
+            bridge.close()
+        self.assertTrue(bridge.slave.poll() is not None)
+    
+    def test_multiplexed(self):
+        bridge = MultiplexedBridge(threads=4, environ=BOGUS_ENVIRON, zygote=self.zygote, standby=False)
+        try:
+            self.assertTrue(self.capture(bridge)['success'])
+        finally:
+            bridge.close()
+
+class TestFraming(unittest.TestCase):
+    message = {'request_id':7,
+               'data':{'bill_first_name':u'\uc548\ub155\n', 'cc_number':'1'},
+               'success':True,}
+    
+    def roundtrip(self, framing):
+        stream = BytesIO(framing.encode(self.message) + framing.encode(self.message))
+        self.assertEqual(framing.read(stream), self.message)
+        self.assertEqual(framing.read(stream), self.message)
+        self.assertEqual(framing.read(stream), None)
+    
+    def test_json(self):
+        self.roundtrip(FRAMINGS['json'])
+    
+    @unittest.skipIf('msgpack' not in FRAMINGS, 'msgpack is not installed')
+    def test_msgpack(self):
+        self.roundtrip(FRAMINGS['msgpack'])
+    
+    @unittest.skipIf('msgpack' not in FRAMINGS, 'msgpack is not installed')
+    def test_msgpack_truncated(self):
+        framing = FRAMINGS['msgpack']
+        stream = BytesIO(framing.encode(self.message)[:-1])
+        self.assertRaises(FramingError, framing.read, stream)
+    
+    def test_bridge_negotiates_framing(self):
+        bridge = Bridge(environ=BOGUS_ENVIRON, framing='msgpack')
+        try:
+            self.assertTrue(bridge.framing.name in ('msgpack', 'json'))
+            secure_data = {'money':'100',
+                           'authorization':'3',}
+            response = bridge.send(data={}, secure_data=secure_data, gateway='test', action='capture')
+            self.assertTrue(response['success'], response['message'])
+        finally:
+            bridge.close()
+
+class TestSocketBridge(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'bridge.sock')
+        self.daemon = Popen([RUBY_PATH, SCRIPT_PATH, '--socket', self.socket_path, '--threads', '4'], env=BOGUS_ENVIRON)
+        wait_for(self.daemon_listening, timeout=30)
+    
+    def daemon_listening(self):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.socket_path)
+        except socket.error:
+            return False
+        finally:
+            probe.close()
+        return True
+    
+    def tearDown(self):
+        self.daemon.terminate()
+        self.daemon.wait()
+        shutil.rmtree(self.directory)
+    
+    def test_clients_share_daemon(self):
+        clients = [SocketBridge(self.socket_path, max_in_flight=4) for index in range(2)]
+        try:
+            for client in clients:
+                secure_data = {'money':'100',
+                               'authorization':'3',}
+                response = client.send(data={}, secure_data=secure_data, gateway='test', action='capture')
+                self.assertTrue(response['success'], response['message'])
+                
+                secure_data['authorization'] = '2'
+                response = client.send(data={}, secure_data=secure_data, gateway='test', action='capture')
+                self.assertFalse(response['success'], response['message'])
+        finally:
+            for client in clients:
+                client.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from payment_bridge.bulk import BulkRunner, main, read_operations
+from payment_bridge.wsgi import BridgeSendTimeout
+
+
+class RecordingBridge(object):
+    def __init__(self, fail_on=(), error=BridgeSendTimeout):
+        self.sent = []
+        self.fail_on = fail_on
+        self.error = error
+    
+    def send(self, deadline=None, **kwargs):
+        self.sent.append(kwargs['secure_data']['authorization'])
+        if kwargs['secure_data']['authorization'] in self.fail_on:
+            raise self.error('Timed out waiting for the bridge')
+        return {'success':kwargs['secure_data']['authorization'] != '2',
+                'message':'ok',
+                'request_id':1,}
+
+class TestBulk(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.directory, 'settlements.jsonl')
+        self.output_path = os.path.join(self.directory, 'results.jsonl')
+        outfile = open(self.input_path, 'w')
+        for index, authorization in enumerate(['3', '2', '4', '5']):
+            outfile.write(json.dumps({'id':'order-%s' % index,
+                                      'gateway':'test',
+                                      'action':'capture',
+                                      'secure_data':{'money':'100', 'authorization':authorization},}) + '\n')
+        outfile.write(json.dumps({'id':'order-4', 'gateway':'test', 'action':'purchase'}) + '\n')
+        outfile.close()
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def read_results(self):
+        results = dict()
+        for line in open(self.output_path):
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            results[result['id']] = result
+        return results
+    
+    def test_run(self):
+        bridge = RecordingBridge(fail_on=['5'])
+        stats = BulkRunner(bridge, self.output_path, concurrency=3).run(read_operations(self.input_path))
+        self.assertEqual(stats, {'succeeded':2, 'failed':3, 'skipped':0, 'interrupted':0})
+        results = self.read_results()
+        self.assertTrue(results['order-0']['success'])
+        self.assertFalse(results['order-1']['success'])
+        self.assertFalse(results['order-3']['outcome_unknown'])
+        self.assertEqual(results['order-4']['message'], 'Unsupported bulk action: purchase')
+        self.assertFalse('request_id' in results['order-0'])
+        self.assertEqual(sorted(bridge.sent), ['2', '3', '4', '5'])
+    
+    def test_unexpected_error(self):
+        #a single worker that died would leave the rest of the file unread
+        bridge = RecordingBridge(fail_on=['3', '2', '4'], error=RuntimeError)
+        stats = BulkRunner(bridge, self.output_path, concurrency=1).run(read_operations(self.input_path))
+        self.assertEqual(stats, {'succeeded':1, 'failed':4, 'skipped':0, 'interrupted':0})
+        results = self.read_results()
+        self.assertTrue(results['order-0']['outcome_unknown'])
+        self.assertTrue(results['order-3']['success'])
+    
+    def test_resume_never_resends_started_operations(self):
+        #a previous run finished order-0 and crashed while order-1 was in flight
+        outfile = open(self.output_path, 'w')
+        outfile.write(json.dumps({'id':'order-0', 'success':True}) + '\n')
+        outfile.write('{"id": "order-2", "succ')
+        outfile.close()
+        outfile = open(self.output_path + '.checkpoint', 'w')
+        outfile.write('"order-0"\n"order-1"\n')
+        outfile.close()
+        
+        bridge = RecordingBridge()
+        stats = BulkRunner(bridge, self.output_path).run(read_operations(self.input_path))
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['interrupted'], 1)
+        self.assertEqual(sorted(bridge.sent), ['4', '5'])
+        results = self.read_results()
+        self.assertTrue(results['order-1']['outcome_unknown'])
+        self.assertTrue(results['order-2']['success'])
+    
+    def test_resume_resends_unsent_operations(self):
+        bridge = RecordingBridge(fail_on=['5'])
+        BulkRunner(bridge, self.output_path).run(read_operations(self.input_path))
+        self.assertTrue(self.read_results()['order-3']['retry'])
+        
+        bridge = RecordingBridge()
+        stats = BulkRunner(bridge, self.output_path).run(read_operations(self.input_path))
+        self.assertEqual(stats, {'succeeded':1, 'failed':0, 'skipped':4, 'interrupted':0})
+        self.assertEqual(bridge.sent, ['5'])
+        self.assertTrue(self.read_results()['order-3']['success'])
+    
+    def test_resume_never_resends_unsent_operations_started_again(self):
+        BulkRunner(RecordingBridge(fail_on=['5']), self.output_path).run(read_operations(self.input_path))
+        #a second run started order-3 again and crashed, so it may have been sent this time
+        outfile = open(self.output_path + '.checkpoint', 'a')
+        outfile.write('"order-3"\n')
+        outfile.close()
+        
+        bridge = RecordingBridge()
+        stats = BulkRunner(bridge, self.output_path).run(read_operations(self.input_path))
+        self.assertEqual(stats['interrupted'], 1)
+        self.assertEqual(bridge.sent, [])
+        self.assertTrue(self.read_results()['order-3']['outcome_unknown'])
+    
+    def test_csv(self):
+        input_path = os.path.join(self.directory, 'settlements.csv')
+        outfile = open(input_path, 'w')
+        outfile.write('id,gateway,action,money,authorization,order_number\n')
+        outfile.write('order-0,test,refund,100,3,A1\n')
+        outfile.close()
+        operations = list(read_operations(input_path))
+        self.assertEqual(operations, [{'id':'order-0',
+                                       'gateway':'test',
+                                       'action':'refund',
+                                       'secure_data':{'money':'100', 'authorization':'3'},
+                                       'data':{'order_number':'A1'},}])
+    
+    def test_main_with_bogus_gateway(self):
+        config_path = os.path.join(self.directory, 'gateways.json')
+        outfile = open(config_path, 'w')
+        json.dump([{'module':'bogus', 'name':'test', 'params':{}}], outfile)
+        outfile.close()
+        self.assertEqual(main(['--config', config_path, '--workers', '1', '--threads', '2',
+                               self.input_path, self.output_path]), 0)
+        results = self.read_results()
+        self.assertEqual(len(results), 5)
+        self.assertTrue(results['order-0']['success'], results['order-0']['message'])
+        self.assertFalse(results['order-1']['success'], results['order-1']['message'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from payment_bridge.tests.common import BaseGatewayTestCase, start_gateway_simulator
+
+
+simulators = []
+
+def get_simulator():
+    #one benchmarks/gateway_simulator.py for every test here
+    if not simulators:
+        simulators.append(start_gateway_simulator(decline_cards=['2']))
+    return simulators[0]
+
+class SimulatorTestCase(BaseGatewayTestCase):
+    """
+    Runs a compat gateway against the gateway simulator to check that it
+    understands the simulator's responses
+    """
+    path = '/'
+    params = {}
+    
+    def read_gateway_params(self):
+        self.simulator = get_simulator()
+        if self.simulator is None:
+            return None
+        params = dict(self.params)
+        params['url'] = 'http://localhost:%s%s' % (self.simulator.server_address[1], self.path)
+        return params
+
+class TestSimulatedAuthorizeNetCIM(SimulatorTestCase):
+    gateway = {
+        'module':'authorize_net_cim_compat',
+        'name':'test',
+    }
+    path = '/xml/v1/request.api'
+    params = {
+        'login':'simulator',
+        'password':'simulator',
+        'test':True,
+    }
+    
+    def test_authorize_and_capture(self):
+        self.checkGatewaySupport('authorize')
+        bill_info = self.data_source.get_all_info()
+        response = self.application.call_bridge(data=bill_info, secure_data={'money':'100'}, gateway='test', action='authorize')
+        self.assertTrue(response['success'], response['message'])
+        trans_id, profile_id, payment_profile_id, address_id = response['authorization'].split(';')
+        self.assertTrue(trans_id in self.simulator.state.cim_transactions)
+        self.assertTrue(payment_profile_id in self.simulator.state.cim_profiles[profile_id]['payment_profiles'])
+        
+        secure_data = {'money':'100', 'authorization':response['authorization']}
+        response = self.application.call_bridge(data={}, secure_data=secure_data, gateway='test', action='capture')
+        self.assertTrue(response['success'], response['message'])
+    
+    def test_authorize_declined(self):
+        self.checkGatewaySupport('authorize')
+        bill_info = self.data_source.get_all_info()
+        bill_info['cc_number'] = '2'
+        response = self.application.call_bridge(data=bill_info, secure_data={'money':'100'}, gateway='test', action='authorize')
+        self.assertFalse(response['success'], response['message'])
+
+class TestSimulatedOrbital(SimulatorTestCase):
+    gateway = {
+        'module':'orbital_compat',
+        'name':'test',
+    }
+    path = '/authorize'
+    params = {
+        'login':'simulator',
+        'password':'simulator',
+        'merchant_id':'000000',
+        'test':True,
+    }
+    
+    def test_authorize(self):
+        self.checkGatewaySupport('authorize')
+        bill_info = self.data_source.get_all_info()
+        secure_data = {'money':'100', 'order_id':'ABCDEF'}
+        response = self.application.call_bridge(data=bill_info, secure_data=secure_data, gateway='test', action='authorize')
+        self.assertTrue(response['success'], response['message'])
+        self.assertTrue(response['authorization'])
+    
+    def test_authorize_declined(self):
+        self.checkGatewaySupport('authorize')
+        bill_info = self.data_source.get_all_info()
+        bill_info['cc_number'] = '2'
+        secure_data = {'money':'100', 'order_id':'ABCDEF'}
+        response = self.application.call_bridge(data=bill_info, secure_data=secure_data, gateway='test', action='authorize')
+        self.assertFalse(response['success'], response['message'])
+
+if __name__ == '__main__':
+    unittest.main()
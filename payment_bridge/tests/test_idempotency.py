@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+from io import BytesIO
+from threading import Thread
+import sys
+import time
+import unittest
+
+from payment_bridge.framing import FramingError
+from payment_bridge.idempotency import DuplicateRequestPending, IdempotencyCache
+from payment_bridge.wsgi import Bridge, BridgeResponseTimeout, BridgeSendTimeout, parse_qs, urlencode
+from payment_bridge.tests.common import BaseTestDirectPostApplication
+
+
+#reads one request and exits without answering, like a bridge crashing mid payment
+DYING_SCRIPT = '''import sys
+sys.stdout.write('{"type": "capabilities", "capabilities": {"test": ["capture"]}, "request_id": null}\\n')
+sys.stdout.flush()
+sys.stdin.readline()'''
+
+class DyingBridge(Bridge):
+    def get_command(self):
+        return [sys.executable, '-c', DYING_SCRIPT]
+
+class DictCache(object):
+    """
+    The parts of the django cache interface a shared backend needs
+    """
+    def __init__(self):
+        self.values = dict()
+    
+    def add(self, key, value, timeout=None):
+        if key in self.values:
+            return False
+        self.values[key] = value
+        return True
+    
+    def get(self, key):
+        return self.values.get(key)
+    
+    def set(self, key, value, timeout=None):
+        self.values[key] = value
+    
+    def delete(self, key):
+        self.values.pop(key, None)
+
+class IdempotentDirectPostApplication(BaseTestDirectPostApplication):
+    idempotency_cache_size = 16
+    derive_idempotency_keys = True
+    
+    def __init__(self, **kwargs):
+        self.bridge_calls = 0
+        self.bridge_timeouts = 0
+        super(IdempotentDirectPostApplication, self).__init__(**kwargs)
+    
+    def call_bridge(self, **kwargs):
+        self.bridge_calls += 1
+        if self.bridge_timeouts:
+            self.bridge_timeouts -= 1
+            raise BridgeResponseTimeout('Timed out waiting for the bridge to respond')
+        return super(IdempotentDirectPostApplication, self).call_bridge(**kwargs)
+
+class DyingDirectPostApplication(IdempotentDirectPostApplication):
+    def construct_bridge(self):
+        return DyingBridge(standby=False, metrics=self.metrics)
+
+class TestIdempotencyCache(unittest.TestCase):
+    def test_replays_finished_result(self):
+        cache = IdempotencyCache()
+        self.assertEqual(cache.begin('a'), None)
+        cache.finish('a', {'url_params':{}})
+        self.assertEqual(cache.begin('a'), {'url_params':{}})
+    
+    def test_abandoned_key_can_be_retried(self):
+        cache = IdempotencyCache()
+        self.assertEqual(cache.begin('a'), None)
+        cache.abandon('a')
+        self.assertEqual(cache.begin('a'), None)
+    
+    def test_ttl_and_eviction(self):
+        cache = IdempotencyCache(max_entries=2, ttl=60)
+        for key in ['a', 'b', 'c']:
+            cache.begin(key)
+            cache.finish(key, key)
+        self.assertEqual(cache.begin('a'), None)
+        self.assertEqual(cache.begin('c'), 'c')
+        cache.ttl = -1
+        cache.finish('d', 'd')
+        self.assertEqual(cache.begin('d'), None)
+    
+    def test_duplicate_waits_for_in_flight_request(self):
+        cache = IdempotencyCache()
+        cache.begin('a')
+        results = []
+        waiter = Thread(target=lambda: results.append(cache.begin('a')))
+        waiter.start()
+        time.sleep(.05)
+        self.assertEqual(results, [])
+        cache.finish('a', 'done')
+        waiter.join(5)
+        self.assertEqual(results, ['done'])
+    
+    def test_deadline_while_in_flight(self):
+        cache = IdempotencyCache()
+        cache.begin('a')
+        self.assertRaises(DuplicateRequestPending, cache.begin, 'a', time.time() + .05)
+    
+    def test_shared_backend(self):
+        backend = DictCache()
+        first = IdempotencyCache(backend=backend)
+        second = IdempotencyCache(backend=backend)
+        self.assertEqual(first.begin('a'), None)
+        self.assertRaises(DuplicateRequestPending, second.begin, 'a', time.time() + .1)
+        first.finish('a', 'done')
+        self.assertEqual(second.begin('a'), 'done')
+
+class TestIdempotentApplication(unittest.TestCase):
+    def setUp(self):
+        self.application = IdempotentDirectPostApplication(redirect_to='http://localhost:8080/direct-post/')
+    
+    def tearDown(self):
+        self.application.shutdown()
+    
+    def post(self, params, expected_status='303 SEE OTHER'):
+        body = urlencode(params).encode('ascii')
+        statuses = []
+        self.headers = None
+        def start_response(status, headers):
+            statuses.append(status)
+            self.headers = dict(headers)
+        response = self.application({'REQUEST_METHOD':'POST',
+                                     'CONTENT_LENGTH':str(len(body)),
+                                     'wsgi.input':BytesIO(body),},
+                                    start_response)
+        self.assertEqual(statuses, [expected_status])
+        #WSGI bodies are bytes, counted in bytes
+        self.assertTrue(isinstance(response[0], bytes))
+        self.assertEqual(int(self.headers['Content-Length']), len(response[0]))
+        return response[0].decode('utf-8')
+    
+    def test_duplicate_post_is_replayed(self):
+        secure_data = {'gateway':'test', 'action':'capture', 'money':'100', 'authorization':'3'}
+        params = {'payload':self.application.encrypt_data(secure_data)}
+        first = self.post(params)
+        self.assertEqual(self.post(params), first)
+        self.assertEqual(self.application.bridge_calls, 1)
+        self.assertTrue('payment_bridge_replays_total 1' in self.application.metrics.render())
+        
+        #a different charge goes through
+        self.post(dict(params, order_number='2'))
+        self.assertEqual(self.application.bridge_calls, 2)
+    
+    def test_explicit_key(self):
+        self.application.derive_idempotency_keys = False
+        secure_data = {'gateway':'test', 'action':'capture', 'money':'100', 'authorization':'3'}
+        self.post({'payload':self.application.encrypt_data(secure_data)})
+        self.post({'payload':self.application.encrypt_data(secure_data)})
+        self.assertEqual(self.application.bridge_calls, 2)
+        
+        secure_data['idempotency_key'] = 'order-1'
+        self.post({'payload':self.application.encrypt_data(secure_data)})
+        self.post({'payload':self.application.encrypt_data(secure_data), 'order_number':'2'})
+        self.assertEqual(self.application.bridge_calls, 3)
+    
+    def test_timed_out_request_is_not_repeated(self):
+        self.application.bridge_timeouts = 1
+        secure_data = {'gateway':'test', 'action':'capture', 'money':'100', 'authorization':'3'}
+        params = {'payload':self.application.encrypt_data(secure_data)}
+        self.assertRaises(BridgeResponseTimeout, self.post, params)
+        replay = self.post(params)
+        self.assertEqual(self.application.bridge_calls, 1)
+        response = self.application.decrypt_data(parse_qs(replay.split('?', 1)[1])['payload'][0])
+        self.assertTrue(response['outcome_unknown'])
+        self.assertFalse(response['success'])
+    
+    def test_send_timeout_releases_key(self):
+        secure_data = {'gateway':'test', 'action':'capture', 'money':'100', 'authorization':'3'}
+        params = {'payload':self.application.encrypt_data(secure_data)}
+        self.application.bridge.lock.acquire()
+        self.application.bridge_timeout = .1
+        try:
+            self.assertRaises(BridgeSendTimeout, self.post, params)
+        finally:
+            self.application.bridge.lock.release()
+        self.post(params)
+        self.assertEqual(self.application.bridge_calls, 2)
+    
+    def test_duplicate_in_flight_gets_conflict(self):
+        self.application.bridge_timeout = .1
+        secure_data = {'gateway':'test', 'action':'capture', 'money':'100', 'authorization':'3'}
+        params = {'payload':self.application.encrypt_data(secure_data)}
+        bridge_kwargs = self.application.read_direct_post(params)
+        self.application.idempotency.begin(self.application.get_idempotency_key(bridge_kwargs))
+        self.post(params, expected_status='409 CONFLICT')
+        self.assertEqual(self.headers['Retry-After'], '1')
+        self.assertEqual(self.application.bridge_calls, 0)
+
+class TestBridgeDiesMidRequest(unittest.TestCase):
+    def setUp(self):
+        self.application = DyingDirectPostApplication(redirect_to='http://localhost:8080/direct-post/')
+    
+    def tearDown(self):
+        self.application.shutdown()
+    
+    def test_retry_is_replayed_not_resent(self):
+        secure_data = {'gateway':'test', 'action':'capture', 'money':'100', 'authorization':'3'}
+        caller_data = {'payload':self.application.encrypt_data(secure_data)}
+        self.assertRaises(FramingError, self.application.process_direct_post, caller_data)
+        result = self.application.process_direct_post(caller_data)
+        self.assertEqual(self.application.bridge_calls, 1)
+        response = self.application.decrypt_data(result['url_params']['payload'])
+        self.assertTrue(response['outcome_unknown'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from payment_bridge.metrics import BridgeMetrics, Histogram, MetricsApplication
+from payment_bridge.wsgi import DirectPostMiddleware
+from payment_bridge.tests.common import BaseTestDirectPostApplication
+
+
+class TestHistogram(unittest.TestCase):
+    def test_render_is_cumulative(self):
+        histogram = Histogram((.1, 1))
+        histogram.observe(.05)
+        histogram.observe(.1)
+        histogram.observe(.5)
+        histogram.observe(5)
+        self.assertEqual(histogram.render('latency', (('gateway', 'test'),)),
+            ['latency_bucket{gateway="test",le="0.1"} 2',
+             'latency_bucket{gateway="test",le="1"} 3',
+             'latency_bucket{gateway="test",le="+Inf"} 4',
+             'latency_sum{gateway="test"} 5.65',
+             'latency_count{gateway="test"} 4'])
+
+class TestBridgeMetrics(unittest.TestCase):
+    def setUp(self):
+        self.application = BaseTestDirectPostApplication(redirect_to='http://localhost:8080/direct-post/',
+            gateway={'module':'bogus', 'name':'test', 'params':{}})
+    
+    def tearDown(self):
+        self.application.shutdown()
+    
+    def capture(self, secure_data):
+        return self.application.call_bridge(data={}, secure_data=secure_data, gateway='test', action='capture')
+    
+    def test_outcomes_and_waits_are_recorded(self):
+        self.capture({'money':'100', 'authorization':'3'})
+        self.capture({'money':'100', 'authorization':'2'})
+        self.capture({'authorization':'3'})
+        
+        text = self.application.metrics.render()
+        self.assertTrue('payment_bridge_requests_total{gateway="test",action="capture",outcome="success"} 1' in text, text)
+        self.assertTrue('payment_bridge_requests_total{gateway="test",action="capture",outcome="failure"} 1' in text, text)
+        self.assertTrue('payment_bridge_requests_total{gateway="test",action="capture",outcome="exception"} 1' in text, text)
+        self.assertTrue('payment_bridge_request_seconds_count{gateway="test",action="capture"} 3' in text, text)
+        self.assertTrue('payment_bridge_wait_seconds_count{wait="lock"} 3' in text, text)
+        self.assertTrue('payment_bridge_in_flight 0' in text, text)
+        self.assertTrue('payment_bridge_restarts_total 0' in text, text)
+    
+    def test_mounted_through_middleware(self):
+        def main_application(environ, start_response):
+            start_response('404 NOT FOUND', [])
+            return [b'']
+        application = DirectPostMiddleware(main_application, MetricsApplication(self.application.metrics), '/metrics')
+        statuses = []
+        body = application({'PATH_INFO':'/metrics'}, lambda status, headers: statuses.append(status))
+        self.assertEqual(statuses, ['200 OK'])
+        self.assertTrue(b'# TYPE payment_bridge_in_flight gauge' in b''.join(body))
+    
+    def test_off_unless_collected(self):
+        class QuietApplication(BaseTestDirectPostApplication):
+            collect_metrics = False
+        application = QuietApplication(redirect_to='http://localhost:8080/direct-post/')
+        try:
+            self.assertEqual(application.metrics, None)
+            response = application.call_bridge(data={}, secure_data={'money':'100', 'authorization':'3'}, gateway='test', action='capture')
+            self.assertTrue(response['success'], response['message'])
+        finally:
+            application.shutdown()
+    
+    def test_render_before_any_request(self):
+        metrics = BridgeMetrics()
+        self.assertTrue('payment_bridge_in_flight 0' in metrics.render())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from payment_bridge.payloads import SERIALIZERS, BadPayload, DjangoSigningCodec, SignedCodec
+from payment_bridge.tests.common import PaymentData
+from payment_bridge.wsgi import BaseDirectPostApplication
+
+
+class CodecDirectPostApplication(BaseDirectPostApplication):
+    def load_gateways_config(self):
+        return [{'module':'bogus', 'name':'test', 'params':{}}]
+    
+    def construct_codec(self):
+        return SignedCodec('secret')
+
+class TestSignedCodec(unittest.TestCase):
+    def setUp(self):
+        self.params = PaymentData().get_all_info()
+        self.params['bill_first_name'] = u'안녕하'
+        self.params['money'] = 100
+    
+    def test_round_trip(self):
+        for serializer in SERIALIZERS:
+            for compress in (True, False):
+                codec = SignedCodec('secret', serializer=serializer, compress=compress)
+                payload = codec.dumps(self.params)
+                self.assertEqual(codec.loads(payload), self.params)
+                self.assertEqual(payload, payload.encode('ascii').decode('ascii'))
+    
+    def test_compression_only_when_smaller(self):
+        codec = SignedCodec('secret', serializer='json')
+        self.assertTrue(codec.dumps(self.params).startswith('jz'))
+        self.assertTrue(codec.dumps({'a':1}).startswith('j'))
+        self.assertFalse(codec.dumps({'a':1}).startswith('jz'))
+        self.assertTrue(len(codec.dumps(self.params)) < len(SignedCodec('secret', serializer='json', compress=False).dumps(self.params)))
+    
+    def test_reads_other_settings(self):
+        writer = SignedCodec('secret', serializer='json', compress=False)
+        reader = SignedCodec('secret')
+        self.assertEqual(reader.loads(writer.dumps(self.params)), self.params)
+    
+    def test_tampering(self):
+        codec = SignedCodec('secret', salt='one')
+        payload = codec.dumps({'money':'100'})
+        value, signature = payload.rsplit('.', 1)
+        self.assertRaises(BadPayload, codec.loads, 'x' + value[1:] + '.' + signature)
+        self.assertRaises(BadPayload, codec.loads, value)
+        self.assertRaises(BadPayload, SignedCodec('other', salt='one').loads, payload)
+        self.assertRaises(BadPayload, SignedCodec('secret', salt='two').loads, payload)
+        self.assertRaises(BadPayload, codec.loads, u'안녕.하세요')
+
+class TestDjangoSigningCodec(unittest.TestCase):
+    def setUp(self):
+        try:
+            from django.conf import settings
+            from django.core import signing
+        except ImportError:
+            self.skipTest('Django is not installed')
+        if not settings.configured:
+            settings.configure(SECRET_KEY='secret')
+        self.signing = signing
+    
+    def test_compatible_with_signing(self):
+        codec = DjangoSigningCodec(salt='payment_bridge.wsgi')
+        params = {'money':'100', 'gateway':'test'}
+        self.assertEqual(self.signing.loads(codec.dumps(params), salt='payment_bridge.wsgi'), params)
+        self.assertEqual(codec.loads(self.signing.dumps(params, salt='payment_bridge.wsgi')), params)
+        self.assertRaises(self.signing.BadSignature, codec.loads, self.signing.dumps(params, salt='other'))
+    
+    def test_reads_the_current_secret_key(self):
+        from django.test.utils import override_settings
+        codec = DjangoSigningCodec(salt='payment_bridge.wsgi')
+        params = {'money':'100', 'gateway':'test'}
+        with override_settings(SECRET_KEY='rotated'):
+            payload = codec.dumps(params)
+            self.assertEqual(self.signing.loads(payload, salt='payment_bridge.wsgi'), params)
+        self.assertRaises(self.signing.BadSignature, codec.loads, payload)
+
+class TestCodecApplication(unittest.TestCase):
+    def setUp(self):
+        self.application = CodecDirectPostApplication(redirect_to='http://localhost:8080/direct-post/')
+    
+    def tearDown(self):
+        self.application.shutdown()
+    
+    def test_direct_post(self):
+        caller_data = PaymentData().get_all_info()
+        caller_data['cc_number'] = '1'
+        caller_data['payload'] = self.application.encrypt_data({'gateway':'test', 'action':'authorize', 'money':'100'})
+        result = self.application.process_direct_post(caller_data)
+        response = self.application.decrypt_data(result['url_params']['payload'])
+        self.assertTrue(response['success'], response['message'])
+        self.assertEqual(response['bill_first_name'], 'John')
+    
+    def test_tampered_payload(self):
+        payload = SignedCodec('other').dumps({'gateway':'test', 'action':'authorize', 'money':'100'})
+        self.assertRaises(BadPayload, self.application.process_direct_post, {'payload':payload})
+
+if __name__ == '__main__':
+    unittest.main()
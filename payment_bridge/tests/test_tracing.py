@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+
+from payment_bridge.tracing import RequestTrace
+from payment_bridge.wsgi import urlencode
+from payment_bridge.tests.common import BaseTestDirectPostApplication
+
+
+class TracedDirectPostApplication(BaseTestDirectPostApplication):
+    trace_requests = True
+    server_timing = True
+    
+    def __init__(self, **kwargs):
+        self.traces = []
+        super(TracedDirectPostApplication, self).__init__(**kwargs)
+    
+    def record_trace(self, trace):
+        self.traces.append(trace)
+
+class TestRequestTrace(unittest.TestCase):
+    def test_bridge_timing(self):
+        trace = RequestTrace()
+        trace.add('decrypt', .001)
+        trace.add_bridge_timing(.5, {'prepare':.01, 'gateway':.4, 'callback':.02, 'total':.45})
+        self.assertEqual(trace.server_timing(),
+            'decrypt;dur=1.000, bridge;dur=500.000, ruby-prepare;dur=10.000, ruby-gateway;dur=400.000, '
+            'ruby-callback;dur=20.000, ruby-total;dur=450.000, ipc;dur=50.000')
+
+class TestTracedApplication(unittest.TestCase):
+    def setUp(self):
+        self.application = TracedDirectPostApplication(redirect_to='http://localhost:8080/direct-post/')
+    
+    def tearDown(self):
+        self.application.shutdown()
+    
+    def test_jsonp_request_is_traced(self):
+        secure_data = {'gateway':'test', 'action':'capture', 'money':'100', 'authorization':'3'}
+        query = urlencode({'callback':'done', 'payload':self.application.encrypt_data(secure_data)})
+        headers = dict()
+        def start_response(status, response_headers):
+            headers.update(response_headers)
+        body = self.application({'REQUEST_METHOD':'GET', 'QUERY_STRING':query}, start_response)[0].decode('utf-8')
+        
+        self.assertEqual(len(self.application.traces), 1)
+        trace = self.application.traces[0]
+        self.assertEqual((trace.gateway, trace.action), ('test', 'capture'))
+        phases = trace.as_dict()
+        for phase in ['decrypt', 'bridge', 'ruby-prepare', 'ruby-gateway', 'ruby-callback', 'ruby-total', 'ipc', 'encrypt', 'total']:
+            self.assertTrue(phase in phases, phase)
+        self.assertTrue(phases['ruby-total'] <= phases['bridge'])
+        self.assertEqual(headers['Server-Timing'], trace.server_timing())
+        
+        #the timing block is not passed on to the browser
+        payload = json.loads(body[len('done('):-len(');')])['payload']
+        response = self.application.decrypt_data(payload)
+        self.assertTrue(response['success'], response['message'])
+        self.assertFalse('timing' in response)
+    
+    def test_untraced_bridge_call_has_no_timing(self):
+        response = self.application.call_bridge(data={}, secure_data={'money':'100', 'authorization':'3'}, gateway='test', action='capture')
+        self.assertFalse('timing' in response)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+"""
+Per request timing breakdown for direct posts
+
+Python times decrypting the payload, the bridge call and encrypting the
+response. Traced requests ask the bridge to time its side too, which comes
+back as a timing block in the response:
+* prepare - build_options and build_credit_card
+* gateway - the gateway call itself
+* callback - construct_callback_params
+* total - everything ruby did for the request
+Whatever remains of the bridge call is spent on IPC and queueing.
+"""
+import time
+
+
+class RequestTrace(object):
+    def __init__(self):
+        self.started = time.time()
+        self.gateway = None
+        self.action = None
+        #(phase, seconds) in the order they happened
+        self.phases = []
+    
+    def add(self, phase, seconds):
+        self.phases.append((phase, seconds))
+    
+    def add_bridge_timing(self, bridge_seconds, timing):
+        """
+        Records a bridge call given its duration and the timing block from the response
+        """
+        self.add('bridge', bridge_seconds)
+        if not timing:
+            return
+        for phase in ('prepare', 'gateway', 'callback', 'total'):
+            if phase in timing:
+                self.add('ruby-%s' % phase, timing[phase])
+        if 'total' in timing:
+            self.add('ipc', max(0, bridge_seconds - timing['total']))
+    
+    def finish(self):
+        self.add('total', time.time() - self.started)
+    
+    def as_dict(self):
+        return dict(self.phases)
+    
+    def server_timing(self):
+        """
+        Returns the phases as a Server-Timing header value, in milliseconds
+        """
+        return ', '.join('%s;dur=%.3f' % (phase, seconds * 1000) for phase, seconds in self.phases)
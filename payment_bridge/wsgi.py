@@ -1,16 +1,43 @@
-from subprocess import Popen, PIPE, STDOUT
-from threading import Lock
-from cgi import parse_qs
-from urllib import urlencode
+from __future__ import print_function
+from subprocess import Popen, PIPE
+from threading import Lock, Condition, Event, Thread, Timer
+from collections import OrderedDict
+from itertools import count
+try:
+    from urlparse import parse_qs
+    from urllib import urlencode
+except ImportError: #python 3
+    from urllib.parse import parse_qs, urlencode
+import hashlib
 import json
+import logging
 import random
+import shutil
+import signal
+import socket
+import tempfile
+import time
 import os
 
+from payment_bridge.framing import FramingError, JSON_FRAMING, negotiate_framing, read_capabilities
+from payment_bridge.idempotency import DuplicateRequestPending, IdempotencyCache
+from payment_bridge.metrics import BridgeMetrics
+from payment_bridge.payloads import DjangoSigningCodec
+from payment_bridge.tracing import RequestTrace
+
 
 random.seed()
 
+logger = logging.getLogger('payment_bridge')
+
 JSONP_RESPONSE = '%(callback)s(%(json_data)s);'
 
+def encode_body(response_body):
+    #WSGI bodies are bytes, which on python 2 str already is
+    if not isinstance(response_body, bytes):
+        response_body = response_body.encode('utf-8')
+    return response_body
+
 def flatten_dictionary(dictionary):
     new_dict = dict()
     for key, values in dictionary.items():
@@ -20,65 +47,991 @@ def flatten_dictionary(dictionary):
 SCRIPT_PATH = os.path.join(os.path.split(os.path.abspath(__file__))[0], 'am_bridge.rb')
 RUBY_PATH = 'ruby1.9.1' #specific to ubuntu
 
-class Bridge(object):
+class BridgeError(Exception):
+    pass
+
+class BridgeUnavailable(BridgeError):
+    """
+    No bridge process could take the request; nothing was sent
+    """
+    sent = False
+
+class BridgePoolFull(BridgeUnavailable):
+    pass
+
+class BridgeTimeout(BridgeError):
+    """
+    The deadline passed before the bridge answered
+    """
+    sent = None
+
+class BridgeSendTimeout(BridgeTimeout):
+    """
+    Timed out before the request was handed to the bridge; safe to retry
+    """
+    sent = False
+
+class BridgeResponseTimeout(BridgeTimeout):
+    """
+    Timed out after the request was sent; the gateway may or may not have acted on it
+    """
+    sent = True
+
+def remaining_time(deadline):
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0)
+
+class TimedLock(object):
+    """
+    A lock whose acquire can give up at a deadline, which python 2 locks cannot.
+    Any thread may release it.
+    """
+    def __init__(self):
+        self.condition = Condition()
+        self.locked = False
+    
+    def acquire(self, deadline=None):
+        self.condition.acquire()
+        try:
+            while self.locked:
+                if deadline is None:
+                    self.condition.wait()
+                elif time.time() >= deadline:
+                    return False
+                else:
+                    self.condition.wait(remaining_time(deadline))
+            self.locked = True
+            return True
+        finally:
+            self.condition.release()
+    
+    def release(self):
+        self.condition.acquire()
+        try:
+            self.locked = False
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+def log_diagnostics(stream):
+    """
+    Logs what the bridge writes to stderr, ruby warnings and anything
+    gateways print, until the process exits
+    """
+    for line in iter(stream.readline, b''):
+        logger.warning('bridge: %s', line.rstrip().decode('utf-8', 'replace'))
+    stream.close()
+
+class BridgeSupervisor(object):
+    """
+    Keeps a pre-booted standby bridge process ready so a crashed or stuck
+    process can be swapped out at once instead of waiting on a ruby boot.
+    When processes keep dying young, spawning the next standby is delayed
+    with exponential backoff.
+    """
+    #processes that lived less than this many seconds count as failures
+    min_uptime = 5
+    
+    def __init__(self, spawn, standby=True, backoff=.5, max_backoff=30):
+        #spawn returns a (process, framing, capabilities, config version) tuple ready to take requests
+        self.spawn = spawn
+        self.keep_standby = standby
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.condition = Condition()
+        self.standby = None
+        self.spawning = False
+        #a standby spawn is waiting out its backoff
+        self.scheduled = False
+        self.timer = None
+        self.closed = False
+        self.current_since = None
+        self.restarts = 0
+        self.failures = 0
+        #standby spawns that failed, and the last error, for callers waiting on one
+        self.spawn_errors = 0
+        self.spawn_error = None
+    
+    def take(self, deadline=None):
+        """
+        Returns the standby and starts preparing the next one.
+        When none is ready one is started in the background, after any backoff,
+        and waited for until deadline; BridgeSendTimeout is raised past it.
+        Only the very first process is spawned in the calling thread.
+        """
+        self.condition.acquire()
+        try:
+            spawn_errors = self.spawn_errors
+            while True:
+                process, self.standby = self.standby, None
+                if process is not None and process[0].poll() is not None:
+                    #the standby died while waiting
+                    self.failures += 1
+                    process = None
+                if process is not None or self.current_since is None:
+                    break
+                if self.closed:
+                    raise BridgeUnavailable('Bridge is closed')
+                if self.spawn_errors != spawn_errors:
+                    raise BridgeUnavailable('Could not start bridge: %s' % self.spawn_error)
+                if not self.spawning:
+                    self.schedule_standby(needed=True)
+                if deadline is not None and time.time() >= deadline:
+                    raise BridgeSendTimeout('Timed out waiting for a bridge process to start')
+                self.condition.wait(remaining_time(deadline))
+        finally:
+            self.condition.release()
+        if process is None:
+            process = self.spawn()
+        
+        now = time.time()
+        if self.current_since is not None:
+            self.restarts += 1
+            if now - self.current_since < self.min_uptime:
+                self.failures += 1
+            else:
+                self.failures = 0
+        self.current_since = now
+        self.schedule_standby()
+        return process
+    
+    def next_delay(self):
+        if not self.failures:
+            return 0
+        return min(self.max_backoff, self.backoff * 2 ** (self.failures - 1))
+    
+    def schedule_standby(self, needed=False):
+        #needed when a caller is waiting on it, even without keep_standby
+        self.condition.acquire()
+        try:
+            if self.closed or self.scheduled or not (self.keep_standby or needed):
+                return
+            self.scheduled = True
+            self.timer = Timer(self.next_delay(), self.spawn_standby)
+            self.timer.daemon = True
+            self.timer.start()
+        finally:
+            self.condition.release()
+    
+    def spawn_standby(self):
+        self.condition.acquire()
+        try:
+            self.scheduled = False
+            if self.closed or self.spawning or self.standby is not None:
+                return
+            self.spawning = True
+        finally:
+            self.condition.release()
+        
+        process = None
+        try:
+            process = self.spawn()
+        except (BridgeError, FramingError, IOError, OSError) as error:
+            logger.error('Could not start standby bridge: %s', error)
+            self.spawn_error = error
+        finally:
+            self.condition.acquire()
+            try:
+                self.spawning = False
+                if process is not None and self.closed:
+                    process[0].kill()
+                elif process is not None:
+                    self.standby = process
+                else:
+                    self.failures += 1
+                    self.spawn_errors += 1
+                self.condition.notify_all()
+            finally:
+                self.condition.release()
+        if process is None:
+            self.schedule_standby()
+    
+    def stats(self):
+        return {'restarts':self.restarts,
+                'failures':self.failures,
+                'standby_ready':self.standby is not None,}
+    
+    def close(self):
+        self.condition.acquire()
+        try:
+            self.closed = True
+            process, self.standby = self.standby, None
+            if self.timer is not None:
+                self.timer.cancel()
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+        if process is not None:
+            #a standby has not served anything, no need to let it finish
+            process[0].kill()
+            process[0].wait()
+
+class SocketWriter(object):
+    """
+    Write end of a unix socket; closing it tells the bridge there are no more
+    requests, like closing a pipe would
+    """
+    def __init__(self, sock):
+        self.socket = sock
+        self.file = sock.makefile('wb')
+    
+    def write(self, data):
+        return self.file.write(data)
+    
+    def flush(self):
+        self.file.flush()
+    
+    def close(self):
+        try:
+            self.file.close()
+            self.socket.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+
+class ZygoteProcess(object):
+    """
+    A bridge process forked by a Zygote, standing in for the Popen of one started directly
+    """
+    #its diagnostics go to the zygote's stderr
+    stderr = None
+    
+    def __init__(self, sock, stdout, pid):
+        self.socket = sock
+        self.stdin = SocketWriter(sock)
+        self.stdout = stdout
+        self.pid = pid
+        self.returncode = None
+    
+    def poll(self):
+        #the zygote reaps its children, so a finished one no longer exists
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except OSError:
+                self.returncode = -1
+        return self.returncode
+    
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    
+    def wait(self):
+        while self.poll() is None:
+            time.sleep(.01)
+        self.socket.close()
+        return self.returncode
+
+class Zygote(object):
+    """
+    A ruby process that loads ActiveMerchant and every gateway once, then forks
+    a ready bridge process for each spawn. Forking takes milliseconds where a
+    ruby boot takes seconds, and the forks share the loaded code.
+    Pass it to a bridge as zygote=.
+    """
     def __init__(self, exec_path=RUBY_PATH, script_path=SCRIPT_PATH, environ=None):
+        self.directory = tempfile.mkdtemp(prefix='payment_bridge')
+        self.socket_path = os.path.join(self.directory, 'zygote.sock')
+        self.process = Popen([exec_path, script_path, '--zygote', self.socket_path],
+                             stdin=PIPE, stdout=PIPE, stderr=PIPE, env=environ)
+        diagnostics = Thread(target=log_diagnostics, args=(self.process.stderr,))
+        diagnostics.daemon = True
+        diagnostics.start()
+        ready = self.process.stdout.readline()
+        if not ready:
+            self.close()
+            raise BridgeError('Zygote exited while starting')
+    
+    def spawn(self, options, environ=None):
+        """
+        Forks a bridge process started with options, the command line after the script path
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        process = None
+        try:
+            sock.connect(self.socket_path)
+            request = {'argv':options, 'environ':environ}
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            stdout = sock.makefile('rb')
+            forked = stdout.readline()
+            if not forked:
+                raise BridgeError('Zygote did not fork a bridge')
+            process = ZygoteProcess(sock, stdout, json.loads(forked.decode('utf-8'))['pid'])
+        finally:
+            if process is None:
+                sock.close()
+        return process
+    
+    def close(self):
+        #bridges already forked keep running until they are closed
+        self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class GatewayConfiguration(object):
+    """
+    Gateways configured on a bridge while it runs, replayed onto every
+    process it starts afterwards
+    """
+    #gateways per configure message, so big configurations load in pieces
+    chunk_size = 100
+    
+    def __init__(self, gateways=()):
         self.lock = Lock()
+        self.version = 0
+        #gateway name => config, in the order they were added
+        self.gateways = OrderedDict((config['name'], config) for config in gateways)
+        #removed and not added back, they may still be in PAYMENT_CONFIGURATION
+        self.removed = set()
+    
+    def update(self, add=(), remove=()):
+        self.lock.acquire()
+        try:
+            for name in remove:
+                self.gateways.pop(name, None)
+                self.removed.add(name)
+            for config in add:
+                self.gateways[config['name']] = config
+                self.removed.discard(config['name'])
+            self.version += 1
+        finally:
+            self.lock.release()
+    
+    def replay_messages(self):
+        """
+        Returns the version and the configure messages that bring a new process up to it
+        """
+        self.lock.acquire()
+        try:
+            version = self.version
+            configs = list(self.gateways.values())
+            removed = sorted(self.removed)
+        finally:
+            self.lock.release()
+        messages = []
+        for start in range(0, len(configs), self.chunk_size):
+            messages.append({'type':'configure', 'add':configs[start:start + self.chunk_size], 'remove':[], 'request_id':None})
+        if removed:
+            messages.append({'type':'configure', 'add':[], 'remove':removed, 'request_id':None})
+        return version, messages
+
+class Bridge(object):
+    #number of requests a single bridge will accept at once
+    max_in_flight = 1
+    
+    def __init__(self, exec_path=RUBY_PATH, script_path=SCRIPT_PATH, environ=None, framing=None, standby=True, metrics=None, gateways=None,
+                 gateway_cache_size=None, zygote=None):
+        self.lock = TimedLock()
         self.exec_path = exec_path
         self.script_path = script_path
         self.environ = environ
+        #optional Zygote to fork processes from instead of booting ruby for each
+        self.zygote = zygote
+        #gateways ruby keeps built for per-request credentials, None for its default
+        self.gateway_cache_size = gateway_cache_size
+        #gateways sent over the channel instead of through PAYMENT_CONFIGURATION
+        self.configuration = GatewayConfiguration(gateways or ())
+        #framing to ask for on startup, see payment_bridge.framing
+        self.preferred_framing = framing
+        self.framing = JSON_FRAMING
+        #gateway name => supported actions, as reported by the bridge
+        self.capabilities = None
+        self.supervisor = BridgeSupervisor(self.spawn, standby=standby)
+        #optional BridgeMetrics recording lock waits and restarts
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.add_bridge(self)
+        #the last process killed, so it is only reaped once
+        self.retired = None
         self.open()
     
-    def send(self, **kwargs):
-        kwargs['request_id'] = random.getrandbits(32)
-        in_payload = json.dumps(kwargs)
-        self.lock.acquire()
+    def send(self, deadline=None, **kwargs):
+        """
+        Sends a request and waits for its response.
+        deadline is a time.time() value; past it BridgeTimeout is raised and a
+        stuck bridge process is swapped for the standby in the background.
+        """
+        kwargs['request_id'] = self.new_request_id()
+        in_payload = self.framing.encode(kwargs)
+        waiting_since = time.time()
+        if not self.lock.acquire(deadline):
+            raise BridgeSendTimeout('Timed out waiting for the bridge')
+        if self.metrics is not None:
+            self.metrics.observe_lock_wait(time.time() - waiting_since)
+        replacing = False
         try:
-            self.slave.stdin.write(in_payload+'\n')
             if self.slave.poll() is not None:
-                print 'slave has terminated.'
-                exit()
-            out_payload = self.slave.stdout.readline()
+                #died while idle, nothing has been sent to it yet
+                logger.warning('slave has terminated.')
+                self.replace(self.slave, deadline)
+            slave = self.slave
+            watchdog = None
+            if deadline is not None:
+                watchdog = Timer(remaining_time(deadline), self.abort, [slave])
+                watchdog.start()
             try:
-                params = json.loads(out_payload)
-            except ValueError as error:
-                print error
-                print out_payload + '\n' + self.slave.stdout.read()
-                
-                #create a new exec since it crashed
-                self.close()
-                self.open()
+                self.stdin.write(in_payload)
+                self.stdin.flush()
+                params = self.framing.read(self.stdout)
+                if params is None:
+                    raise FramingError('Bridge exited before responding')
+            except (FramingError, IOError, OSError) as error:
+                #swap in a new exec since it crashed or we killed it
+                self.replace_later(slave)
+                replacing = True
+                if deadline is not None and time.time() >= deadline:
+                    raise BridgeResponseTimeout('Timed out waiting for the bridge to respond')
+                logger.error('Bridge failed: %s', error)
                 raise
+            finally:
+                if watchdog is not None:
+                    watchdog.cancel()
         finally:
-            self.lock.release()
+            if not replacing:
+                self.lock.release()
         
         #ensure we don't have someone else's response
         assert params['request_id'] == kwargs['request_id']
         
         return params
     
-    def open(self):
-        self.slave = Popen([self.exec_path, self.script_path], stdin=PIPE, stdout=PIPE, stderr=STDOUT, env=self.environ)
+    def send_many(self, items, concurrency=4, deadline=None):
+        """
+        Sends a batch of requests in one round trip.
+        items are dictionaries with gateway, action, data and secure_data; the
+        bridge runs up to concurrency of them at once and the responses come
+        back in the same order, each with its own success flag.
+        """
+        response = self.send(type='batch', items=list(items), concurrency=concurrency, deadline=deadline)
+        return response['results']
+    
+    def configure(self, add=(), remove=(), deadline=None):
+        """
+        Adds, replaces or removes gateways without restarting the bridge.
+        add is a list of gateway configs like load_gateways_config returns and
+        remove a list of gateway names. Processes started later get the same
+        changes. Returns the new capabilities.
+        """
+        add = list(add)
+        remove = list(remove)
+        self.configuration.update(add, remove)
+        response = self.send(type='configure', add=add, remove=remove, deadline=deadline)
+        self.capabilities = response['capabilities']
+        return self.capabilities
+    
+    def replay_configuration(self, stdin, stdout, framing, capabilities):
+        """
+        Sends the configure calls so far to a new process; returns the version
+        it is now at and its capabilities
+        """
+        version, messages = self.configuration.replay_messages()
+        for message in messages:
+            stdin.write(framing.encode(message))
+            stdin.flush()
+            response = framing.read(stdout)
+            if response is None:
+                raise FramingError('Bridge exited while being configured')
+            capabilities = response['capabilities']
+        return version, capabilities
+    
+    def abort(self, slave):
+        try:
+            slave.kill()
+        except OSError:
+            #already gone
+            pass
+    
+    def retire(self, slave):
+        """
+        Kills slave; it is reaped in the background
+        """
+        if slave is self.retired:
+            return
+        self.retired = slave
+        self.abort(slave)
+        def reap():
+            leftover = slave.stdout.read()
+            if leftover:
+                logger.warning('Unread bridge output: %r', leftover)
+            slave.wait()
+        thread = Thread(target=reap)
+        thread.daemon = True
+        thread.start()
+    
+    def replace(self, slave, deadline=None):
+        """
+        Kills slave and swaps in the standby, waiting for it until deadline
+        """
+        self.retire(slave)
+        self.open(deadline)
+    
+    def replace_later(self, slave):
+        """
+        Kills slave and swaps in the standby on another thread, so the caller
+        can report its failure at once. Called holding the lock, which that
+        thread releases once the new process is in; if it cannot start one the
+        next send tries again.
+        """
+        self.retire(slave)
+        def replace():
+            try:
+                self.open()
+            except (BridgeError, FramingError, IOError, OSError) as error:
+                logger.error('Could not replace bridge: %s', error)
+            finally:
+                self.lock.release()
+        thread = Thread(target=replace)
+        thread.daemon = True
+        thread.start()
+    
+    def new_request_id(self):
+        return random.getrandbits(32)
+    
+    def get_command(self):
+        command = [self.exec_path, self.script_path]
+        if self.gateway_cache_size is not None:
+            command += ['--gateway-cache', str(self.gateway_cache_size)]
+        return command
+    
+    def spawn(self):
+        if self.zygote is not None:
+            slave = self.zygote.spawn(self.get_command()[2:], self.environ)
+        else:
+            #stderr gets its own pipe so a stray warning can't corrupt a response
+            slave = Popen(self.get_command(), stdin=PIPE, stdout=PIPE, stderr=PIPE, env=self.environ)
+            diagnostics = Thread(target=log_diagnostics, args=(slave.stderr,))
+            diagnostics.daemon = True
+            diagnostics.start()
+        try:
+            capabilities = read_capabilities(slave.stdout)
+            framing = negotiate_framing(slave.stdin, slave.stdout, self.preferred_framing)
+            version, capabilities = self.replay_configuration(slave.stdin, slave.stdout, framing, capabilities)
+        except (FramingError, IOError, OSError):
+            self.abort(slave)
+            raise
+        return slave, framing, capabilities, version
+    
+    def open(self, deadline=None):
+        self.slave, self.framing, self.capabilities, version = self.supervisor.take(deadline)
+        self.stdin, self.stdout = self.slave.stdin, self.slave.stdout
+        if version != self.configuration.version:
+            #configured while the standby was booting
+            version, self.capabilities = self.replay_configuration(self.stdin, self.stdout, self.framing, self.capabilities)
+    
+    def negotiate(self):
+        capabilities = read_capabilities(self.stdout)
+        self.framing = negotiate_framing(self.stdin, self.stdout, self.preferred_framing)
+        version, self.capabilities = self.replay_configuration(self.stdin, self.stdout, self.framing, capabilities)
+    
+    def close(self):
+        self.supervisor.close()
+        if self.slave is self.retired:
+            #killed and being reaped already
+            return
+        self.slave.stdin.close()
+        outdata = self.slave.stdout.read()
+        self.slave.wait()
+        logger.debug('Shutdown bridge result: %r', outdata)
+
+class PendingResponse(object):
+    def __init__(self):
+        self.event = Event()
+        self.response = None
+        self.error = None
+    
+    def set(self, response=None, error=None):
+        self.response = response
+        self.error = error
+        self.event.set()
+    
+    def get(self, deadline=None):
+        self.event.wait(remaining_time(deadline))
+        if not self.event.is_set():
+            raise BridgeResponseTimeout('Timed out waiting for the bridge to respond')
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+class MultiplexedBridge(Bridge):
+    """
+    Keeps many requests in flight over a single bridge process.
+    The ruby side works through requests on a pool of threads and answers
+    them out of order; a reader thread hands each response to the caller
+    waiting on its request_id.
+    """
+    def __init__(self, threads=16, **kwargs):
+        self.threads = threads
+        self.max_in_flight = threads
+        self.pending = dict()
+        self.pending_lock = Lock()
+        self.request_ids = count()
+        #requests whose callers timed out while ruby is still working on them
+        self.abandoned = set()
+        #false while the reader thread is reconnecting
+        self.connected = False
+        #connections reopened after the process or daemon went away
+        self.reconnects = 0
+        self.closing = False
+        self.closed = Event()
+        super(MultiplexedBridge, self).__init__(**kwargs)
+    
+    def new_request_id(self):
+        return next(self.request_ids)
+    
+    def get_command(self):
+        return super(MultiplexedBridge, self).get_command() + ['--threads', str(self.threads)]
+    
+    def open(self, deadline=None):
+        self.connect(deadline)
+        self.connected = True
+        self.reader = Thread(target=self.read_responses, args=(self.stdout,))
+        self.reader.daemon = True
+        self.reader.start()
+    
+    def connect(self, deadline=None):
+        super(MultiplexedBridge, self).open(deadline)
+    
+    def disconnect(self):
+        self.stdin.close()
+        self.slave.wait()
+    
+    def send(self, deadline=None, **kwargs):
+        pending = PendingResponse()
+        request_id = kwargs['request_id'] = self.new_request_id()
+        in_payload = self.framing.encode(kwargs)
+        self.pending_lock.acquire()
+        try:
+            self.pending[request_id] = pending
+        finally:
+            self.pending_lock.release()
+        
+        waiting_since = time.time()
+        if not self.lock.acquire(deadline):
+            self.pop_pending(request_id)
+            raise BridgeSendTimeout('Timed out waiting for the bridge')
+        if self.metrics is not None:
+            self.metrics.observe_lock_wait(time.time() - waiting_since)
+        try:
+            if not self.connected:
+                #nothing would read the response
+                self.pop_pending(request_id)
+                raise BridgeUnavailable('Bridge is reconnecting')
+            self.stdin.write(in_payload)
+            self.stdin.flush()
+        except (IOError, OSError, ValueError) as error:
+            #ValueError is raised when writing to a closed file
+            self.pop_pending(request_id)
+            raise BridgeError('Could not write to bridge: %s' % error)
+        finally:
+            self.lock.release()
+        
+        try:
+            return pending.get(deadline)
+        except BridgeResponseTimeout:
+            self.abandon(request_id)
+            raise
+    
+    def pop_pending(self, request_id):
+        self.pending_lock.acquire()
+        try:
+            pending = self.pending.pop(request_id, None)
+            if pending is None:
+                #a late answer to an abandoned request
+                self.abandoned.discard(request_id)
+            return pending
+        finally:
+            self.pending_lock.release()
+    
+    def abandon(self, request_id):
+        """
+        Stops waiting on a request. A single slow gateway call is left to
+        finish, but once every ruby thread is stuck on abandoned requests
+        the bridge is replaced.
+        """
+        self.pending_lock.acquire()
+        try:
+            if self.pending.pop(request_id, None) is None:
+                return
+            self.abandoned.add(request_id)
+            stuck = len(self.abandoned) >= self.threads
+        finally:
+            self.pending_lock.release()
+        if stuck:
+            logger.warning('All bridge threads are stuck, restarting the bridge')
+            self.reset()
+    
+    def reset(self):
+        #the reader thread notices the process is gone and opens a new one
+        self.abort(self.slave)
+    
+    def read_responses(self, stdout):
+        framing = self.framing
+        while True:
+            try:
+                params = framing.read(stdout)
+            except FramingError as error:
+                logger.warning('Unparsable bridge output: %r', error.data)
+                continue
+            if params is None:
+                break
+            pending = self.pop_pending(params.get('request_id'))
+            if pending is not None:
+                pending.set(response=params)
+        
+        #the process is gone, nobody still waiting on it will get an answer
+        self.pending_lock.acquire()
+        try:
+            self.connected = False
+            pending, self.pending = list(self.pending.values()), dict()
+            self.abandoned = set()
+        finally:
+            self.pending_lock.release()
+        for waiting in pending:
+            waiting.set(error=BridgeError('Bridge exited before responding'))
+        self.reconnect()
+    
+    def reconnect(self):
+        """
+        Opens a new connection, which starts its own reader thread, retrying
+        with the supervisor's backoff until it works or the bridge is closed
+        """
+        delay = self.supervisor.backoff
+        while not self.closing:
+            self.lock.acquire()
+            try:
+                self.open()
+                self.reconnects += 1
+                return
+            except (BridgeError, FramingError, IOError, OSError) as error:
+                logger.error('Could not reopen bridge, retrying in %ss: %s', delay, error)
+            finally:
+                self.lock.release()
+            self.closed.wait(delay)
+            delay = min(delay * 2, self.supervisor.max_backoff)
     
     def close(self):
-        #self.slave.stdin.close()
-        outdata, errdata = self.slave.communicate()
-        print 'Shutdown bridge result:', outdata, errdata
-        #self.slave.terminate()
-        #self.slave.kill()
+        self.closing = True
+        self.closed.set()
+        self.supervisor.close()
+        self.disconnect()
+        self.reader.join()
+
+class SocketBridge(MultiplexedBridge):
+    """
+    Client for a shared bridge daemon listening on a unix socket, started with:
+    ruby am_bridge.rb --socket PATH --threads N
+    The daemon loads ActiveMerchant once and serves every process on the host.
+    Unlike MultiplexedBridge, reset cannot kill the stuck ruby threads; it
+    only drops this client's connection, and the daemon's threads finish their
+    gateway calls before they are freed.
+    """
+    def __init__(self, socket_path, max_in_flight=16, framing=None, metrics=None, gateways=None):
+        self.socket_path = socket_path
+        super(SocketBridge, self).__init__(threads=max_in_flight, framing=framing, standby=False, metrics=metrics, gateways=gateways)
+    
+    def get_command(self):
+        raise NotImplementedError('SocketBridge connects to a running daemon')
+    
+    def connect(self, deadline=None):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(self.socket_path)
+        self.stdin = self.socket.makefile('wb')
+        self.stdout = self.socket.makefile('rb')
+        self.negotiate()
+    
+    def disconnect(self):
+        self.reset()
+        self.stdin.close()
+        self.socket.close()
+    
+    def reset(self):
+        #the next connection gets fresh daemon threads, the old ones are left to finish
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+class BridgePool(object):
+    """
+    Spreads requests across several pre-spawned bridges.
+    Each request is handed to the least loaded bridge with spare capacity;
+    when every bridge is busy callers queue up, at most max_waiting deep.
+    """
+    def __init__(self, size=4, max_waiting=None, bridge_class=Bridge, **kwargs):
+        self.condition = Condition()
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self.metrics = kwargs.get('metrics')
+        self.workers = [bridge_class(**kwargs) for index in range(size)]
+        self.load = [0] * size
+    
+    @property
+    def capabilities(self):
+        #every worker runs the same configuration
+        return self.workers[0].capabilities
+    
+    def send(self, deadline=None, **kwargs):
+        waiting_since = time.time()
+        index = self.acquire(deadline)
+        if self.metrics is not None:
+            self.metrics.observe_queue_wait(time.time() - waiting_since)
+        try:
+            return self.workers[index].send(deadline=deadline, **kwargs)
+        finally:
+            self.release(index)
+    
+    def send_many(self, items, concurrency=4, deadline=None):
+        index = self.acquire(deadline)
+        try:
+            return self.workers[index].send_many(items, concurrency=concurrency, deadline=deadline)
+        finally:
+            self.release(index)
+    
+    def configure(self, add=(), remove=(), deadline=None):
+        add = list(add)
+        remove = list(remove)
+        for worker in self.workers:
+            capabilities = worker.configure(add, remove, deadline=deadline)
+        return capabilities
+    
+    def acquire(self, deadline=None):
+        self.condition.acquire()
+        try:
+            index = self.pick_worker()
+            if index is None:
+                if self.max_waiting is not None and self.waiting >= self.max_waiting:
+                    raise BridgePoolFull('%s requests are already waiting for a bridge' % self.waiting)
+                self.waiting += 1
+                try:
+                    while index is None:
+                        if deadline is not None and time.time() >= deadline:
+                            raise BridgeSendTimeout('Timed out waiting for a free bridge')
+                        self.condition.wait(remaining_time(deadline))
+                        index = self.pick_worker()
+                finally:
+                    self.waiting -= 1
+            self.load[index] += 1
+            return index
+        finally:
+            self.condition.release()
+    
+    def release(self, index):
+        self.condition.acquire()
+        try:
+            self.load[index] -= 1
+            self.condition.notify()
+        finally:
+            self.condition.release()
+    
+    def pick_worker(self):
+        #least loaded worker that can take another request
+        best = None
+        for index, worker in enumerate(self.workers):
+            if self.load[index] >= worker.max_in_flight:
+                continue
+            if best is None or self.load[index] < self.load[best]:
+                best = index
+        return best
+    
+    def close(self):
+        for worker in self.workers:
+            worker.close()
 
 class BaseDirectPostApplication(object):
     encrypted_field = 'payload'
+    #set to run requests across a pool of bridges instead of a single one
+    bridge_pool_size = None
+    bridge_max_waiting = None
+    #set to keep this many requests in flight on each bridge
+    bridge_threads = None
+    #set to use a shared bridge daemon instead of starting our own
+    bridge_socket = None
+    #set to 'msgpack' to use length prefixed MessagePack frames when available
+    bridge_framing = None
+    #seconds a direct post may wait on the bridge before BridgeTimeout is raised
+    bridge_timeout = None
+    #set to record bridge calls in application.metrics, see construct_metrics
+    collect_metrics = False
+    #set to time every direct post, see record_trace
+    trace_requests = False
+    #set to also send traced timings to the browser in a Server-Timing header
+    server_timing = False
+    #set to fork bridge processes from a Zygote instead of booting ruby for each
+    bridge_zygote = False
+    #gateways each bridge keeps built for merchant credentials, see load_merchant_gateway
+    bridge_gateway_cache_size = None
+    #set to replay direct posts to their duplicates, see get_idempotency_key
+    idempotency_cache_size = None
+    #seconds a result is replayed for
+    idempotency_ttl = 600
+    #set to treat direct posts with identical caller data as duplicates
+    derive_idempotency_keys = False
+    #caller data that varies between duplicates, like JSONP callback names
+    idempotency_ignored_fields = ('callback', '_')
+    #seconds a duplicate of an in flight direct post is told to wait before retrying
+    idempotency_retry_after = 1
     
     def __init__(self, redirect_to):
         self.redirect_to = redirect_to
+        self.codec = self.construct_codec()
+        self.metrics = self.construct_metrics()
+        self.idempotency = self.construct_idempotency_cache()
+        self.zygote = self.construct_zygote()
         self.bridge = self.construct_bridge()
     
+    def construct_codec(self):
+        """
+        Returns the codec encrypt_data and decrypt_data use, such as a
+        payloads.SignedCodec, or None if they are overridden instead
+        """
+        return None
+    
+    def construct_metrics(self):
+        """
+        Returns the BridgeMetrics to record calls in, or None to record nothing
+        """
+        if not self.collect_metrics:
+            return None
+        return BridgeMetrics()
+    
+    def construct_idempotency_cache(self):
+        """
+        Returns the IdempotencyCache to replay results from, or None to send every direct post
+        Override to pass a backend shared between processes
+        """
+        if not self.idempotency_cache_size:
+            return None
+        return IdempotencyCache(max_entries=self.idempotency_cache_size, ttl=self.idempotency_ttl)
+    
+    def construct_zygote(self):
+        if not self.bridge_zygote or self.bridge_socket:
+            return None
+        return Zygote()
+    
     def construct_bridge(self):
+        if self.bridge_socket:
+            return SocketBridge(self.bridge_socket, max_in_flight=self.bridge_threads or 16, framing=self.bridge_framing, metrics=self.metrics)
         config = self.load_gateways_config()
-        return Bridge(environ={'PAYMENT_CONFIGURATION':json.dumps(config)})
+        kwargs = {'environ':{},
+                  'gateways':config,
+                  'gateway_cache_size':self.bridge_gateway_cache_size,
+                  'zygote':self.zygote,
+                  'framing':self.bridge_framing,
+                  'metrics':self.metrics,}
+        bridge_class = Bridge
+        if self.bridge_threads:
+            bridge_class = MultiplexedBridge
+            kwargs['threads'] = self.bridge_threads
+        if self.bridge_pool_size:
+            return BridgePool(size=self.bridge_pool_size, max_waiting=self.bridge_max_waiting, bridge_class=bridge_class, **kwargs)
+        return bridge_class(**kwargs)
     
     def shutdown(self):
         self.bridge.close()
+        if self.zygote is not None:
+            self.zygote.close()
     
     def load_gateways_config(self):
         """
@@ -94,30 +1047,242 @@ class BaseDirectPostApplication(object):
         """
         Takes an encoded string and returns a dictionary
         """
-        raise NotImplementedError
+        if self.codec is None:
+            raise NotImplementedError
+        return self.codec.loads(encrypted_data)
     
     def encrypt_data(self, params):
         """
         Takes a dictionary and returns a string
         """
+        if self.codec is None:
+            raise NotImplementedError
+        return self.codec.dumps(params)
+    
+    def load_merchant_gateway(self, merchant):
+        """
+        Returns the gateway for a merchant named in the secure data, a
+        dictionary containing:
+        * module - string
+        * params - dictionary of the merchant's credentials
+        The bridge builds it on first use and keeps it in an LRU.
+        """
         raise NotImplementedError
     
-    def call_bridge(self, data, secure_data, gateway, action):
-        return self.bridge.send(data=data, secure_data=secure_data, gateway=gateway, action=action)
+    def call_bridge(self, data, secure_data, gateway, action, deadline=None, trace=False, gateway_config=None):
+        kwargs = {'data':data,
+                  'secure_data':secure_data,
+                  'gateway':gateway,
+                  'action':action,
+                  'deadline':deadline,
+                  'trace':trace,}
+        if gateway_config is not None:
+            kwargs['gateway_config'] = gateway_config
+        if self.metrics is None:
+            response = self.bridge.send(**kwargs)
+            response.pop('gateway_cache', None)
+            return response
+        self.metrics.request_started()
+        started = time.time()
+        response = None
+        try:
+            response = self.bridge.send(**kwargs)
+        finally:
+            self.metrics.request_finished(gateway, action, time.time() - started, response)
+        gateway_cache = response.pop('gateway_cache', None)
+        if gateway_cache is not None:
+            self.metrics.observe_gateway_cache(gateway_cache['hit'], gateway_cache['evicted'])
+        return response
+    
+    def get_deadline(self):
+        if self.bridge_timeout is None:
+            return None
+        return time.time() + self.bridge_timeout
     
-    def process_direct_post(self, caller_data):
+    def read_direct_post(self, caller_data):
+        """
+        Decrypts the caller's payload and returns the keyword arguments for call_bridge
+        """
+        deadline = self.get_deadline()
         encrypted_data = caller_data[self.encrypted_field]
         decrypted_data = self.decrypt_data(encrypted_data)
-        gateway_key = decrypted_data['gateway']
-        action = decrypted_data['action']
-        redirect_to = decrypted_data.get('redirect', self.redirect_to)
-        
-        response_params = self.call_bridge(data=caller_data, secure_data=decrypted_data, gateway=gateway_key, action=action)
+        bridge_kwargs = {'data':caller_data,
+                         'secure_data':decrypted_data,
+                         'action':decrypted_data['action'],
+                         'deadline':deadline,}
+        if 'merchant' in decrypted_data:
+            #one of many sub-merchants, labelled by gateway module so metrics
+            #stay one series per module
+            gateway_config = self.load_merchant_gateway(decrypted_data['merchant'])
+            bridge_kwargs['gateway'] = gateway_config['module']
+            bridge_kwargs['gateway_config'] = gateway_config
+        else:
+            bridge_kwargs['gateway'] = decrypted_data['gateway']
+        return bridge_kwargs
+    
+    def build_direct_post_result(self, bridge_kwargs, response_params):
+        redirect_to = bridge_kwargs['secure_data'].get('redirect', self.redirect_to)
         return {'url_params':{self.encrypted_field: self.encrypt_data(response_params)},
                 'redirect':redirect_to,}
     
+    def check_supported(self, gateway, action):
+        """
+        Returns the bridge's error response for a gateway or action it does
+        not support, or None if the request should go to the bridge
+        """
+        capabilities = self.bridge.capabilities
+        if capabilities is None:
+            return None
+        if gateway not in capabilities:
+            message = 'Unrecognized gateway'
+        elif action not in capabilities[gateway]:
+            message = 'Unrecognized Action'
+        else:
+            return None
+        return {'message':message,
+                'success':False,
+                'gateway':gateway,
+                'action':action,}
+    
+    def start_trace(self):
+        if not self.trace_requests:
+            return None
+        return RequestTrace()
+    
+    def record_trace(self, trace):
+        """
+        Called with the RequestTrace of every traced direct post once it is done
+        """
+        pass
+    
+    def get_idempotency_key(self, bridge_kwargs):
+        """
+        Returns the key shared by duplicates of a direct post, or None if it has none
+        Uses the idempotency_key in the secure data, or a hash of the caller
+        data if derive_idempotency_keys is set
+        """
+        secure_data = bridge_kwargs['secure_data']
+        if secure_data.get('idempotency_key'):
+            key = str(secure_data['idempotency_key'])
+        elif self.derive_idempotency_keys:
+            data = dict((name, value) for name, value in bridge_kwargs['data'].items()
+                        if name not in self.idempotency_ignored_fields)
+            key = hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+        else:
+            return None
+        if 'merchant' in secure_data:
+            return '%s:%s:%s' % (secure_data['merchant'], bridge_kwargs['action'], key)
+        return '%s:%s:%s' % (bridge_kwargs['gateway'], bridge_kwargs['action'], key)
+    
+    def start_direct_post(self, caller_data, trace=None):
+        """
+        Decrypts a direct post; returns the keyword arguments for call_bridge
+        and its idempotency key, if it is to be replayed to duplicates
+        """
+        started = time.time()
+        bridge_kwargs = self.read_direct_post(caller_data)
+        if trace is not None:
+            trace.add('decrypt', time.time() - started)
+            trace.gateway = bridge_kwargs['gateway']
+            trace.action = bridge_kwargs['action']
+            bridge_kwargs['trace'] = True
+        key = None
+        if self.idempotency is not None:
+            key = self.get_idempotency_key(bridge_kwargs)
+        return bridge_kwargs, key
+    
+    def replay_direct_post(self, result, started, trace=None):
+        if trace is not None:
+            trace.add('replay', time.time() - started)
+        if self.metrics is not None:
+            self.metrics.observe_replay()
+        return result
+    
+    def release_idempotency_key(self, key, result):
+        #without a result the request is known not to have reached the bridge, so it may be retried
+        if result is None:
+            self.idempotency.abandon(key)
+        else:
+            self.idempotency.finish(key, result)
+    
+    def process_direct_post(self, caller_data, trace=None):
+        bridge_kwargs, key = self.start_direct_post(caller_data, trace)
+        if key is None:
+            return self.execute_direct_post(bridge_kwargs, trace)
+        
+        started = time.time()
+        result = self.idempotency.begin(key, bridge_kwargs['deadline'])
+        if result is not None:
+            return self.replay_direct_post(result, started, trace)
+        try:
+            result = self.execute_direct_post(bridge_kwargs, trace)
+        except Exception as error:
+            if getattr(error, 'sent', True) is not False:
+                #it may have reached the gateway, so duplicates must not charge again
+                result = self.build_outcome_unknown_result(bridge_kwargs)
+            raise
+        finally:
+            self.release_idempotency_key(key, result)
+        return result
+    
+    def build_outcome_unknown_result(self, bridge_kwargs):
+        """
+        Returns the result replayed to duplicates of a direct post that timed
+        out after reaching the bridge
+        """
+        response_params = {'message':'Timed out waiting for the gateway, the payment may have gone through',
+                           'success':False,
+                           'outcome_unknown':True,
+                           'gateway':bridge_kwargs['gateway'],
+                           'action':bridge_kwargs['action'],}
+        return self.build_direct_post_result(bridge_kwargs, response_params)
+    
+    def check_direct_post(self, bridge_kwargs):
+        """
+        Returns the error response for a direct post the bridge can't serve,
+        or None if it should be sent
+        """
+        if 'gateway_config' in bridge_kwargs:
+            #merchant gateways are not in the capabilities, ruby checks those
+            return None
+        return self.check_supported(bridge_kwargs['gateway'], bridge_kwargs['action'])
+    
+    def finish_direct_post(self, bridge_kwargs, response_params, trace=None, bridge_started=None):
+        """
+        Returns the result for a direct post's response; bridge_started is
+        when it was sent, None if it never went to the bridge
+        """
+        if trace is not None and bridge_started is not None:
+            trace.add_bridge_timing(time.time() - bridge_started, response_params.pop('timing', None))
+        started = time.time()
+        result = self.build_direct_post_result(bridge_kwargs, response_params)
+        if trace is not None:
+            trace.add('encrypt', time.time() - started)
+        return result
+    
+    def execute_direct_post(self, bridge_kwargs, trace=None):
+        response_params = self.check_direct_post(bridge_kwargs)
+        if response_params is not None:
+            return self.finish_direct_post(bridge_kwargs, response_params, trace)
+        started = time.time()
+        response_params = self.call_bridge(**bridge_kwargs)
+        return self.finish_direct_post(bridge_kwargs, response_params, trace, started)
+    
+    def finish_trace(self, trace, response_headers):
+        trace.finish()
+        self.record_trace(trace)
+        if self.server_timing:
+            response_headers.append(('Server-Timing', trace.server_timing()))
+    
+    def render_jsonp(self, callback, url_params):
+        return JSONP_RESPONSE % {'callback':callback, 'json_data': json.dumps(url_params)}
+    
+    def render_redirect(self, params):
+        return '%s?%s' % (params['redirect'], urlencode(params['url_params']))
+    
     def render_bad_request(self, environ, start_response, response_body):
         status = '405 METHOD NOT ALLOWED'
+        response_body = encode_body(response_body)
         
         response_headers = [('Content-Type', 'text/html'),
                       ('Content-Length', str(len(response_body)))]
@@ -125,7 +1290,19 @@ class BaseDirectPostApplication(object):
         
         return [response_body]
     
+    def render_duplicate_pending(self, environ, start_response):
+        status = '409 CONFLICT'
+        response_body = encode_body('The original request is still in progress; retry shortly.')
+        
+        response_headers = [('Content-Type', 'text/html'),
+                      ('Content-Length', str(len(response_body))),
+                      ('Retry-After', str(self.idempotency_retry_after))]
+        start_response(status, response_headers)
+        
+        return [response_body]
+    
     def __call__(self, environ, start_response):
+        trace = self.start_trace()
         if environ['REQUEST_METHOD'].upper() == 'GET':
             
             #read our caller data from GET params
@@ -136,9 +1313,12 @@ class BaseDirectPostApplication(object):
             if not callback:
                 return self.render_bad_request(environ, start_response, "Invalid JSONP request; Please provide 'callback'.")
             
-            params = self.process_direct_post(caller_data)['url_params']
+            try:
+                params = self.process_direct_post(caller_data, trace)['url_params']
+            except DuplicateRequestPending:
+                return self.render_duplicate_pending(environ, start_response)
             
-            response_body = JSONP_RESPONSE % {'callback':callback, 'json_data': json.dumps(params)}
+            response_body = self.render_jsonp(callback, params)
             
             status = '200 OK'
             content_type = 'text/javascript'
@@ -151,20 +1331,27 @@ class BaseDirectPostApplication(object):
             
             # read our caller data from POST params
             request_body = environ['wsgi.input'].read(request_body_size)
+            if not isinstance(request_body, str): #python 3
+                request_body = request_body.decode('utf-8')
             caller_data = flatten_dictionary(parse_qs(request_body))
             
-            params = self.process_direct_post(caller_data)
-            
+            try:
+                params = self.process_direct_post(caller_data, trace)
+            except DuplicateRequestPending:
+                return self.render_duplicate_pending(environ, start_response)
             
-            response_body = '%s?%s' % (params['redirect'], urlencode(params['url_params']))
+            response_body = self.render_redirect(params)
             
             status = '303 SEE OTHER'
             content_type = 'text/html'
         else:
             return self.render_bad_request(environ, start_response, "Request method must be a POST or JSONP")
         
+        response_body = encode_body(response_body)
         response_headers = [('Content-Type', content_type),
                       ('Content-Length', str(len(response_body)))]
+        if trace is not None:
+            self.finish_trace(trace, response_headers)
         start_response(status, response_headers)
         
         return [response_body]
@@ -184,19 +1371,8 @@ class DjangoDirectPostApplication(BaseDirectPostApplication):
         from django.conf import settings
         return getattr(settings, self.settings_name, [])
     
-    def decrypt_data(self, encrypted_data):
-        """
-        Takes an encoded string and returns a dictionary
-        """
-        from django.core.signing import loads
-        return loads(encrypted_data, salt=self.salt_namespace)
-    
-    def encrypt_data(self, params):
-        """
-        Takes a dictionary and returns a string
-        """
-        from django.core.signing import dumps
-        return dumps(params, salt=self.salt_namespace)
+    def construct_codec(self):
+        return DjangoSigningCodec(salt=self.salt_namespace)
 
 class DirectPostMiddleware(object):
     def __init__(self, main_application, direct_post_application, url_endpoint):
@@ -222,7 +1398,7 @@ def sanity_test():
                  'cc_ccv': '111',
                  'bill_first_name':'John',
                  'bill_last_name': 'Smith',}
-    print bridge.send(test=True, gateway='bogus', action='store', data=bill_info)
+    print(bridge.send(test=True, gateway='bogus', action='store', data=bill_info))
     
     bill_info = {'cc_number':'2', #for failure use 2
                  'cc_exp_year': '2015',
@@ -230,7 +1406,7 @@ def sanity_test():
                  'cc_ccv': '111',
                  'bill_first_name':'John',
                  'bill_last_name': 'Smith',}
-    print bridge.send(test=True, gateway='bogus', action='store', data=bill_info)
+    print(bridge.send(test=True, gateway='bogus', action='store', data=bill_info))
 
 if __name__ == '__main__':
     sanity_test()